@@ -0,0 +1,259 @@
+# audio_analysis.py
+# Local audio analysis on the orchestrator host. Tracks are decoded by ffmpeg into a mono PCM stream that is read in
+# fixed-size chunks, so memory stays flat regardless of track length; spectra and peaks are computed with NumPy.
+# CPU-heavy work runs in a process pool so the orchestrator thread and the Telegram bot are never blocked on it.
+
+import logging
+import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+    logging.warning("NumPy not installed. Local audio fingerprinting disabled.")
+
+# --- Analysis Parameters ---
+SAMPLE_RATE = 11025           # Riffusion output carries little energy above ~5 kHz; a low rate keeps FFTs small
+FFT_SIZE = 1024
+HOP_SIZE = 512
+CHUNK_FRAMES = 256            # STFT frames per decoded chunk (~12 s of audio at the settings above)
+PEAK_BANDS = (0, 10, 20, 40, 80, 160, 512)   # FFT bin band edges; the strongest bin per band per frame is a peak candidate
+PEAK_MIN_DB_ABOVE_MEAN = 6.0  # Candidates must stand this far above the frame's mean log magnitude
+FAN_OUT = 3                   # Each anchor peak is paired with this many following peaks
+MAX_PAIR_FRAMES = 64          # Target zone length in frames
+ANALYSIS_TIMEOUT_SECONDS = 180
+ONSET_FFT_SIZE = 512          # Tempo uses its own finer STFT: ~86 onset frames/s instead of the fingerprint's ~21.5
+ONSET_HOP_SIZE = 128
+TEMPO_MIN_BPM = 60
+TEMPO_MAX_BPM = 180
+TEMPO_PRIOR_BPM = 120         # Log-Gaussian prior that settles half/double-tempo ambiguity towards common tempos
+CHROMA_MIN_HZ = 110           # Below this the fingerprint STFT's ~10.8 Hz bins are wider than a semitone
+CHROMA_MAX_HZ = 4000
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def ffmpeg_available():
+    return shutil.which("ffmpeg") is not None
+
+
+def iter_pcm_chunks(audio_path, chunk_samples):
+    # Yields float32 mono sample blocks of chunk_samples (the last one may be shorter) straight from ffmpeg's stdout.
+    cmd = ["ffmpeg", "-v", "error", "-nostdin", "-i", audio_path, "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "-"]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE); finished = False
+    try:
+        chunk_bytes = chunk_samples * 2
+        while True:
+            raw = proc.stdout.read(chunk_bytes)
+            if not raw: break
+            yield np.frombuffer(raw[:len(raw) - len(raw) % 2], dtype="<i2").astype(np.float32) / 32768.0
+        finished = True
+    finally:
+        if not finished and proc.poll() is None: proc.kill()  # Consumer stopped early; don't leave ffmpeg blocked on a full pipe
+        proc.stdout.close(); stderr = proc.stderr.read().decode("utf-8", "replace").strip(); proc.stderr.close(); return_code = proc.wait()
+    if return_code != 0: raise RuntimeError(f"ffmpeg exited {return_code}: {stderr[-300:]}")
+
+
+class StreamingSTFT:
+    # Frames a sample stream block by block; each block is framed together with the tail of the previous one so no frame is lost at block edges.
+    def __init__(self, fft_size, hop_size):
+        self.fft_size = fft_size; self.hop_size = hop_size; self.window = np.hanning(fft_size).astype(np.float32); self.carry = np.zeros(0, dtype=np.float32)
+
+    def push(self, samples):
+        # Magnitude spectra (frames x fft_size/2+1) of every frame completed by `samples`, or None if none completed.
+        buffer = np.concatenate([self.carry, samples])
+        if len(buffer) < self.fft_size: self.carry = buffer; return None
+        num_frames = 1 + (len(buffer) - self.fft_size) // self.hop_size
+        frames = np.lib.stride_tricks.as_strided(buffer, shape=(num_frames, self.fft_size), strides=(buffer.strides[0] * self.hop_size, buffer.strides[0]))
+        magnitudes = np.abs(np.fft.rfft(frames * self.window, axis=1)); self.carry = buffer[num_frames * self.hop_size:].copy()
+        return magnitudes
+
+
+def find_peaks(log_spec):
+    # Returns (frame_offsets, bins) of the strongest bin per band per frame, keeping only bins well above the frame mean.
+    frame_means = log_spec.mean(axis=1, keepdims=True); peak_frames = []; peak_bins = []
+    for low, high in zip(PEAK_BANDS[:-1], PEAK_BANDS[1:]):
+        band = log_spec[:, low:high]; best = band.argmax(axis=1); best_db = band[np.arange(len(band)), best]
+        keep = best_db >= frame_means[:, 0] + PEAK_MIN_DB_ABOVE_MEAN
+        peak_frames.append(np.nonzero(keep)[0]); peak_bins.append(best[keep] + low)
+    frames = np.concatenate(peak_frames); bins = np.concatenate(peak_bins); order = np.lexsort((bins, frames))
+    return frames[order], bins[order]
+
+
+def landmark_hashes(frames, bins):
+    # Pairs every peak with its next FAN_OUT peaks inside the target zone: hash = f1 (10 bits) | f2 (10 bits) | dt (6 bits).
+    hashes = []
+    for offset in range(1, FAN_OUT + 1):
+        if len(frames) <= offset: break
+        dt = frames[offset:] - frames[:-offset]; valid = (dt > 0) & (dt < MAX_PAIR_FRAMES)
+        pair_hashes = (bins[:-offset][valid].astype(np.int64) << 16) | (bins[offset:][valid].astype(np.int64) << 6) | dt[valid].astype(np.int64)
+        hashes.append(np.stack([frames[:-offset][valid], pair_hashes], axis=1))
+    if not hashes: return []
+    all_hashes = np.concatenate(hashes); all_hashes = all_hashes[np.lexsort((all_hashes[:, 1], all_hashes[:, 0]))]
+    return all_hashes[:, 1].tolist()
+
+
+# --- Tempo / Key / Duration ---
+_KEY_NAMES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+_MAJOR_PROFILE = [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88]   # Krumhansl-Kessler key profiles
+_MINOR_PROFILE = [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17]
+
+
+def _chroma_bins():
+    # FFT bins of the fingerprint STFT inside the chroma range, and the pitch class (C=0) each one maps to.
+    freqs = np.arange(FFT_SIZE // 2 + 1) * SAMPLE_RATE / FFT_SIZE
+    bins = np.nonzero((freqs >= CHROMA_MIN_HZ) & (freqs <= CHROMA_MAX_HZ))[0]
+    return bins, (np.round(12 * np.log2(freqs[bins] / 440.0)).astype(int) + 9) % 12
+
+
+def estimate_tempo(onset_envelope, frame_rate):
+    # BPM from the autocorrelation of the onset envelope, weighted by a tempo prior; None for too little audio.
+    if len(onset_envelope) < frame_rate * 4: return None
+    env = onset_envelope - onset_envelope.mean(); n = len(env)
+    autocorr = np.fft.irfft(np.abs(np.fft.rfft(env, 2 * n)) ** 2)[:n]
+    min_lag = max(1, int(60 * frame_rate / TEMPO_MAX_BPM)); max_lag = min(n - 2, int(np.ceil(60 * frame_rate / TEMPO_MIN_BPM)))
+    lags = np.arange(min_lag, max_lag + 1)
+    score = autocorr[lags] * np.exp(-0.5 * np.log2(60 * frame_rate / lags / TEMPO_PRIOR_BPM) ** 2)
+    best = int(np.argmax(score))
+    if score[best] <= 0: return None
+    lag = float(lags[best])
+    if 0 < best < len(score) - 1:  # Parabolic interpolation between lags for sub-frame precision
+        a, b, c = score[best - 1], score[best], score[best + 1]; denom = a - 2 * b + c
+        if denom != 0: lag += 0.5 * (a - c) / denom
+    return round(60 * frame_rate / lag, 1)
+
+
+def estimate_key(chroma):
+    # (key name like "A" / "F#m", correlation) of the best-matching rotated major/minor profile.
+    if not np.any(chroma): return None, 0.0
+    profiles = np.array([np.roll(_MAJOR_PROFILE, k) for k in range(12)] + [np.roll(_MINOR_PROFILE, k) for k in range(12)])
+    profiles = profiles - profiles.mean(axis=1, keepdims=True); centered = chroma - chroma.mean()
+    scores = profiles @ centered / (np.linalg.norm(profiles, axis=1) * np.linalg.norm(centered) + 1e-12); best = int(np.argmax(scores))
+    return _KEY_NAMES[best % 12] + ("m" if best >= 12 else ""), round(float(scores[best]), 3)
+
+
+def compute_track_analysis(audio_path):
+    # Worker-side entry point: one decode pass gives the fingerprint, tempo, key and duration, plus the MP3 frame check.
+    fingerprint_stft = StreamingSTFT(FFT_SIZE, HOP_SIZE); onset_stft = StreamingSTFT(ONSET_FFT_SIZE, ONSET_HOP_SIZE)
+    chroma_bins, pitch_classes = _chroma_bins(); chroma = np.zeros(12)
+    frame_base = 0; all_frames = []; all_bins = []; flux = []; previous = None; total_samples = 0
+    for samples in iter_pcm_chunks(audio_path, CHUNK_FRAMES * HOP_SIZE):
+        total_samples += len(samples)
+        magnitudes = fingerprint_stft.push(samples)
+        if magnitudes is not None:
+            log_spec = 20.0 * np.log10(magnitudes + 1e-6); frames, bins = find_peaks(log_spec); all_frames.append(frames + frame_base); all_bins.append(bins); frame_base += len(log_spec)
+            chroma += np.bincount(pitch_classes, weights=(magnitudes[:, chroma_bins] ** 2).sum(axis=0), minlength=12)
+        onset_magnitudes = onset_stft.push(samples)
+        if onset_magnitudes is not None:
+            compressed = np.log1p(100.0 * onset_magnitudes); stacked = compressed if previous is None else np.vstack([previous, compressed])
+            flux.append(np.maximum(np.diff(stacked, axis=0), 0.0).sum(axis=1)); previous = compressed[-1:]
+    fingerprint = landmark_hashes(np.concatenate(all_frames), np.concatenate(all_bins)) if all_frames else []
+    key, key_confidence = estimate_key(chroma)
+    mp3_check = verify_mp3(audio_path) if audio_path.lower().endswith(".mp3") else {"ok": True, "error": None}
+    return {"fingerprint": fingerprint, "estimated_bpm": estimate_tempo(np.concatenate(flux), SAMPLE_RATE / ONSET_HOP_SIZE) if flux else None,
+            "estimated_key": key, "key_confidence": key_confidence, "duration": round(total_samples / SAMPLE_RATE, 2),
+            "mp3_check_ok": mp3_check["ok"], "processing_error": mp3_check["error"]}
+
+
+# --- MP3 Integrity ---
+# Walks the MPEG frame headers without decoding, seeking from one 4-byte header to the next, so only the headers (plus
+# the ID3 tag sizes and a block per resync) are read. A download cut short ends in a frame that claims more bytes than
+# the file has, which is what a size check alone cannot see.
+_MP3_BITRATES = {  # (MPEG-1?, layer) -> kbps by bitrate index
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}  # by version bits
+MP3_MIN_FRAMES = 10
+MP3_MAX_RESYNC_BYTES = 4096   # Junk tolerated between frames before the stream counts as corrupt
+MP3_MAX_LEADING_BYTES = 65536 # Junk tolerated before the first frame before the file counts as having no audio
+
+
+def _parse_mp3_header(header):
+    # (frame_length, samples_per_frame, sample_rate) for a valid 4-byte frame header, else None.
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0: return None
+    version = (header[1] >> 3) & 3; layer = 4 - ((header[1] >> 1) & 3); bitrate_index = header[2] >> 4; rate_index = (header[2] >> 2) & 3
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3: return None  # Reserved values / free format
+    mpeg1 = version == 3; bitrate = _MP3_BITRATES[(mpeg1, layer)][bitrate_index] * 1000; sample_rate = _MP3_SAMPLE_RATES[version][rate_index]; padding = (header[2] >> 1) & 1
+    if layer == 1: return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate
+    samples = 1152 if (layer == 2 or mpeg1) else 576
+    return samples // 8 * bitrate // sample_rate + padding, samples, sample_rate
+
+
+def verify_mp3(path, min_frames=MP3_MIN_FRAMES):
+    # Returns {"ok", "frames", "duration", "error"}; ok means at least min_frames whole frames and no truncated last frame.
+    result = {"ok": False, "frames": 0, "duration": 0.0, "error": None}
+    try:
+        with open(path, 'rb', buffering=0) as f: return _walk_mp3_frames(f, os.fstat(f.fileno()).st_size, min_frames, result)
+    except OSError as e: result["error"] = f"unreadable: {e}"; return result
+
+
+def _read_at(f, position, size):
+    f.seek(position); return f.read(size)
+
+
+def _walk_mp3_frames(f, size, min_frames, result):
+    end = size; position = 0
+    if size >= 128 and _read_at(f, size - 128, 3) == b"TAG": end -= 128  # ID3v1 trailer
+    tag = _read_at(f, 0, 10)
+    if tag[:3] == b"ID3" and len(tag) >= 10:
+        position = 10 + ((tag[6] & 0x7F) << 21 | (tag[7] & 0x7F) << 14 | (tag[8] & 0x7F) << 7 | (tag[9] & 0x7F)) + (10 if tag[5] & 0x10 else 0)
+    skipped = 0
+    while position + 4 <= end:
+        header = _parse_mp3_header(_read_at(f, position, 4))
+        if header is None:
+            # Out of sync: look for the next frame header in one block read instead of one read per byte.
+            block = _read_at(f, position, min(end - position, MP3_MAX_RESYNC_BYTES + 3))
+            step = next((i for i in range(1, len(block) - 3) if block[i] == 0xFF and _parse_mp3_header(block[i:i + 4])), max(1, len(block) - 3))
+            position += step; skipped += step
+            if skipped > MP3_MAX_RESYNC_BYTES and result["frames"]: result["error"] = f"lost frame sync at byte {position}"; return result
+            if skipped > MP3_MAX_LEADING_BYTES: break  # No audio found near the start
+            continue
+        frame_length, samples, sample_rate = header
+        if position + frame_length > end: result["error"] = f"truncated: last frame needs {position + frame_length - end} more bytes"; result["duration"] = round(result["duration"], 2); return result
+        result["frames"] += 1; result["duration"] += samples / sample_rate; position += frame_length; skipped = 0
+    result["duration"] = round(result["duration"], 2)
+    if result["frames"] < min_frames: result["error"] = f"only {result['frames']} MPEG frames found"; return result
+    result["ok"] = True; return result
+
+
+def _get_process_pool(max_workers):
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None: _process_pool = ProcessPoolExecutor(max_workers=max_workers); logging.info(f"Audio analysis process pool started ({max_workers} workers).")
+        return _process_pool
+
+
+def run_in_pool(func, audio_path, max_workers=2, timeout=ANALYSIS_TIMEOUT_SECONDS):
+    # Submits func(audio_path) to the shared process pool; returns None (logged) on any failure or timeout.
+    global _process_pool
+    try: future = _get_process_pool(max_workers).submit(func, audio_path)
+    except Exception as e: logging.error(f"Failed submit {func.__name__} for {audio_path}: {e}", exc_info=True); _process_pool = None; return None
+    try: return future.result(timeout=timeout)
+    except FutureTimeoutError: logging.error(f"{func.__name__} timed out after {timeout}s for {audio_path}."); future.cancel(); return None
+    except Exception as e: logging.error(f"{func.__name__} failed for {audio_path}: {e}"); return None
+
+
+def analyze_audio_file(audio_path, max_workers=2):
+    # Orchestrator-side helper: compute_track_analysis() in the process pool, or None if local analysis isn't possible.
+    if not NUMPY_AVAILABLE: logging.warning("Local analysis skipped: NumPy not installed."); return None
+    if not ffmpeg_available(): logging.warning("Local analysis skipped: ffmpeg not found on PATH."); return None
+    if not audio_path or not os.path.exists(audio_path): logging.error(f"Local analysis skipped: '{audio_path}' not found."); return None
+    analysis = run_in_pool(compute_track_analysis, audio_path, max_workers=max_workers)
+    if analysis is not None: logging.info(f"Local analysis for {os.path.basename(audio_path)}: BPM {analysis['estimated_bpm']}, key {analysis['estimated_key']} ({analysis['key_confidence']}), {analysis['duration']}s, MP3 OK={analysis['mp3_check_ok']}, {len(analysis['fingerprint'])} landmark hashes.")
+    return analysis
+
+
+def shutdown_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is not None: _process_pool.shutdown(wait=False, cancel_futures=True); _process_pool = None
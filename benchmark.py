@@ -0,0 +1,522 @@
+# benchmark.py
+# Offline benchmark of the orchestrator's hot paths. Kaggle, Google Drive, Spotify and the Telegram bot are replaced by
+# local stand-ins with configurable latency and failure rates, plugged in where the code already looks them up
+# (utils._kaggle_api_class, the Drive service object and utils._build_drive_service, utils._spotify_client, the notifier's Bot).
+# Kernel output files are served by a local HTTP server so downloads go through the real streaming path. Everything
+# runs in a temporary working directory; no credentials or network access are needed.
+#
+#   python benchmark.py                                  # all benchmarks, default fake latencies
+#   python benchmark.py --only main_cycle,uniqueness --cycles 50
+#   python benchmark.py --backend kaggle:250:0.05 --json bench.json
+#   python benchmark.py --baseline bench.json            # exit code 1 if any p50 regressed beyond --max-regression
+
+import argparse
+import ast
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCHMARKS = ("import_time", "state", "uniqueness", "prompts", "spotify_refresh", "gdrive_cleanup", "main_cycle", "bot_handlers")
+DEFAULT_LATENCY_MS = {"kaggle": 120, "drive": 80, "spotify": 60, "telegram": 40}
+MP3_FRAME_HEADER = bytes([0xFF, 0xFB, 0x90, 0x00])   # MPEG-1 Layer III, 128 kbps, 44.1 kHz: 417-byte frames
+MP3_FRAME_LENGTH = 417
+
+
+# --- Fake Backends ---
+class FakeBackend:
+    # Latency/failure model shared by one service's stand-in: every call sleeps latency +- jitter and fails with
+    # probability failure_rate by raising whatever make_error(operation) returns. Calls inside batched() share the
+    # latency already paid by the batch request and only draw their failures.
+    def __init__(self, name, latency_ms, jitter_ms, failure_rate, seed, make_error):
+        self.name = name; self.latency = latency_ms / 1000; self.jitter = jitter_ms / 1000; self.failure_rate = failure_rate
+        self._rng = random.Random(seed); self._lock = threading.Lock(); self._make_error = make_error; self._local = threading.local()
+        self.calls = 0; self.failures = 0
+
+    def _draw(self):
+        with self._lock:
+            self.calls += 1; delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter)); fail = self._rng.random() < self.failure_rate
+            if fail: self.failures += 1
+        return delay, fail
+
+    def call(self, operation):
+        delay, fail = self._draw()
+        if not getattr(self._local, "batched", False): time.sleep(delay)
+        if fail: raise self._make_error(operation)
+
+    def batched(self, run):
+        self._local.batched = True
+        try: return run()
+        finally: self._local.batched = False
+
+    async def acall(self, operation):
+        delay, fail = self._draw(); await asyncio.sleep(delay)
+        if fail: raise self._make_error(operation)
+
+
+class FakeKaggleError(Exception):
+    def __init__(self, operation, status=503):
+        super().__init__(f"fake Kaggle failure during {operation}"); self.status = status
+
+
+def fake_mp3(frames=200):
+    return (MP3_FRAME_HEADER + bytes(MP3_FRAME_LENGTH - 4)) * frames
+
+
+def fake_result(prompt, rng):
+    # What the notebook writes next to each MP3; a random landmark-hash list keeps the tracks unique.
+    return {"prompt": prompt, "estimated_bpm": rng.randint(70, 160), "estimated_key": rng.choice(["C", "Am", "G", "Em", "F#m"]), "duration": 5.2,
+            "mp3_check_ok": True, "processing_error": None, "fingerprint": [rng.getrandbits(32) for _ in range(400)], "fingerprint_error": None}
+
+
+class FakeKaggleWorld:
+    # Kernels of every fake account. A push starts a run that reports queued -> running -> complete (or error) over
+    # run_seconds and writes its output files into output_dir/<owner>/<kernel>/, replacing the previous run's outputs.
+    def __init__(self, backend, output_dir, run_seconds, run_failure_rate, seed):
+        self.backend = backend; self.output_dir = output_dir; self.run_seconds = run_seconds; self.run_failure_rate = run_failure_rate
+        self.base_url = None; self.kernels = {}; self.datasets = {}; self.pushes = 0; self._lock = threading.Lock(); self._rng = random.Random(seed)
+
+    def start_run(self, slug, params):
+        batch = params.get("batch") if isinstance(params, dict) else None
+        entries = batch if batch else [params]
+        with self._lock:
+            self.pushes += 1; version = self.kernels.get(slug, {}).get("version", 0) + 1; failed = self._rng.random() < self.run_failure_rate
+            self.kernels[slug] = {"version": version, "started": time.monotonic(), "failed": failed}
+            rng = random.Random(self._rng.random())
+        kernel_dir = os.path.join(self.output_dir, *slug.split('/', 1)); shutil.rmtree(kernel_dir, ignore_errors=True); os.makedirs(kernel_dir)
+        if failed: return version
+        for n, entry in enumerate(entries):
+            mp3_name, json_name = (f"output_{n}.mp3", f"result_{n}.json") if batch else ("output.mp3", "result.json")
+            with open(os.path.join(kernel_dir, mp3_name), 'wb') as f: f.write(fake_mp3())
+            with open(os.path.join(kernel_dir, json_name), 'w', encoding='utf-8') as f: json.dump(fake_result(entry.get("prompt"), rng), f)
+        return version
+
+    def status(self, slug):
+        with self._lock: kernel = self.kernels.get(slug)
+        if kernel is None: return "complete"
+        elapsed = time.monotonic() - kernel["started"]
+        if elapsed < self.run_seconds * 0.1: return "queued"
+        if elapsed < self.run_seconds: return "running"
+        return "error" if kernel["failed"] else "complete"
+
+    def output_files(self, slug):
+        kernel_dir = os.path.join(self.output_dir, *slug.split('/', 1))
+        names = sorted(os.listdir(kernel_dir)) if os.path.isdir(kernel_dir) else []
+        return [{"fileName": name, "url": f"{self.base_url}/{slug}/{name}"} for name in names]
+
+
+def make_fake_kaggle_api(world):
+    # utils instantiates _kaggle_api_class() once per account and calls _load_config(); every instance shares `world`.
+    class FakeKaggleApi:
+        def _load_config(self, config): self.username = config["username"]
+
+        def kernels_list(self, mine=True, page_size=20):
+            world.backend.call("kernels_list"); return []
+
+        def kernels_pull(self, kernel, path=None, metadata=False, quiet=True):
+            world.backend.call("kernels_pull"); os.makedirs(path, exist_ok=True)
+            notebook = {"cells": [{"cell_type": "code", "execution_count": None, "metadata": {}, "outputs": [], "source": ["import json, os\n", "print(MUSICAI_PARAMS)\n"]}], "metadata": {}, "nbformat": 4, "nbformat_minor": 5}
+            with open(os.path.join(path, "notebook.ipynb"), 'w', encoding='utf-8') as f: json.dump(notebook, f)
+            with open(os.path.join(path, "kernel-metadata.json"), 'w', encoding='utf-8') as f:
+                json.dump({"id": kernel, "code_file": "notebook.ipynb", "language": "python", "kernel_type": "notebook", "dataset_sources": [], "competition_sources": [], "kernel_sources": []}, f)
+
+        def dataset_create_version(self, folder, version_notes, quiet=True, dir_mode="skip"):
+            # The params dataset of the default trigger path: the next push that lists it as a source runs with these params.
+            world.backend.call("dataset_create_version")
+            with open(os.path.join(folder, "dataset-metadata.json"), 'r', encoding='utf-8') as f: dataset_id = json.load(f)["id"]
+            with open(os.path.join(folder, "params.json"), 'r', encoding='utf-8') as f: world.datasets[dataset_id] = json.load(f)
+            return {"status": "ok", "error": None}
+
+        dataset_create_new = dataset_create_version
+
+        def kernels_push(self, folder):
+            world.backend.call("kernels_push")
+            with open(os.path.join(folder, "kernel-metadata.json"), 'r', encoding='utf-8') as f: metadata = json.load(f)
+            if "code_file" in metadata:  # KAGGLE_PARAMS_IN_SOURCE: params are embedded in the pushed source
+                with open(os.path.join(folder, metadata["code_file"]), 'r', encoding='utf-8') as f: source = f.read()
+                if metadata["code_file"].endswith(".ipynb"): source = "".join("".join(cell.get("source", [])) for cell in json.loads(source)["cells"])
+                match = re.search(r"^MUSICAI_PARAMS = _musicai_json\.loads\((.*)\)$", source, re.MULTILINE)
+                params = json.loads(ast.literal_eval(match.group(1))) if match else {}
+            else: params = next((world.datasets[slug] for slug in metadata.get("dataset_sources", []) if slug in world.datasets), {})
+            version = world.start_run(metadata["id"], params)
+            return {"versionNumber": version, "url": f"https://www.kaggle.com/code/{metadata['id']}", "error": None}
+
+        def kernels_status(self, kernel):
+            world.backend.call("kernels_status"); return {"status": world.status(kernel), "failureMessage": None}
+
+        def kernel_output_with_http_info(self, owner_slug, kernel_slug):
+            world.backend.call("kernel_output"); return {"files": world.output_files(f"{owner_slug}/{kernel_slug}")}
+
+        def process_response(self, response): return response
+
+    return FakeKaggleApi
+
+
+def make_output_server(world):
+    # Serves world.output_dir over HTTP with the Kaggle backend's latency; failures answer 503.
+    class OutputHandler(SimpleHTTPRequestHandler):
+        def do_GET(self):
+            try: world.backend.call("output_download")
+            except FakeKaggleError: self.send_error(503); return
+            super().do_GET()
+
+        def log_message(self, format, *args): pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(OutputHandler, directory=world.output_dir)); server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="bench-kaggle-output", daemon=True).start()
+    world.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    return server
+
+
+class _FakeRequest:
+    def __init__(self, func): self._func = func
+    def execute(self, http=None, num_retries=0): return self._func()
+
+
+class _FakeBatch:
+    # One HTTP round trip for the whole batch, like Drive's batch endpoint; each part still fails on its own.
+    def __init__(self, backend, callback): self._backend = backend; self._callback = callback; self._requests = []
+    def add(self, request, request_id=None): self._requests.append((request_id, request))
+
+    def execute(self, http=None):
+        self._backend.call("batch"); self._backend.batched(self._run_parts)
+
+    def _run_parts(self):
+        for request_id, request in self._requests:
+            try: response = request.execute()
+            except Exception as e: self._callback(request_id, None, e)
+            else: self._callback(request_id, response, None)
+
+
+class FakeDrive:
+    # The googleapiclient surface this repo uses: files() create/list/delete, changes() feed, about(), batch requests.
+    # `_http.credentials` lets utils build per-thread services, which utils._build_drive_service hands back as this same object.
+    def __init__(self, backend, http_error):
+        self.backend = backend; self._http_error = http_error; self._http = SimpleNamespace(credentials=SimpleNamespace(valid=True))
+        self.files_by_id = {}; self.changes_log = []; self._next_id = 0; self._lock = threading.Lock()
+
+    def add_file(self, name, folder_id, created_time):
+        with self._lock:
+            self._next_id += 1; file = {"id": f"fake{self._next_id}", "name": name, "createdTime": created_time.strftime('%Y-%m-%dT%H:%M:%S.000Z'), "parents": [folder_id], "trashed": False}
+            self.files_by_id[file["id"]] = file; self.changes_log.append({"fileId": file["id"], "removed": False, "file": dict(file)})
+            return file
+
+    def seed(self, folder_id, count, max_age_days, rng):
+        now = datetime.now(timezone.utc)
+        for i in range(count): self.add_file(f"seed_{i}.mp3", folder_id, now - timedelta(days=rng.uniform(0, max_age_days * 2)))
+
+    def files(self): return _FakeFiles(self)
+    def changes(self): return _FakeChanges(self)
+    def about(self): return SimpleNamespace(get=lambda fields=None: _FakeRequest(lambda: (self.backend.call("about"), {"storageQuota": {}, "user": {"displayName": "bench"}})[1]))
+    def new_batch_http_request(self, callback=None): return _FakeBatch(self.backend, callback)
+
+
+class _FakeFiles:
+    def __init__(self, drive): self.drive = drive
+
+    def create(self, body=None, media_body=None, fields=None):
+        def run():
+            self.drive.backend.call("files.create"); created = self.drive.add_file(body.get("name"), (body.get("parents") or [None])[0], datetime.now(timezone.utc))
+            return {"id": created["id"]}
+        return _FakeRequest(run)
+
+    def list(self, q=None, spaces=None, fields=None, pageSize=100, pageToken=None, orderBy=None):
+        def run():
+            self.drive.backend.call("files.list"); folder_id = re.search(r"'([^']+)' in parents", q or "").group(1) if q and "in parents" in q else None
+            with self.drive._lock: files = [f for f in self.drive.files_by_id.values() if not f["trashed"] and (folder_id is None or folder_id in f["parents"])]
+            files.sort(key=lambda f: f["createdTime"]); start = int(pageToken or 0); page = files[start:start + pageSize]
+            response = {"files": [{"id": f["id"], "name": f["name"], "createdTime": f["createdTime"]} for f in page]}
+            if start + pageSize < len(files): response["nextPageToken"] = str(start + pageSize)
+            return response
+        return _FakeRequest(run)
+
+    def delete(self, fileId=None):
+        def run():
+            self.drive.backend.call("files.delete")
+            with self.drive._lock:
+                if self.drive.files_by_id.pop(fileId, None) is None: raise self.drive._http_error(404, "File not found")
+                self.drive.changes_log.append({"fileId": fileId, "removed": True})
+            return ""
+        return _FakeRequest(run)
+
+
+class _FakeChanges:
+    def __init__(self, drive): self.drive = drive
+
+    def getStartPageToken(self):
+        def run():
+            self.drive.backend.call("changes.getStartPageToken")
+            with self.drive._lock: return {"startPageToken": str(len(self.drive.changes_log))}
+        return _FakeRequest(run)
+
+    def list(self, pageToken=None, spaces=None, fields=None, pageSize=1000):
+        def run():
+            self.drive.backend.call("changes.list"); start = int(pageToken)
+            with self.drive._lock: changes = self.drive.changes_log[start:start + pageSize]; end = len(self.drive.changes_log)
+            response = {"changes": changes}
+            if start + pageSize < end: response["nextPageToken"] = str(start + pageSize)
+            else: response["newStartPageToken"] = str(end)
+            return response
+        return _FakeRequest(run)
+
+
+class FakeSpotify:
+    GENRES = ["lofi", "synthwave", "ambient", "house", "techno", "jazz", "trap", "indie pop", "drum and bass", "chillhop"]
+
+    def __init__(self, backend, seed): self.backend = backend; self._rng = random.Random(seed)
+
+    def categories(self, country=None, limit=20):
+        self.backend.call("categories"); return {"categories": {"items": [{"name": name.title()} for name in self.GENRES[:limit]]}}
+
+    def new_releases(self, limit=20):
+        self.backend.call("new_releases")
+        return {"albums": {"items": [{"artists": [{"id": f"artist{self._rng.randint(0, 500)}"}]} for _ in range(limit)]}}
+
+    def artists(self, artist_ids):
+        self.backend.call("artists"); return {"artists": [{"id": a, "genres": self._rng.sample(self.GENRES, 2)} for a in artist_ids]}
+
+
+class FakeBot:
+    def __init__(self, backend): self.backend = backend; self.sent = 0
+    async def send_message(self, chat_id=None, text=None, parse_mode=None, reply_markup=None):
+        await self.backend.acall("send_message"); self.sent += 1
+
+    async def get_me(self):
+        await self.backend.acall("get_me"); return SimpleNamespace(id=0, username="bench_bot")
+
+
+class FakeMessage:
+    def __init__(self, backend): self.backend = backend; self.replies = []
+    async def reply_text(self, text, parse_mode=None, reply_markup=None):
+        await self.backend.acall("reply_text"); self.replies.append(text)
+
+
+# --- Measurement ---
+def percentile(sorted_values, q):
+    if not sorted_values: return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values) + 0.5)) - 1))]
+
+
+def measure(name, func, iterations, results):
+    durations = []; errors = 0; started = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        try: ok = func()
+        except Exception as e: logging.warning(f"Benchmark {name}: {type(e).__name__}: {e}"); ok = False
+        durations.append(time.perf_counter() - t0); errors += ok is False
+    total = time.perf_counter() - started; durations.sort()
+    results.append({"name": name, "n": iterations, "errors": errors, "ops_per_sec": iterations / total if total > 0 else None,
+                    "mean_ms": sum(durations) / len(durations) * 1000 if durations else None, "p50_ms": (percentile(durations, 0.5) or 0) * 1000, "p99_ms": (percentile(durations, 0.99) or 0) * 1000})
+    return results[-1]
+
+
+def format_results(results):
+    width = max([len(r["name"]) for r in results] + [9])
+    lines = [f"{'benchmark':<{width}} {'n':>6} {'err':>4} {'ops/s':>9} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9}"]
+    for r in results: lines.append(f"{r['name']:<{width}} {r['n']:>6} {r['errors']:>4} {r['ops_per_sec']:>9.1f} {r['mean_ms']:>9.2f} {r['p50_ms']:>9.2f} {r['p99_ms']:>9.2f}")
+    return "\n".join(lines)
+
+
+def compare_to_baseline(results, baseline_path, max_regression):
+    # Returns the names whose p50 grew by more than max_regression (a fraction) against the saved run.
+    with open(baseline_path, 'r', encoding='utf-8') as f: baseline = {r["name"]: r for r in json.load(f)["results"]}
+    regressions = []
+    for r in results:
+        before = baseline.get(r["name"])
+        if before and before["p50_ms"] > 0 and r["p50_ms"] > before["p50_ms"] * (1 + max_regression):
+            regressions.append(r["name"]); print(f"REGRESSION {r['name']}: p50 {before['p50_ms']:.2f} ms -> {r['p50_ms']:.2f} ms")
+    return regressions
+
+
+# --- Harness ---
+class Harness:
+    def __init__(self, args):
+        self.args = args; self.rng = random.Random(args.seed); self.work_dir = tempfile.mkdtemp(prefix="musicai-bench-")
+        self.backends = {}; self.loop = None; self.loop_thread = None; self.output_server = None
+
+    def backend(self, name, make_error):
+        latency, failure_rate = self.args.backend_overrides.get(name, (DEFAULT_LATENCY_MS[name] * self.args.latency_scale, self.args.failure_rate))
+        self.backends[name] = FakeBackend(name, latency, self.args.jitter_ms, failure_rate, self.rng.random(), make_error)
+        return self.backends[name]
+
+    def setup(self):
+        # Secrets main.py insists on at import time; none of them reach a real service.
+        os.environ.update({"GOOGLE_CREDS_JSON": json.dumps({"installed": {"client_id": "bench", "client_secret": "bench"}}), "TELEGRAM_BOT_TOKEN": "0:bench", "TELEGRAM_CHAT_ID": "1",
+                           "SPOTIPY_CLIENT_ID": "bench", "SPOTIPY_CLIENT_SECRET": "bench"})
+        for i in range(1, 5): os.environ[f"KAGGLE_JSON_{i}"] = json.dumps({"username": f"bench{i}", "key": "bench"})
+        sys.path.insert(0, REPO_DIR); os.chdir(self.work_dir)
+        import httplib2
+        import requests
+        import telegram
+        from googleapiclient.errors import HttpError
+        import main, utils
+        logging.getLogger().setLevel(getattr(logging, self.args.log_level))
+        self.main = main; self.utils = utils
+        main.DRY_RUN = utils.DRY_RUN = False  # Every call below lands on a fake backend; DRY_RUN would skip the triggers, uploads and deletes being measured
+        if not self.args.local_analysis: main.LOCAL_ANALYSIS_ENABLED = False; main.LOCAL_FINGERPRINT_ENABLED = False  # Use the fingerprint in result.json
+        http_error = lambda status, message: HttpError(httplib2.Response({"status": status}), message.encode())
+        self.world = FakeKaggleWorld(self.backend("kaggle", FakeKaggleError), os.path.join(self.work_dir, "kaggle_outputs"), self.args.run_seconds, self.args.run_failure_rate, self.rng.random())
+        self.output_server = make_output_server(self.world); utils._kaggle_api_class = make_fake_kaggle_api(self.world)
+        self.drive = FakeDrive(self.backend("drive", lambda op: http_error(429, f"fake rateLimitExceeded during {op}")), http_error)
+        utils._build_drive_service = lambda **kwargs: self.drive
+        utils._spotify_client = FakeSpotify(self.backend("spotify", lambda op: requests.exceptions.ConnectionError(f"fake Spotify failure during {op}")), self.rng.random())
+        self.loop = asyncio.new_event_loop(); self.loop_thread = threading.Thread(target=self.loop.run_forever, name="bench-bot-loop", daemon=True); self.loop_thread.start()
+        self.telegram = self.backend("telegram", lambda op: telegram.error.NetworkError(f"fake Telegram failure during {op}")); self.bot = FakeBot(self.telegram)
+        self.loop.call_soon_threadsafe(utils.start_telegram_notifier, self.bot, self.loop)
+
+    def teardown(self):
+        main = getattr(self, "main", None)
+        if main is not None:
+            main.stop_track_pipeline(); main.shutdown_audio_pool()
+            asyncio.run_coroutine_threadsafe(self.utils.stop_telegram_notifier(), self.loop).result(timeout=30); main.close_state_stores()
+        if self.loop is not None: self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.output_server is not None: self.output_server.shutdown()
+        os.chdir(REPO_DIR)
+        if not self.args.keep_work_dir: shutil.rmtree(self.work_dir, ignore_errors=True)
+        else: print(f"Work directory kept: {self.work_dir}")
+
+    # --- Benchmarks ---
+    def bench_import_time(self, results):
+        # Cold start of a fresh interpreter up to a usable module: what every process start and /restart pays.
+        def import_module(name):
+            code = f"import sys; sys.path.insert(0, {REPO_DIR!r}); import {name}"
+            return subprocess.run([sys.executable, "-c", code], cwd=self.work_dir, capture_output=True).returncode == 0
+        iterations = max(1, self.args.iterations // 20)
+        for name in ("defaults", "utils", "main"): measure(f"import {name} (new process)", partial(import_module, name), iterations, results)
+        # Heaviest top-level imports of main, from the interpreter's own -X importtime report (cumulative microseconds).
+        report = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import sys; sys.path.insert(0, {REPO_DIR!r}); import main"], cwd=self.work_dir, capture_output=True, text=True).stderr
+        timings = []
+        for line in report.splitlines():
+            parts = line.split("|")
+            if len(parts) == 3 and parts[1].strip().isdigit() and not parts[2].startswith("  "): timings.append((int(parts[1]), parts[2].strip()))
+        print("Slowest top-level imports of main: " + ", ".join(f"{name} {us / 1000:.0f} ms" for us, name in sorted(timings, reverse=True)[:8]))
+
+    def bench_state(self, results):
+        state = self.main.load_state(self.main.STATE_FILE_PATH); state["kaggle_run_history"] = {str(i): [{"seconds": 700.0, "status": "complete", "batch_size": 4, "tracks": 4, "finished": None}] * 20 for i in range(4)}
+        measure("save_state", lambda: self.main.save_state(state, self.main.STATE_FILE_PATH), self.args.iterations, results)
+        measure("load_state", lambda: bool(self.main.load_state(self.main.STATE_FILE_PATH)), self.args.iterations, results)
+
+    def bench_uniqueness(self, results):
+        # Preloaded in bulk (python benchmark.py --only uniqueness --fingerprints 100000 for the large-catalog case). New
+        # tracks are unrelated to the catalog; duplicates keep 80% of a stored track's hashes (Jaccard ~0.67). A wrong verdict counts as an error.
+        index = self.utils.get_fingerprint_index(); stored = []
+        for start in range(0, self.args.fingerprints, 5000):
+            batch = [[self.rng.getrandbits(32) for _ in range(400)] for _ in range(min(5000, self.args.fingerprints - start))]
+            index.add_many((fp, f"seed {start + n}", None) for n, fp in enumerate(batch)); stored += self.rng.sample(batch, min(len(batch), 50))
+        probes = [[self.rng.getrandbits(32) for _ in range(400)] for _ in range(self.args.iterations)]; probe = iter(probes)
+        duplicates = [self.rng.sample(fp, 320) + [self.rng.getrandbits(32) for _ in range(80)] for fp in self.rng.choices(stored, k=self.args.iterations)]; duplicate = iter(duplicates)
+        threshold = self.main.LANDMARK_SIMILARITY_THRESHOLD
+        measure(f"is_unique_enough ({self.args.fingerprints} fps)", lambda: self.utils.is_unique_enough(next(probe), threshold), self.args.iterations, results)
+        measure(f"is_unique_enough duplicate ({self.args.fingerprints} fps)", lambda: not self.utils.is_unique_enough(next(duplicate), threshold), self.args.iterations, results)
+
+    def bench_prompts(self, results):
+        measure(f"prompt_batch x{self.main.KAGGLE_BATCH_SIZE}", lambda: bool(self.main._prompt_queue.take(self.main.KAGGLE_BATCH_SIZE)), self.args.iterations, results)
+
+    def bench_spotify_refresh(self, results):
+        while self.utils._spotify_refresh_lock.locked(): time.sleep(0.05)  # A refresh started by prompt generation would make every call a no-op
+        measure("spotify_refresh", self.utils.refresh_spotify_trend_cache, max(1, self.args.iterations // 10), results)
+
+    def bench_gdrive_cleanup(self, results):
+        # Each round adds a burst of new uploads (half of them already expired), then runs the incremental cleanup.
+        folder_id = self.main.GDRIVE_BACKUP_FOLDER_ID; state = self.main.load_state(self.main.STATE_FILE_PATH)
+        self.drive.seed(folder_id, self.args.drive_files, self.main.MAX_DRIVE_FILE_AGE_DAYS, self.rng)
+        def round_():
+            self.drive.seed(folder_id, self.args.drive_burst, self.main.MAX_DRIVE_FILE_AGE_DAYS, self.rng)
+            return self.main.perform_gdrive_cleanup(state, self.drive)
+        measure(f"gdrive_cleanup (+{self.args.drive_burst}/round)", round_, max(1, self.args.iterations // 10), results)
+
+    def bench_main_cycle(self, results):
+        # Status polls are made due before every cycle (a fake run finishes in run_seconds, not the learned run time),
+        # so each cycle exercises trigger, poll, download and pipeline handoff instead of mostly sleeping.
+        main = self.main; state = main.load_state(main.STATE_FILE_PATH); state["status"] = "running"; main.save_state(state, main.STATE_FILE_PATH)
+        if main.PIPELINE_ENABLED: main.start_track_pipeline(self.drive)
+        def cycle():
+            state = main.load_state(main.STATE_FILE_PATH)
+            for job in (state.get("slots") or []) + [state]: job["next_status_poll_time"] = None
+            if state.get("status") != "running": state["status"] = "running"; state["intervention_pending_since"] = None
+            main.save_state(state, main.STATE_FILE_PATH)
+            main.run_main_cycle(self.drive); time.sleep(self.args.cycle_gap)
+            return main.load_state(main.STATE_FILE_PATH).get("status") == "running"
+        measure("run_main_cycle", cycle, self.args.cycles, results)
+        if main._pipeline is not None:
+            deadline = time.monotonic() + 60
+            while any(n for name, n in main._pipeline.queues.sizes().items() if name != "results") and time.monotonic() < deadline: time.sleep(0.2)
+        final = main.load_state(main.STATE_FILE_PATH); main.apply_pipeline_results(final)
+        print(f"main_cycle: {self.world.pushes} Kaggle runs, {final.get('total_tracks_generated', 0)} tracks uploaded, {len(self.drive.files_by_id)} files on fake Drive.")
+
+    def bench_bot_handlers(self, results):
+        main = self.main
+        def run_handler(handler, args=()):
+            update = SimpleNamespace(effective_user=SimpleNamespace(id=1), effective_chat=SimpleNamespace(id=1), message=FakeMessage(self.telegram), callback_query=None)
+            context = SimpleNamespace(args=list(args), bot=self.bot)
+            asyncio.run_coroutine_threadsafe(handler(update, context), self.loop).result(timeout=60)
+            return bool(update.message.replies)
+        for name, handler, args in (("/status", main.status_command, ()), ("/usage", main.usage_command, ()), ("/logs", main.logs_command, ()),
+                                    ("/errors", main.errors_command, ()), ("/errors 24", main.errors_command, ("24",)), ("/metrics", main.metrics_command, ())):
+            measure(f"bot {name}", partial(run_handler, handler, args), max(1, self.args.iterations // 5), results)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline orchestrator benchmark with fake Kaggle/Drive/Spotify/Telegram backends.")
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help=f"Comma-separated subset of: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--iterations", type=int, default=200, help="Iterations for the micro benchmarks (cleanup/Spotify/bot use a fraction)")
+    parser.add_argument("--cycles", type=int, default=30, help="run_main_cycle iterations")
+    parser.add_argument("--cycle-gap", type=float, default=0.05, help="Seconds between cycles (lets fake runs progress)")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Multiplier for the default per-backend latencies")
+    parser.add_argument("--jitter-ms", type=float, default=20.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Probability that any fake API call fails")
+    parser.add_argument("--backend", action="append", default=[], metavar="NAME:LATENCY_MS:FAILURE_RATE", help=f"Per-backend override; NAME in {', '.join(DEFAULT_LATENCY_MS)}")
+    parser.add_argument("--run-seconds", type=float, default=0.5, help="Wall time of a fake Kaggle run")
+    parser.add_argument("--run-failure-rate", type=float, default=0.0, help="Probability that a fake Kaggle run ends in 'error'")
+    parser.add_argument("--fingerprints", type=int, default=2000, help="Fingerprints preloaded into the uniqueness index")
+    parser.add_argument("--drive-files", type=int, default=500, help="Files preloaded into the fake Drive folder")
+    parser.add_argument("--drive-burst", type=int, default=40, help="Files added before each cleanup round")
+    parser.add_argument("--local-analysis", action="store_true", help="Run the local MP3 analysis (needs numpy + ffmpeg) instead of trusting result.json")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--log-level", default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--json", help="Write the results to this file (usable as a later --baseline)")
+    parser.add_argument("--baseline", help="Results file of an earlier run to compare p50 latencies against")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="Allowed p50 growth against --baseline (0.25 = 25%%)")
+    parser.add_argument("--keep-work-dir", action="store_true")
+    args = parser.parse_args(argv)
+    args.backend_overrides = {}
+    for spec in args.backend:
+        name, latency, failure_rate = spec.split(":")
+        if name not in DEFAULT_LATENCY_MS: parser.error(f"Unknown backend '{name}'.")
+        args.backend_overrides[name] = (float(latency), float(failure_rate))
+    args.selected = [name.strip() for name in args.only.split(",") if name.strip()]
+    unknown = [name for name in args.selected if name not in BENCHMARKS]
+    if unknown: parser.error(f"Unknown benchmarks: {unknown}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv); harness = Harness(args); results = []
+    try:
+        harness.setup()
+        for name in BENCHMARKS:
+            if name in args.selected: print(f"Running {name}..."); getattr(harness, f"bench_{name}")(results)
+    finally: harness.teardown()
+    print(format_results(results))
+    print("Fake backend calls: " + ", ".join(f"{b.name} {b.calls} ({b.failures} failed)" for b in harness.backends.values()))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f: json.dump({"created": datetime.now(timezone.utc).isoformat(), "args": {k: v for k, v in vars(args).items() if k != "backend_overrides"}, "results": results}, f, indent=1)
+    if args.baseline and compare_to_baseline(results, args.baseline, args.max_regression): return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
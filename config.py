@@ -11,22 +11,27 @@ PROMPT_GENRES = [ "pop", "rock", "jazz", "classical", "electronic", "hip hop", "
 PROMPT_INSTRUMENTS = [ "piano", "guitar", "acoustic guitar", "electric guitar", "bass guitar", "drums", "synthesizer", "synth pads", "arp synth", "lead synth", "violin", "cello", "strings section", "flute", "saxophone", "trumpet", "brass section", "organ", "electric piano", "vibraphone", "marimba", "bells", "choir", "vocals (instrumental focus)", "beat", "percussion", "tabla", "sitar", ]
 PROMPT_MOODS = [ "upbeat", "chill", "relaxing", "energetic", "driving", "melancholic", "sad", "happy", "ethereal", "atmospheric", "dark", "mysterious", "epic", "intense", "calm", "peaceful", "groovy", "funky", "dreamy", "nostalgic", "romantic", "suspenseful", "minimalist", "experimental", "aggressive", "smooth", ]
 PROMPT_TEMPLATES = [ "{genre} track with {instrument}", "{mood} {genre} featuring {instrument}", "A {mood} piece based on {instrument} in a {genre} style", "{instrument} solo over a {genre} beat", "Atmospheric {genre} with {mood} {instrument}", "{genre}", "{instrument}", "{mood} {genre}", "{mood} {instrument}", ]
+PROMPT_QUEUE_SIZE = 32 # Ready prompt+seed entries kept pre-generated for the trigger step (refilled in the background)
 
 # --- Uniqueness Check Configuration ---
 UNIQUENESS_CHECK_ENABLED = True
-UNIQUENESS_FINGERPRINT_COUNT = 50
-UNIQUENESS_SIMILARITY_THRESHOLD = 0.90
+UNIQUENESS_SIMILARITY_THRESHOLD = 0.90 # SequenceMatcher ratio, for the notebook's string fingerprints
+LANDMARK_SIMILARITY_THRESHOLD = 0.40   # Hash-set Jaccard, for local landmark fingerprints (re-encodes/trims of one track score ~0.45+, unrelated ones <0.3)
+LOCAL_FINGERPRINT_ENABLED = True # Fingerprint the downloaded MP3 locally (needs ffmpeg + numpy); the notebook's fingerprint is only a fallback
+LOCAL_ANALYSIS_ENABLED = True    # Estimate BPM/key/duration and check the MP3 locally (same decode as the fingerprint) instead of trusting result.json
+AUDIO_ANALYSIS_WORKERS = 2       # Processes in the local audio analysis pool
 
 # --- Kaggle Configuration ---
 NUM_KAGGLE_ACCOUNTS = 4
-ESTIMATED_KAGGLE_RUN_HOURS = 0.2 # <<< IMPORTANT: Adjust based on observed notebook run time! (e.g., 15 mins = 0.25)
+ESTIMATED_KAGGLE_RUN_HOURS = 0.2 # Run time assumed until runs have been measured (then the measured per-account median is used)
 KAGGLE_WEEKLY_GPU_QUOTA = 30.0   # <<< IMPORTANT: Verify current Kaggle quota!
 KAGGLE_USAGE_BUFFER = 0.90       # Safety margin (use 90% of quota)
-SCHEDULED_ROTATION_TRACK_COUNT = 25 # Optional: Rotate accounts every N successful tracks per account (approx)
 
 # --- Google Drive Cleanup Configuration ---
 MAX_DRIVE_FILES = 50
 MAX_DRIVE_FILE_AGE_DAYS = 7
+GDRIVE_BATCH_DELETE_SIZE = 50   # Deletes per Drive batch HTTP request (API maximum is 100)
+GDRIVE_CLEANUP_WORKERS = 3      # Batch requests in flight at once during cleanup
 
 # --- Style Profile Configuration ---
 STYLE_PROFILE_RESET_TRACK_COUNT = 100 # Reset profile counts every N successful tracks
@@ -36,4 +41,46 @@ STYLE_PROFILE_MAX_HISTORY = 20        # Max number of recent BPMs/Keys to store
 INTERVENTION_TIMEOUT_MINUTES = 15 # Minutes to wait for user action before auto-recovery
 
 # --- Other Configurations ---
-HEALTH_CHECK_INTERVAL_MINUTES = 30
\ No newline at end of file
+HEALTH_CHECK_INTERVAL_MINUTES = 30
+# --- Multi-Slot Configuration ---
+KAGGLE_MULTI_SLOT_ENABLED = True # If True, keep one in-flight Kaggle run per account instead of rotating a single job across accounts
+SLOT_WORK_DIR = "slot_work"      # Each slot downloads into its own subfolder (slot_work/slot_<index>) so outputs never collide
+
+# --- Kaggle Status Polling Configuration ---
+KAGGLE_POLL_MIN_SECONDS = 20     # Fastest status poll interval, used around the expected finish of a run
+KAGGLE_POLL_MAX_SECONDS = 600    # Slowest status poll interval, used early in a run
+KAGGLE_RUN_HISTORY_SIZE = 20     # Recent measured runs kept per account for the expected run time and quota forecast
+KAGGLE_STATUS_MAX_FAILURES = 4   # Consecutive failed status polls before asking for intervention
+KAGGLE_DOWNLOAD_MAX_FAILURES = 2 # Failed download rounds (each with its own quick retries) before a run's output is given up
+
+# --- Kaggle Batch Configuration ---
+KAGGLE_BATCH_SIZE = 1                # Prompts per notebook launch; boot + model load are paid once per batch. >1 needs a notebook that reads {"batch": [...]} and writes output_{n}.mp3/result_{n}.json
+ESTIMATED_KAGGLE_TRACK_HOURS = 0.03  # Extra GPU hours per additional track in a batch run (on top of ESTIMATED_KAGGLE_RUN_HOURS)
+KAGGLE_PARAMS_IN_SOURCE = False      # Embed run params in the pushed notebook source (one kernels_push per run) instead of a params dataset version per run. Needs a notebook that reads MUSICAI_PARAMS_PATH
+
+# --- Track Pipeline Configuration ---
+PIPELINE_ENABLED = True          # Analysis, upload and profile updates run on their own workers; a slot is re-triggered as soon as its outputs are downloaded
+PIPELINE_DIR = "pipeline_work"   # Downloaded tracks waiting in the pipeline, plus the persisted stage queues
+PIPELINE_ANALYZE_QUEUE_SIZE = 8  # Tracks waiting for analysis; a full queue holds back new Kaggle runs (bounds disk use)
+PIPELINE_UPLOAD_QUEUE_SIZE = 8
+PIPELINE_ANALYZE_WORKERS = 2     # Tracks analyzed at once (each runs in the audio analysis process pool)
+PIPELINE_UPLOAD_WORKERS = 2
+PIPELINE_UPLOAD_MAX_ATTEMPTS = 5 # Upload attempts (each with its own short retries) before a track is left on disk for manual upload
+
+# --- Metrics Configuration ---
+METRICS_ENABLED = True
+METRICS_FILE_PATH = "metrics.json"      # Cumulative histograms/counters plus hourly rollups, reloaded on start
+METRICS_HTTP_HOST = "127.0.0.1"         # Prometheus text endpoint; local only unless changed
+METRICS_HTTP_PORT = 9108                # 0 disables the endpoint (the /metrics command still works)
+METRICS_SAVE_INTERVAL_SECONDS = 300
+
+# --- Logging Configuration ---
+LOG_QUEUE_ENABLED = True                # Handlers run on one listener thread; a logging call only enqueues the record
+LOG_JSON_ENABLED = False                # Also write compact JSON lines (with step/account/run_id fields) for log tooling
+LOG_JSON_FILE_PATH = "system_log.jsonl"
+LOG_SEGMENT_RETENTION_DAYS = 30         # Shipped log segments are exempt from the MAX_DRIVE_FILES cleanup and kept this long (oldest go first, so no gaps)
+
+# --- State Backup Configuration ---
+STATE_SNAPSHOT_DIR = "state_snapshots"  # Snapshot manifest plus the last full snapshot (the base for deltas)
+STATE_SNAPSHOT_FULL_EVERY = 24          # Delta snapshots between full ones; bounds what a restore needs from Drive
+STATE_SNAPSHOT_RETENTION_DAYS = 30      # Snapshots are exempt from the MAX_DRIVE_FILES cleanup; any point this far back stays restorable
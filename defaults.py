@@ -0,0 +1,8 @@
+# defaults.py
+# Default state documents shared by main.py and utils.py. Plain data built from config only: importing this module has
+# no side effects (no secrets, logging handlers or client libraries), so utils never has to import main.
+
+from config import NUM_KAGGLE_ACCOUNTS
+
+JOB_SLOT_DEFAULTS = { "current_step": "idle", "current_prompt": None, "last_kaggle_trigger_time": None, "last_downloaded_mp3": None, "last_downloaded_json": None, "retry_count": 0, "last_error": None, "next_status_poll_time": None, "next_trigger_time": None, "batch_size": 1, "batch_prompts": [], "pending_outputs": [] } # Per-slot job fields (multi-slot mode)
+DEFAULT_STATE = { "status": "stopped", "active_kaggle_account_index": 0, "active_drive_account_index": 0, "current_step": "idle", "current_prompt": None, "last_kaggle_run_id": None, "last_kaggle_trigger_time": None, "last_downloaded_mp3": None, "last_downloaded_json": None, "retry_count": 0, "batch_size": 1, "batch_prompts": [], "pending_outputs": [], "total_tracks_generated": 0, "style_profile_id": "default", "fallback_active": False, "kaggle_usage": [{"account_index": i, "gpu_hours_used_this_week": 0.0, "last_reset_time": None} for i in range(NUM_KAGGLE_ACCOUNTS)], "last_error": None, "_checksum": None, "last_gdrive_cleanup_time": None, "last_health_check_time": None, "intervention_pending_since": None, "slots": [dict(JOB_SLOT_DEFAULTS, account_index=i) for i in range(NUM_KAGGLE_ACCOUNTS)], "error_slot_index": None, "kaggle_run_history": {}, "kaggle_account_pinned": False }
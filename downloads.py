@@ -0,0 +1,79 @@
+# downloads.py
+# Streaming file downloads for Kaggle kernel outputs. Each file goes to "<dest>.part" and is hashed while it streams.
+# Only a finished transfer is renamed into place. A retry resumes the .part with an HTTP Range request, guarded by
+# If-Range on the ETag saved with it, so a partial file from an older kernel version is never continued.
+
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+CHUNK_SIZE = 256 * 1024
+CONNECT_TIMEOUT_SECONDS = 15
+READ_TIMEOUT_SECONDS = 120
+PART_SUFFIX = ".part"
+PART_META_SUFFIX = ".part.json"
+
+
+class IncompleteOutputError(Exception):
+    # A wanted output file is missing, partial or failed its check. Retryable: the next attempt resumes any .part file.
+    pass
+
+
+def _load_part_meta(dest_path):
+    try:
+        with open(dest_path + PART_META_SUFFIX, 'r', encoding='utf-8') as f: return json.load(f)
+    except (OSError, ValueError): return {}
+
+
+def _remove_quietly(*paths):
+    for path in paths:
+        try: os.remove(path)
+        except FileNotFoundError: pass
+        except OSError as e: logging.warning(f"Could not remove {path}: {e}")
+
+
+def download_file(url, dest_path, session=None):
+    # Returns {"path", "size", "sha256", "resumed_from"}; raises on HTTP/network errors (the .part is kept for the next try).
+    os.makedirs(os.path.dirname(dest_path) or ".", exist_ok=True)
+    part_path = dest_path + PART_SUFFIX; meta = _load_part_meta(dest_path); http = session or requests
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) and meta.get("etag") else 0
+    headers = {"Range": f"bytes={offset}-", "If-Range": meta["etag"]} if offset else {}
+    with http.get(url, headers=headers, stream=True, timeout=(CONNECT_TIMEOUT_SECONDS, READ_TIMEOUT_SECONDS)) as response:
+        if response.status_code == 416 and offset: _remove_quietly(part_path, dest_path + PART_META_SUFFIX); raise IOError("Range not satisfiable; partial file discarded")
+        response.raise_for_status()
+        resumed = offset if response.status_code == 206 else 0  # 200 means the file changed (or no range support): start over
+        expected_size = None
+        if response.status_code == 206 and "/" in response.headers.get("Content-Range", ""):
+            total = response.headers["Content-Range"].rsplit("/", 1)[1]; expected_size = int(total) if total.isdigit() else None
+        elif response.headers.get("Content-Length", "").isdigit() and not response.headers.get("Content-Encoding"): expected_size = int(response.headers["Content-Length"])
+        digest = hashlib.sha256()
+        if resumed:
+            with open(part_path, 'rb') as f:
+                for block in iter(lambda: f.read(CHUNK_SIZE), b""): digest.update(block)
+        else:
+            etag = response.headers.get("ETag")
+            with open(dest_path + PART_META_SUFFIX, 'w', encoding='utf-8') as f: json.dump({"etag": etag, "url": url.split("?")[0]}, f)
+        with open(part_path, 'ab' if resumed else 'wb') as f:
+            for block in response.iter_content(chunk_size=CHUNK_SIZE):
+                if block: f.write(block); digest.update(block)
+    size = os.path.getsize(part_path)
+    if expected_size is not None and size != expected_size: raise IOError(f"incomplete download: {size}/{expected_size} bytes")
+    os.replace(part_path, dest_path); _remove_quietly(dest_path + PART_META_SUFFIX)
+    if resumed: logging.info(f"Resumed {os.path.basename(dest_path)} from byte {resumed}.")
+    return {"path": dest_path, "size": size, "sha256": digest.hexdigest(), "resumed_from": resumed}
+
+
+def download_files(files, destination_dir, max_workers=4):
+    # files: {file_name: url}. Returns {file_name: download_file() result or None}; one failed file doesn't stop the rest.
+    if not files: return {}
+    results = {}
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=min(max_workers, len(files))) as pool:
+        futures = {name: pool.submit(download_file, url, os.path.join(destination_dir, name), session) for name, url in files.items()}
+        for name, future in futures.items():
+            try: results[name] = future.result(); logging.info(f"Downloaded {name}: {results[name]['size']} bytes, sha256 {results[name]['sha256'][:12]}.")
+            except (requests.exceptions.RequestException, IOError, OSError) as e: logging.warning(f"Download of {name} failed: {e}"); results[name] = None
+    return results
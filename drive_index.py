@@ -0,0 +1,142 @@
+# drive_index.py
+# Local index of the Drive backup folder, kept current from the Drive Changes feed instead of re-listing the folder.
+# Entries sit in a min-heap on createdTime, so cleanup pops the oldest files without sorting the whole folder. Stale
+# entries (removed files, old createdTimes) are skipped lazily on pop; _queued keeps one live entry per (time, file).
+# Files matching `keep` (backup artifacts with their own retention) are indexed but never cleanup candidates, and do
+# not count towards max_files.
+# The Drive service is passed in on every call; any object with the googleapiclient files()/changes() surface works.
+
+import heapq
+import json
+import logging
+import os
+from datetime import datetime
+
+from googleapiclient.errors import HttpError
+
+CHANGES_PAGE_SIZE = 1000
+LIST_PAGE_SIZE = 1000
+_CHANGE_FIELDS = "nextPageToken, newStartPageToken, changes(fileId, removed, file(id, name, createdTime, parents, trashed))"
+
+
+def _created_ts(created_time):
+    return datetime.fromisoformat(created_time.replace('Z', '+00:00')).timestamp()
+
+
+class DriveFolderIndex:
+    def __init__(self, path, folder_id, keep=None):
+        self.path = path; self.folder_id = folder_id; self.keep = keep or (lambda name: False)
+        self.files = {}; self.page_token = None; self._heap = []; self._queued = set(); self._kept = set()
+        self._load()
+
+    # --- Persistence ---
+    def _load(self):
+        if not os.path.exists(self.path): return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f: data = json.load(f)
+            if data.get("folder_id") != self.folder_id: logging.warning("Drive index is for another folder. Rebuilding."); return
+            self.files = data.get("files", {}); self.page_token = data.get("page_token")
+        except (OSError, ValueError) as e: logging.error(f"Failed load Drive index '{self.path}': {e}. Rebuilding."); self.files = {}; self.page_token = None
+        self._rebuild_heap()
+
+    def save(self):
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f: json.dump({"folder_id": self.folder_id, "page_token": self.page_token, "files": self.files}, f, separators=(',', ':'))
+            os.replace(temp_path, self.path); return True
+        except (OSError, TypeError) as e: logging.error(f"Failed save Drive index: {e}", exc_info=True); return False
+
+    def _rebuild_heap(self):
+        self._heap = []; self._kept = set()
+        for file_id, meta in self.files.items():
+            if self.keep(meta.get("name") or ""): self._kept.add(file_id); continue
+            try: self._heap.append((_created_ts(meta["createdTime"]), file_id))
+            except (KeyError, ValueError): logging.warning(f"Drive index: bad createdTime for {meta.get('name')}. Ignoring it for cleanup.")
+        heapq.heapify(self._heap); self._queued = set(self._heap)
+
+    def _push(self, entry):
+        # A file removed and re-added with the same createdTime still has its old entry queued; pushing another would
+        # make cleanup return it twice.
+        if entry in self._queued: return
+        heapq.heappush(self._heap, entry); self._queued.add(entry)
+
+    # --- Updates ---
+    def _put(self, file):
+        try: ts = _created_ts(file["createdTime"])
+        except (KeyError, ValueError): logging.warning(f"Could not parse createdTime for {file.get('name')}."); return
+        self.files[file["id"]] = {"name": file.get("name"), "createdTime": file["createdTime"]}
+        if self.keep(file.get("name") or ""): self._kept.add(file["id"]); return  # A queued entry from before a rename is skipped on pop
+        self._kept.discard(file["id"]); self._push((ts, file["id"]))  # A stale entry for this id (other createdTime) is skipped lazily on pop
+        if len(self._heap) > 2 * len(self.files) + 64: self._rebuild_heap()
+
+    def _full_listing(self, service):
+        # Token first, listing second: changes made while listing are replayed by the next refresh instead of being lost.
+        start_token = service.changes().getStartPageToken().execute().get("startPageToken")
+        self.files = {}; self._heap = []; self._queued = set(); self._kept = set(); page_token = None
+        while True:
+            response = service.files().list(q=f"'{self.folder_id}' in parents and trashed=false", spaces='drive', fields='nextPageToken, files(id, name, createdTime)', pageSize=LIST_PAGE_SIZE, pageToken=page_token).execute()
+            for file in response.get("files", []): self._put(file)
+            page_token = response.get("nextPageToken")
+            if page_token is None: break
+        self.page_token = start_token
+        logging.info(f"Drive index rebuilt from full listing: {len(self.files)} files.")
+
+    def _apply_changes(self, service):
+        applied = 0; page_token = self.page_token
+        while page_token:
+            response = service.changes().list(pageToken=page_token, spaces='drive', fields=_CHANGE_FIELDS, pageSize=CHANGES_PAGE_SIZE).execute()
+            for change in response.get("changes", []):
+                file_id = change.get("fileId"); file = change.get("file") or {}
+                if change.get("removed") or file.get("trashed") or self.folder_id not in file.get("parents", []):
+                    if self.files.pop(file_id, None) is not None: self._kept.discard(file_id); applied += 1
+                else: self._put(file); applied += 1
+            if "newStartPageToken" in response: self.page_token = response["newStartPageToken"]; break
+            page_token = response.get("nextPageToken")
+        logging.info(f"Drive index refreshed from changes feed: {applied} changes applied, {len(self.files)} files.")
+
+    def refresh(self, service):
+        # Returns True if the index is current. An expired/invalid page token falls back to one full listing.
+        try:
+            if self.page_token is None: self._full_listing(service)
+            else:
+                try: self._apply_changes(service)
+                except HttpError as e:
+                    if e.resp.status not in (400, 404, 410): raise
+                    logging.warning(f"Drive changes token rejected ({e.resp.status}). Rebuilding index."); self._full_listing(service)
+        except Exception as e: logging.error(f"Failed refresh Drive index: {e}", exc_info=True); return False
+        self.save(); return True
+
+    # --- Cleanup Selection ---
+    def _pop_oldest(self):
+        while self._heap:
+            ts, file_id = heapq.heappop(self._heap); self._queued.discard((ts, file_id)); meta = self.files.get(file_id)
+            if meta is not None and file_id not in self._kept and _created_ts(meta["createdTime"]) == ts: return ts, file_id
+        return None
+
+    def take_cleanup_candidates(self, max_files, max_age_seconds, now_ts):
+        # Pops expired files and then the oldest files over max_files: O(k log n) for k candidates.
+        # Candidates stay in the index until mark_deleted(); release() puts undeleted ones back on the heap.
+        expired, excess = [], []; age_limit = now_ts - max_age_seconds
+        while True:
+            entry = self._pop_oldest()
+            if entry is None: break
+            remaining = len(self.files) - len(self._kept) - len(expired) - len(excess)
+            if entry[0] < age_limit: expired.append(entry)
+            elif remaining > max_files: excess.append(entry)
+            else: self._push(entry); break
+        return [(file_id, self.files[file_id]) for _, file_id in expired], [(file_id, self.files[file_id]) for _, file_id in excess]
+
+    def kept_files(self):
+        # [(file_id, meta)] of the files excluded from cleanup, oldest first, for the caller's own retention rules.
+        return sorted(((file_id, self.files[file_id]) for file_id in self._kept), key=lambda item: _created_ts(item[1]["createdTime"]))
+
+    def mark_deleted(self, file_ids):
+        for file_id in file_ids: self.files.pop(file_id, None); self._kept.discard(file_id)
+
+    def release(self, file_ids):
+        for file_id in file_ids:
+            meta = self.files.get(file_id)
+            if meta is not None and file_id not in self._kept: self._push((_created_ts(meta["createdTime"]), file_id))
+
+    def __len__(self):
+        return len(self.files)
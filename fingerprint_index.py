@@ -0,0 +1,216 @@
+# fingerprint_index.py
+# Persistent fingerprint index for the uniqueness check. Every kept track is stored in a small SQLite
+# database together with MinHash/LSH band buckets, so a lookup only compares the new fingerprint against
+# tracks that share at least one bucket instead of the whole catalog. Landmark fingerprints are stored as packed,
+# sorted uint32 arrays so scoring a candidate is a binary search over its bytes, not a JSON parse and a set build.
+
+import json
+import logging
+import sqlite3
+import struct
+import threading
+import zlib
+import hashlib
+import math
+import random
+from datetime import datetime, timezone
+from difflib import SequenceMatcher
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False  # Pure-Python MinHash; same values, but ~1 s per 5k-hash landmark fingerprint
+
+# --- LSH Parameters ---
+# 64 bands x 2 rows: pairs with shingle Jaccard >= 0.3 become candidates with probability ~0.997, >= 0.4 with ~1.0.
+# Landmark fingerprints are judged at Jaccard ~0.4, so the band layout has to recall well down there; 32 x 4 only
+# caught ~56% of pairs at 0.4. Candidates are always re-scored with the exact similarity(), so the LSH step only
+# decides who gets compared. Changing the layout re-buckets the stored tracks on the next open.
+MINHASH_NUM_PERM = 128
+LSH_BANDS = 64
+SHINGLE_SIZE = 4              # Characters per shingle for string fingerprints
+MAX_CANDIDATES = 500          # Upper bound on exact comparisons per lookup (most-shared buckets first)
+MAX_MISS_RATE = 0.001         # Landmark lookups skip candidates sharing too few bands to be at the threshold, at this miss rate
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_MAX_COEFF = 1 << 31          # Keeps a * shingle + b below 2**64, so NumPy's uint64 gives the same values as Python ints
+_MINHASH_VERSION = 2          # Part of the stored layout: bump when the signature values change
+_PERM_CHUNK = 32              # Permutations hashed per NumPy pass (bounds the temporary array)
+
+
+def _shingles(fingerprint):
+    # Strings are shingled into overlapping character k-grams; int sequences (hashes/landmarks) are used as tokens directly.
+    if isinstance(fingerprint, str):
+        if len(fingerprint) <= SHINGLE_SIZE: return {zlib.crc32(fingerprint.encode("utf-8"))}
+        return {zlib.crc32(fingerprint[i:i + SHINGLE_SIZE].encode("utf-8")) for i in range(len(fingerprint) - SHINGLE_SIZE + 1)}
+    return {int(token) & _MAX_HASH for token in fingerprint}
+
+
+def _pack(fingerprint):
+    # Sorted, de-duplicated little-endian uint32: 4 bytes per landmark hash (they are 26-bit) and the set semantics Jaccard needs.
+    values = sorted({int(token) & _MAX_HASH for token in fingerprint})
+    return struct.pack(f"<{len(values)}I", *values)
+
+
+def _unpack(blob):
+    if NUMPY_AVAILABLE: return np.frombuffer(blob, dtype="<u4")
+    return frozenset(struct.unpack(f"<{len(blob) // 4}I", blob))
+
+
+def _shared(query, stored):
+    # Size of the intersection of two _unpack()ed landmark sets; with NumPy a searchsorted over the sorted stored array.
+    if not NUMPY_AVAILABLE: return len(query & stored)
+    if not len(stored) or not len(query): return 0
+    positions = np.searchsorted(stored, query); positions[positions == len(stored)] = 0
+    return int(np.count_nonzero(stored[positions] == query))
+
+
+def _encode(fingerprint):
+    # (fingerprint TEXT, is_sequence, landmarks BLOB) columns for a new row.
+    if isinstance(fingerprint, str): return fingerprint, 0, None
+    return "", 1, _pack(fingerprint)
+
+
+def _decode(stored, is_sequence, landmarks):
+    return [int(v) for v in _unpack(landmarks)] if is_sequence else stored
+
+
+def similarity(fp1, fp2):
+    # Strings (the notebook's fingerprints) keep the metric the uniqueness check has always used, default autojunk
+    # included. Int sequences (local landmark hashes, thousands per track) are scored by hash-set Jaccard, which the
+    # MinHash estimates: SequenceMatcher is quadratic-ish there and took seconds per lookup. Mixed kinds never match.
+    if not fp1 or not fp2: return 0.0
+    if isinstance(fp1, str) and isinstance(fp2, str): return SequenceMatcher(None, fp1, fp2).ratio()
+    if isinstance(fp1, str) or isinstance(fp2, str): return 0.0
+    return _jaccard(set(fp1), set(fp2))
+
+
+def _jaccard(set1, set2):
+    shared = len(set1 & set2)
+    return shared / (len(set1) + len(set2) - shared) if shared else 0.0
+
+
+class FingerprintIndex:
+    def __init__(self, path, num_perm=MINHASH_NUM_PERM, bands=LSH_BANDS):
+        if num_perm % bands: raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands}).")
+        self.path = path; self.num_perm = num_perm; self.bands = bands; self.rows = num_perm // bands
+        rng = random.Random(1)  # Fixed seed: permutations must match across restarts or stored buckets become meaningless
+        self._perms = [(rng.randrange(1, _MAX_COEFF), rng.randrange(0, _MAX_COEFF)) for _ in range(num_perm)]
+        if NUMPY_AVAILABLE: self._perm_a = np.array([a for a, _ in self._perms], dtype=np.uint64)[:, None]; self._perm_b = np.array([b for _, b in self._perms], dtype=np.uint64)[:, None]
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS tracks (id INTEGER PRIMARY KEY, fingerprint TEXT NOT NULL, is_sequence INTEGER NOT NULL DEFAULT 0, label TEXT, added_at TEXT)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS lsh_buckets (band INTEGER NOT NULL, bucket INTEGER NOT NULL, track_id INTEGER NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_lsh_buckets ON lsh_buckets (band, bucket)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(tracks)")}
+            if "track_key" not in columns: self._conn.execute("ALTER TABLE tracks ADD COLUMN track_key TEXT")
+            if "landmarks" not in columns: self._conn.execute("ALTER TABLE tracks ADD COLUMN landmarks BLOB")
+            self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_tracks_key ON tracks (track_key)")
+        self._pack_json_landmarks(); self._check_layout()
+        logging.info(f"Fingerprint index opened: {path} ({len(self)} tracks)")
+
+    def _pack_json_landmarks(self):
+        # Rows written before the landmarks column kept the hashes as a JSON list in the fingerprint column.
+        rows = self._conn.execute("SELECT id, fingerprint FROM tracks WHERE is_sequence = 1 AND landmarks IS NULL").fetchall()
+        if not rows: return
+        logging.info(f"Packing {len(rows)} JSON landmark fingerprints into the landmarks column...")
+        with self._conn: self._conn.executemany("UPDATE tracks SET fingerprint = '', landmarks = ? WHERE id = ?", [(_pack(json.loads(stored)), track_id) for track_id, stored in rows])
+
+    def _check_layout(self):
+        # Buckets are only comparable under the layout they were computed with; re-bucket every stored track otherwise.
+        layout = f"{self.num_perm}x{self.bands}/v{_MINHASH_VERSION}"
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'lsh_layout'").fetchone()
+        if row and row[0] == layout: return
+        tracks = self._conn.execute("SELECT id, fingerprint, is_sequence, landmarks FROM tracks").fetchall()
+        if tracks: logging.info(f"Fingerprint index LSH layout changed ({row[0] if row else 'unrecorded'} -> {layout}). Re-bucketing {len(tracks)} tracks...")
+        with self._conn:
+            self._conn.execute("DELETE FROM lsh_buckets")
+            for track_id, stored, is_sequence, landmarks in tracks:
+                self._conn.executemany("INSERT INTO lsh_buckets (band, bucket, track_id) VALUES (?, ?, ?)", [(band, bucket, track_id) for band, bucket in self._band_buckets(_decode(stored, is_sequence, landmarks))])
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('lsh_layout', ?)", (layout,))
+
+    def __len__(self):
+        with self._lock: return self._conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+
+    def _minhash(self, fingerprint):
+        shingles = _shingles(fingerprint)
+        if not NUMPY_AVAILABLE: return [min(((a * s + b) % _MERSENNE_PRIME) & _MAX_HASH for s in shingles) for a, b in self._perms]
+        values = np.fromiter(shingles, dtype=np.uint64, count=len(shingles)); signature = []
+        for start in range(0, self.num_perm, _PERM_CHUNK):
+            hashed = (self._perm_a[start:start + _PERM_CHUNK] * values + self._perm_b[start:start + _PERM_CHUNK]) % np.uint64(_MERSENNE_PRIME)
+            signature += (hashed & np.uint64(_MAX_HASH)).min(axis=1).tolist()
+        return signature
+
+    def _band_buckets(self, fingerprint):
+        signature = self._minhash(fingerprint); buckets = []
+        for band in range(self.bands):
+            band_bytes = b"".join(v.to_bytes(4, "little") for v in signature[band * self.rows:(band + 1) * self.rows])
+            buckets.append((band, int.from_bytes(hashlib.blake2b(band_bytes, digest_size=8).digest(), "little", signed=True)))
+        return buckets
+
+    def _insert(self, fingerprint, label, key, buckets):
+        # Caller holds the lock and the transaction. key identifies the track across reruns of the step that adds it.
+        if key is not None:
+            row = self._conn.execute("SELECT id FROM tracks WHERE track_key = ?", (key,)).fetchone()
+            if row: logging.info(f"Fingerprint for '{key}' already indexed (track {row[0]})."); return row[0]
+        stored, is_sequence, landmarks = _encode(fingerprint)
+        track_id = self._conn.execute("INSERT INTO tracks (fingerprint, is_sequence, landmarks, label, added_at, track_key) VALUES (?, ?, ?, ?, ?, ?)", (stored, is_sequence, landmarks, label, datetime.now(timezone.utc).isoformat(), key)).lastrowid
+        self._conn.executemany("INSERT INTO lsh_buckets (band, bucket, track_id) VALUES (?, ?, ?)", [(band, bucket, track_id) for band, bucket in buckets])
+        return track_id
+
+    def add(self, fingerprint, label=None, key=None):
+        # A second add with the same key is a no-op that returns the stored track's id.
+        if not fingerprint: logging.warning("Not indexing empty fingerprint."); return None
+        buckets = self._band_buckets(fingerprint)
+        with self._lock, self._conn: return self._insert(fingerprint, label, key, buckets)
+
+    def add_many(self, entries):
+        # entries: iterable of (fingerprint, label, key), stored in one transaction. Returns the ids of the non-empty ones, in order.
+        prepared = [(fingerprint, label, key, self._band_buckets(fingerprint)) for fingerprint, label, key in entries if fingerprint]
+        with self._lock, self._conn: return [self._insert(*entry) for entry in prepared]
+
+    def min_shared_bands(self, jaccard):
+        # A pair at this Jaccard shares Binomial(bands, jaccard ** rows) bands; the fewest it shares except with MAX_MISS_RATE.
+        p = jaccard ** self.rows; below = 0.0
+        for k in range(self.bands + 1):
+            below += math.comb(self.bands, k) * p ** k * (1 - p) ** (self.bands - k)
+            if below > MAX_MISS_RATE: return max(1, k)
+        return 1
+
+    def max_similarity(self, fingerprint, threshold=None, exclude_key=None):
+        # Returns (best_similarity, track_id) over LSH candidates; stops early once a candidate reaches threshold.
+        # The track stored under exclude_key (the same track, added by an earlier run of the same step) is not compared.
+        # For landmark fingerprints similarity() is the Jaccard the bands estimate, so candidates sharing fewer bands than
+        # a pair at the threshold would are not scored; string fingerprints are judged by SequenceMatcher, so all are.
+        if not fingerprint: return 0.0, None
+        buckets = self._band_buckets(fingerprint)
+        where = " OR ".join(["(band = ? AND bucket = ?)"] * len(buckets)); args = [v for pair in buckets for v in pair]
+        min_bands = self.min_shared_bands(threshold) if threshold is not None and not isinstance(fingerprint, str) else 1
+        with self._lock:
+            candidate_ids = [row[0] for row in self._conn.execute(f"SELECT track_id FROM lsh_buckets WHERE {where} GROUP BY track_id HAVING COUNT(*) >= ? ORDER BY COUNT(*) DESC LIMIT ?", args + [min_bands, MAX_CANDIDATES])]
+            if not candidate_ids: return 0.0, None
+            rows = self._conn.execute(f"SELECT id, fingerprint, is_sequence, track_key, landmarks FROM tracks WHERE id IN ({','.join('?' * len(candidate_ids))})", candidate_ids).fetchall()
+        rows_by_id = {row[0]: row for row in rows}; best_similarity, best_id = 0.0, None
+        query = None if isinstance(fingerprint, str) else _unpack(_pack(fingerprint))  # Packed once, not per candidate
+        for track_id in candidate_ids:
+            row = rows_by_id.get(track_id)
+            if row is None or (exclude_key is not None and row[3] == exclude_key): continue
+            if query is None: sim = similarity(fingerprint, row[1]) if not row[2] else 0.0
+            elif not row[2]: sim = 0.0
+            else: shared = _shared(query, _unpack(row[4])); sim = shared / (len(query) + len(row[4]) // 4 - shared) if shared else 0.0
+            if sim > best_similarity: best_similarity, best_id = sim, track_id
+            if threshold is not None and best_similarity >= threshold: break
+        logging.debug(f"Fingerprint lookup: {len(candidate_ids)} candidates, max sim {best_similarity:.4f}")
+        return best_similarity, best_id
+
+    def is_unique(self, fingerprint, threshold, key=None):
+        best_similarity, best_id = self.max_similarity(fingerprint, threshold, exclude_key=key)
+        if best_similarity >= threshold: logging.warning(f"Track too similar to indexed track {best_id} (Sim: {best_similarity:.4f} >= Thr: {threshold})."); return False
+        logging.info(f"Uniqueness check passed. Max sim: {best_similarity:.4f} (Thr: {threshold}, {len(self)} indexed tracks)"); return True
+
+    def close(self):
+        with self._lock: self._conn.close()
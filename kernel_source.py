@@ -0,0 +1,53 @@
+# kernel_source.py
+# Run parameters delivered inside the pushed notebook source: a marked first cell (or block, for script kernels)
+# defines MUSICAI_PARAMS and writes them to PARAMS_RUNTIME_PATH, replacing the per-run params dataset version.
+# The marked cell is stripped again from pulled sources so the cached source is always the user's own notebook.
+
+import json
+
+PARAMS_MARKER = "# MUSICAI_PARAMS: injected by the orchestrator on every run; edits here are overwritten"
+PARAMS_END_MARKER = "# MUSICAI_PARAMS_END"
+PARAMS_RUNTIME_PATH = "/tmp/musicai_params.json"   # Outside /kaggle/working so it never shows up in the kernel output
+PARAMS_CELL_TAG = "musicai-params"
+
+
+def _params_code(params):
+    # repr() of the JSON text is a valid Python string literal whatever the prompt contains.
+    return [
+        PARAMS_MARKER,
+        "import json as _musicai_json, os as _musicai_os",
+        f"MUSICAI_PARAMS = _musicai_json.loads({json.dumps(params)!r})",
+        f"with open({PARAMS_RUNTIME_PATH!r}, 'w') as _musicai_f: _musicai_json.dump(MUSICAI_PARAMS, _musicai_f)",
+        f"_musicai_os.environ['MUSICAI_PARAMS_PATH'] = {PARAMS_RUNTIME_PATH!r}",
+        PARAMS_END_MARKER,
+    ]
+
+
+def _is_params_cell(cell):
+    source = cell.get("source", "")
+    text = "".join(source) if isinstance(source, list) else source
+    return PARAMS_CELL_TAG in cell.get("metadata", {}).get("tags", []) or text.startswith(PARAMS_MARKER)
+
+
+def strip_params(source_text, code_file):
+    # Removes a previously injected params cell/block; anything else is returned unchanged.
+    if code_file.endswith(".ipynb"):
+        notebook = json.loads(source_text)
+        notebook["cells"] = [cell for cell in notebook.get("cells", []) if not _is_params_cell(cell)]
+        return json.dumps(notebook, indent=1)
+    lines = source_text.splitlines(keepends=True)
+    if lines and lines[0].rstrip("\n") == PARAMS_MARKER:
+        for i, line in enumerate(lines):
+            if line.rstrip("\n") == PARAMS_END_MARKER: return "".join(lines[i + 1:])
+    return source_text
+
+
+def inject_params(source_text, code_file, params):
+    # Returns the source with the params cell/block placed first, ahead of any code that reads the parameters.
+    code_lines = _params_code(params)
+    if code_file.endswith(".ipynb"):
+        notebook = json.loads(strip_params(source_text, code_file))
+        cell = {"cell_type": "code", "execution_count": None, "metadata": {"tags": [PARAMS_CELL_TAG]}, "outputs": [], "source": [line + "\n" for line in code_lines[:-1]] + [code_lines[-1]]}
+        notebook["cells"] = [cell] + notebook.get("cells", [])
+        return json.dumps(notebook, indent=1)
+    return "\n".join(code_lines) + "\n" + strip_params(source_text, code_file)
@@ -0,0 +1,170 @@
+# log_shipping.py
+# Incremental log backup. Each backup ships only the bytes written since the last one, gzip-compressed, as one numbered
+# segment, instead of re-uploading the whole live log. The shipped offset is saved with the identity of the file it
+# belongs to (inode plus a hash of its first bytes), so it follows RotatingFileHandler's renames: files rotated since the
+# last backup are shipped from the saved offset (or whole, if new) before the live file. The segments concatenated in
+# sequence order give back the full log: rebuild_log(), or `python log_shipping.py rebuild OUTPUT SEGMENT_OR_DIR...`.
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+from datetime import datetime, timezone
+
+from log_utils import rotated_log_paths
+
+HEAD_BYTES = 256        # Identity hash covers this much of the file's start (guards against inode reuse after rotation)
+READ_CHUNK_SIZE = 1024 * 1024
+SEGMENT_PATTERN = re.compile(r"_seg(\d+)_")
+SEGMENT_NAME_PATTERN = re.compile(r"_seg\d{6,}_\d{8}_\d{6}.*\.gz$")  # Full segment file name, as ship() builds it
+
+
+def _head_hash(f, length):
+    f.seek(0); return hashlib.sha1(f.read(length)).hexdigest()
+
+
+def _last_line_end(f, offset, end):
+    # Position just past the last newline in [offset, end), scanning backwards; offset if there is none.
+    position = end
+    while position > offset:
+        start = max(offset, position - READ_CHUNK_SIZE); f.seek(start); block = f.read(position - start)
+        newline = block.rfind(b"\n")
+        if newline >= 0: return start + newline + 1
+        position = start
+    return offset
+
+
+def _matches(path, saved):
+    # True if `path` is the file the saved offset was taken from (it may have been renamed by rotation since).
+    try:
+        if os.stat(path).st_ino != saved.get("inode"): return False
+        with open(path, 'rb') as f: return _head_hash(f, saved.get("head_len", 0)) == saved.get("head")
+    except OSError: return False
+
+
+class LogShipper:
+    def __init__(self, log_path, backup_count, state_path=None, work_dir="."):
+        self.log_path = log_path; self.backup_count = backup_count; self.work_dir = work_dir
+        self.state_path = state_path or f"{log_path}.shipping.json"
+        self.state = self._load_state()
+
+    # --- State ---
+    def _load_state(self):
+        # {"seq": next segment number, "file": {"inode", "head_len", "head", "offset"} of the file shipped last, or None}
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f: state = json.load(f)
+            if isinstance(state, dict) and isinstance(state.get("seq"), int): return state
+        except FileNotFoundError: pass
+        except (OSError, ValueError) as e: logging.error(f"Failed load log shipping state '{self.state_path}': {e}. Shipping from the start.")
+        return {"seq": 0, "file": None}
+
+    def _save_state(self):
+        temp_path = self.state_path + ".tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f: json.dump(self.state, f)
+            os.replace(temp_path, self.state_path); return True
+        except OSError as e: logging.error(f"Failed save log shipping state '{self.state_path}': {e}"); return False
+
+    # --- Shipping ---
+    def pending_files(self):
+        # [(path, start offset)] oldest first: the file shipped last (from its offset) and every file newer than it.
+        paths = [p for p in reversed(rotated_log_paths(self.log_path, self.backup_count)) if os.path.exists(p)]
+        saved = self.state.get("file")
+        if saved:
+            for i, path in enumerate(paths):
+                if _matches(path, saved):
+                    offset = saved.get("offset", 0)
+                    if os.path.getsize(path) < offset: logging.warning(f"Log shipping: '{path}' shrank below the shipped offset. Shipping it from the start."); offset = 0
+                    return [(path, offset)] + [(p, 0) for p in paths[i + 1:]]
+            logging.warning(f"Log shipping: last shipped file of '{self.log_path}' rotated out before it was finished. Segment {self.state['seq']} starts after a gap.")
+        return [(p, 0) for p in paths]
+
+    def ship(self, upload):
+        # upload(local_path, name) -> Drive file ID or None. Returns {"name", "bytes", "compressed", "file_id"}, or None when
+        # there is nothing new or the upload failed (the offset then stays put and the bytes go out with the next segment).
+        pending = self.pending_files()
+        if not pending: return None
+        stem, ext = os.path.splitext(os.path.basename(self.log_path))
+        name = f"{stem}_seg{self.state['seq']:06d}_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}{ext}.gz"
+        segment_path = os.path.join(self.work_dir, name); raw_bytes = 0; last = None
+        try:
+            with gzip.open(segment_path, 'wb') as out:
+                for n, (path, offset) in enumerate(pending):
+                    with open(path, 'rb') as f:
+                        end = os.fstat(f.fileno()).st_size
+                        if n == len(pending) - 1: end = _last_line_end(f, offset, end)  # The live file may end mid-record
+                        f.seek(offset); remaining = end - offset
+                        while remaining > 0:
+                            block = f.read(min(READ_CHUNK_SIZE, remaining))
+                            if not block: break
+                            out.write(block); remaining -= len(block); raw_bytes += len(block)
+                        head_len = min(HEAD_BYTES, end)
+                        last = {"inode": os.fstat(f.fileno()).st_ino, "head_len": head_len, "head": _head_hash(f, head_len), "offset": end}
+        except OSError as e: logging.error(f"Log shipping: failed write segment '{segment_path}': {e}"); self._remove_segment(segment_path); return None
+        if not raw_bytes:
+            self._remove_segment(segment_path)
+            if last and last != self.state.get("file"): self.state["file"] = last; self._save_state()  # Follow a rotation that happened meanwhile
+            return None
+        compressed = os.path.getsize(segment_path); file_id = upload(segment_path, name); self._remove_segment(segment_path)
+        if not file_id: logging.error(f"Log shipping: upload of '{name}' failed. {raw_bytes} bytes stay pending."); return None
+        self.state = {"seq": self.state["seq"] + 1, "file": last}; self._save_state()
+        logging.info(f"Shipped log segment '{name}': {raw_bytes} bytes ({compressed} compressed).")
+        return {"name": name, "bytes": raw_bytes, "compressed": compressed, "file_id": file_id}
+
+    def _remove_segment(self, path):
+        try: os.remove(path)
+        except FileNotFoundError: pass
+        except OSError as e: logging.warning(f"Could not remove log segment {path}: {e}")
+
+
+# --- Rebuild ---
+def is_segment_name(name):
+    return SEGMENT_NAME_PATTERN.search(name) is not None
+
+
+def segment_number(path):
+    match = SEGMENT_PATTERN.search(os.path.basename(path))
+    return int(match.group(1)) if match else None
+
+
+def rebuild_log(segment_paths, output_path):
+    # Concatenates the segments of one log in sequence order. Returns {"segments", "bytes", "missing": [segment numbers]}.
+    numbered = sorted((n, p) for p in segment_paths if (n := segment_number(p)) is not None)
+    if not numbered: logging.error("No log segments to rebuild from."); return None
+    numbers = [n for n, _ in numbered]
+    missing = sorted(set(range(numbers[0], numbers[-1] + 1)) - set(numbers))
+    if missing: logging.warning(f"Log segments missing: {missing}. The rebuilt log has gaps there.")
+    total = 0
+    with open(output_path, 'wb') as out:
+        for _, path in numbered:
+            with gzip.open(path, 'rb') as f:
+                for block in iter(lambda: f.read(READ_CHUNK_SIZE), b""): out.write(block); total += len(block)
+    logging.info(f"Rebuilt '{output_path}' from {len(numbered)} segments ({total} bytes).")
+    return {"segments": len(numbered), "bytes": total, "missing": missing}
+
+
+def _expand_segment_paths(paths):
+    expanded = []
+    for path in paths:
+        if os.path.isdir(path): expanded += [os.path.join(path, name) for name in os.listdir(path) if name.endswith(".gz") and SEGMENT_PATTERN.search(name)]
+        else: expanded.append(path)
+    return expanded
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild a log from segments shipped by LogShipper.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    rebuild = commands.add_parser("rebuild", help="Concatenate downloaded segments (files or directories) in sequence order.")
+    rebuild.add_argument("output"); rebuild.add_argument("segments", nargs="+")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
+    args = parse_args()
+    result = rebuild_log(_expand_segment_paths(args.segments), args.output)
+    sys.exit(0 if result and not result["missing"] else 1)
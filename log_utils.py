@@ -0,0 +1,185 @@
+# log_utils.py
+# Log access that doesn't scale with log size: an in-memory ring of recent records (plus a separate ring of
+# warnings/errors) for the bot's /logs and /errors, and a reverse block reader to search the rotated log files.
+# Also the logging pipeline itself: records are queued by the caller and handled by one listener thread, optionally
+# written as JSON lines carrying the step/account/run_id context set by the orchestrator.
+
+import contextvars
+import copy
+import json
+import logging
+import os
+import queue
+import threading
+from collections import deque
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+RECENT_RING_SIZE = 500        # Most recent formatted records of any level
+PROBLEM_RING_SIZE = 200       # Most recent WARNING/ERROR/CRITICAL records
+READ_BLOCK_SIZE = 64 * 1024
+LOG_TIME_FORMAT = "%Y-%m-%d %H:%M:%S,%f"   # logging's default asctime, as used by LOG_FORMAT in main.py
+_LEVEL_NAMES = {"DEBUG": logging.DEBUG, "INFO": logging.INFO, "WARNING": logging.WARNING, "ERROR": logging.ERROR, "CRITICAL": logging.CRITICAL}
+LOG_CONTEXT_FIELDS = ("step", "account", "run_id")
+
+
+# --- Log Context ---
+# Per thread / asyncio task, so the orchestrator, pipeline workers and bot handlers never see each other's fields.
+_log_context = contextvars.ContextVar("log_context", default={})
+
+def set_log_context(**fields):
+    # Fields attached to every record logged afterwards from this thread or task; a None value removes the field.
+    context = dict(_log_context.get())
+    for name, value in fields.items():
+        if value is None: context.pop(name, None)
+        else: context[name] = value
+    _log_context.set(context)
+
+def clear_log_context(): _log_context.set({})
+
+
+class LogContextFilter(logging.Filter):
+    # Runs in the logging thread (before the record is queued) and copies the current context onto the record.
+    def filter(self, record):
+        context = _log_context.get()
+        for name in LOG_CONTEXT_FIELDS: setattr(record, name, context.get(name))
+        return True
+
+
+class JsonLinesFormatter(logging.Formatter):
+    # One compact JSON object per record: ts (local time, like the text log), level, file, line, msg, the context fields
+    # that are set, and exc with the formatted traceback.
+    def format(self, record):
+        entry = {"ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"), "level": record.levelname, "file": record.filename, "line": record.lineno, "msg": record.getMessage()}
+        for name in LOG_CONTEXT_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None: entry[name] = value
+        if record.exc_info and not record.exc_text: record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text: entry["exc"] = record.exc_text
+        return json.dumps(entry, separators=(",", ":"), default=str)
+
+
+# --- Queued Logging ---
+class _PreparedQueueHandler(QueueHandler):
+    # Keeps the record's fields for the listener's own formatters: only the message is merged and the traceback rendered
+    # (exc_info can't safely cross threads), instead of QueueHandler's default pre-formatting of the whole line.
+    def prepare(self, record):
+        record = copy.copy(record); record.msg = record.getMessage(); record.args = None
+        if record.exc_info: record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info); record.exc_info = None
+        return record
+
+
+_listener = None
+
+def start_queue_logging(logger, handlers):
+    # Replaces the logger's handlers with a queue; `handlers` (each keeping its own level and formatter) run on one
+    # background thread. Returns the listener; stop_queue_logging() drains it at shutdown.
+    global _listener
+    log_queue = queue.SimpleQueue(); queue_handler = _PreparedQueueHandler(log_queue); queue_handler.addFilter(LogContextFilter())
+    for handler in list(logger.handlers): logger.removeHandler(handler)
+    logger.addHandler(queue_handler)
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True); _listener.start()
+    return _listener
+
+def stop_queue_logging():
+    # Writes out everything still queued. Safe to call when queued logging was never started.
+    global _listener
+    if _listener is not None: _listener.stop(); _listener = None
+
+
+class RingBufferHandler(logging.Handler):
+    def __init__(self, recent_size=RECENT_RING_SIZE, problem_size=PROBLEM_RING_SIZE, level=logging.INFO):
+        super().__init__(level)
+        self._recent = deque(maxlen=recent_size); self._problems = deque(maxlen=problem_size); self._ring_lock = threading.Lock()
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+            with self._ring_lock:
+                self._recent.append(line)
+                if record.levelno >= logging.WARNING: self._problems.append((record.levelno, line))
+        except Exception: self.handleError(record)
+
+    def recent(self, count):
+        with self._ring_lock: return list(self._recent)[-count:]
+
+    def problems(self, count, min_level=logging.ERROR):
+        with self._ring_lock: return [line for levelno, line in self._problems if levelno >= min_level][-count:]
+
+    def seed_from_files(self, log_path, backup_count=0):
+        # Fills the rings from the tail of the existing logs so /logs and /errors have history right after a restart.
+        recent, problems = [], []
+        for entry in iter_log_entries_reverse(log_path, backup_count):
+            if len(recent) < self._recent.maxlen: recent.append(entry["text"])
+            if entry["levelno"] >= logging.WARNING and len(problems) < self._problems.maxlen: problems.append((entry["levelno"], entry["text"]))
+            if len(recent) >= self._recent.maxlen and len(problems) >= self._problems.maxlen: break
+        with self._ring_lock:
+            # Older seeded entries go before anything already buffered; extending from the right keeps the newest on overflow.
+            recent_now, problems_now = list(self._recent), list(self._problems); self._recent.clear(); self._problems.clear()
+            self._recent.extend(recent[::-1] + recent_now); self._problems.extend(problems[::-1] + problems_now)
+        logging.debug(f"Log ring seeded with {len(recent)} recent and {len(problems)} warning/error entries.")
+
+
+def iter_lines_reverse(path, block_size=READ_BLOCK_SIZE):
+    # Yields the file's lines last-to-first by seeking backwards in fixed-size blocks; memory is bounded by block size plus one line.
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END); position = f.tell(); remainder = b""
+        while position > 0:
+            read_size = min(block_size, position); position -= read_size; f.seek(position)
+            parts = (f.read(read_size) + remainder).split(b"\n"); remainder = parts[0]
+            for part in reversed(parts[1:]):
+                if part: yield part.decode('utf-8', 'replace')
+        if remainder: yield remainder.decode('utf-8', 'replace')
+
+
+def rotated_log_paths(log_path, backup_count):
+    # Newest first, matching RotatingFileHandler's naming (system_log.txt, .1, .2, ...).
+    return [log_path] + [f"{log_path}.{i}" for i in range(1, backup_count + 1)]
+
+
+def _parse_json_entry(line):
+    # A JsonLinesFormatter line -> (datetime, levelno, text rendered like the text log plus its context fields), or None.
+    try: entry = json.loads(line); timestamp = datetime.fromisoformat(entry["ts"]); levelno = _LEVEL_NAMES[entry["level"]]
+    except (ValueError, KeyError, TypeError): return None
+    context = ", ".join(f"{name}={entry[name]}" for name in LOG_CONTEXT_FIELDS if name in entry)
+    text = f"{timestamp.strftime(LOG_TIME_FORMAT)[:-3]} - {entry['level']} - {entry.get('file')}:{entry.get('line')} - {entry.get('msg')}" + (f" [{context}]" if context else "")
+    return timestamp, levelno, text + (f"\n{entry['exc']}" if entry.get("exc") else "")
+
+
+def _parse_header(line):
+    # "<asctime> - <LEVEL> - ..." -> (datetime, levelno), or None for continuation lines (tracebacks, multi-line messages).
+    parts = line.split(" - ", 2)
+    if len(parts) < 3 or parts[1] not in _LEVEL_NAMES: return None
+    try: return datetime.strptime(parts[0], LOG_TIME_FORMAT), _LEVEL_NAMES[parts[1]]
+    except ValueError: return None
+
+
+def iter_log_entries_reverse(log_path, backup_count=0):
+    # Yields {"time", "levelno", "text"} newest first across the live and rotated files; continuation lines are folded into their entry.
+    # Works on the text log and on the JSON-lines log (one self-contained entry per line).
+    for path in rotated_log_paths(log_path, backup_count):
+        if not os.path.exists(path): continue
+        continuation = []
+        try:
+            for line in iter_lines_reverse(path):
+                if line.startswith("{"):
+                    parsed = _parse_json_entry(line)
+                    if parsed is not None: yield {"time": parsed[0], "levelno": parsed[1], "text": parsed[2]}; continuation = []; continue
+                header = _parse_header(line)
+                if header is None: continuation.append(line); continue
+                yield {"time": header[0], "levelno": header[1], "text": "\n".join([line] + continuation[::-1])}; continuation = []
+        except OSError as e: logging.warning(f"Failed read log file {path}: {e}")
+
+
+def search_logs(log_path, backup_count=0, since=None, until=None, min_level=logging.NOTSET, contains=None, limit=50):
+    # Newest-first scan that stops at the first entry older than `since`, so a recent window never reads old files.
+    # Returns up to `limit` matching entry texts in chronological order.
+    matches = []
+    for entry in iter_log_entries_reverse(log_path, backup_count):
+        if since is not None and entry["time"] < since: break
+        if until is not None and entry["time"] > until: continue
+        if entry["levelno"] < min_level or (contains and contains not in entry["text"]): continue
+        matches.append(entry["text"])
+        if len(matches) >= limit: break
+    matches.reverse()
+    return matches
@@ -0,0 +1,210 @@
+# metrics.py
+# In-process latency and throughput metrics. Every instrumented operation (Kaggle trigger/run/download, status polls,
+# uniqueness check, Drive upload, Telegram send, pipeline stages, retry_operation attempts) gets a latency histogram
+# and per-outcome counts. The registry is served as Prometheus text on a local HTTP port, summarized for the bot's
+# /metrics and saved to a JSON file (cumulative totals plus an hourly history) so trends survive restarts.
+
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds; spans Telegram sends (sub-second) to GPU runs (tens of minutes)
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 900, 1200, 1800, 2700, 3600)
+HISTORY_HOURS = 168     # Hourly rollups kept for trends (one week)
+METRIC_PREFIX = "musicai"
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(labels):
+    return ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels)
+
+
+def _format_seconds(seconds):
+    if seconds is None: return "-"
+    if seconds < 1: return f"{seconds * 1000:.0f}ms"
+    if seconds < 120: return f"{seconds:.1f}s"
+    return f"{seconds / 60:.1f}m" if seconds < 7200 else f"{seconds / 3600:.1f}h"
+
+
+class MetricsRegistry:
+    def __init__(self, buckets=DEFAULT_BUCKETS, history_hours=HISTORY_HOURS):
+        self.buckets = tuple(buckets); self._lock = threading.Lock()
+        self._operations = {}; self._counters = {}; self._history = deque(maxlen=history_hours)
+
+    # --- Recording ---
+    def _operation(self, name):
+        op = self._operations.get(name)
+        if op is None: op = self._operations[name] = {"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0, "outcomes": {}}
+        return op
+
+    def _hour(self):
+        # Current hourly rollup {"hour": epoch hour, "ops": {name: [count, errors, seconds]}}, appended when the hour changes.
+        hour = int(time.time() // 3600)
+        if not self._history or self._history[-1]["hour"] != hour: self._history.append({"hour": hour, "ops": {}})
+        return self._history[-1]
+
+    def observe(self, operation, seconds, outcome="ok"):
+        seconds = max(0.0, float(seconds))
+        with self._lock:
+            op = self._operation(operation)
+            op["buckets"][bisect.bisect_left(self.buckets, seconds)] += 1; op["sum"] += seconds; op["count"] += 1
+            op["outcomes"][outcome] = op["outcomes"].get(outcome, 0) + 1
+            rollup = self._hour()["ops"].setdefault(operation, [0, 0, 0.0])
+            rollup[0] += 1; rollup[1] += outcome != "ok"; rollup[2] += seconds
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock: self._counters[key] = self._counters.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, operation):
+        # Observes the block's duration; an exception escaping the block is recorded as outcome "error" and re-raised.
+        started = time.perf_counter(); outcome = "error"
+        try: yield; outcome = "ok"
+        finally: self.observe(operation, time.perf_counter() - started, outcome)
+
+    # --- Reading ---
+    def _quantile(self, op, q):
+        # Linear interpolation inside the histogram bucket holding the q-th observation.
+        if not op["count"]: return None
+        rank = q * op["count"]; seen = 0
+        for i, n in enumerate(op["buckets"]):
+            if n and seen + n >= rank:
+                if i >= len(self.buckets): return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+    def summary(self, recent_hours=24):
+        # One row per operation: lifetime count/errors/mean/p50/p95 plus count/errors/mean over the last `recent_hours`.
+        first_hour = int(time.time() // 3600) - recent_hours + 1
+        with self._lock:
+            recent = {}
+            for rollup in self._history:
+                if rollup["hour"] < first_hour: continue
+                for name, (n, errors, seconds) in rollup["ops"].items():
+                    r = recent.setdefault(name, [0, 0, 0.0]); r[0] += n; r[1] += errors; r[2] += seconds
+            rows = []
+            for name in sorted(self._operations):
+                op = self._operations[name]; r = recent.get(name, [0, 0, 0.0])
+                rows.append({"operation": name, "count": op["count"], "errors": op["count"] - op["outcomes"].get("ok", 0), "mean": op["sum"] / op["count"] if op["count"] else None,
+                             "p50": self._quantile(op, 0.5), "p95": self._quantile(op, 0.95), "recent_count": r[0], "recent_errors": r[1], "recent_mean": r[2] / r[0] if r[0] else None})
+        return rows
+
+    def format_summary(self, recent_hours=24):
+        # Fixed-width table for a Telegram code block.
+        rows = self.summary(recent_hours)
+        if not rows: return "No metrics recorded yet."
+        width = max(len(r["operation"]) for r in rows)
+        lines = [f"{'operation':<{width}} {'n':>6} {'err':>4} {'p50':>7} {'p95':>7} {f'{recent_hours}h n':>6} {'err':>4} {'mean':>7}"]
+        for r in rows:
+            lines.append(f"{r['operation']:<{width}} {r['count']:>6} {r['errors']:>4} {_format_seconds(r['p50']):>7} {_format_seconds(r['p95']):>7} {r['recent_count']:>6} {r['recent_errors']:>4} {_format_seconds(r['recent_mean']):>7}")
+        return "\n".join(lines)
+
+    def render_prometheus(self):
+        with self._lock:
+            lines = [f"# HELP {METRIC_PREFIX}_operation_seconds Duration of instrumented operations.", f"# TYPE {METRIC_PREFIX}_operation_seconds histogram"]
+            for name in sorted(self._operations):
+                op = self._operations[name]; labels = _label_text([("operation", name)]); cumulative = 0
+                for bound, n in zip(self.buckets, op["buckets"]):
+                    cumulative += n; lines.append(f'{METRIC_PREFIX}_operation_seconds_bucket{{{labels},le="{bound:g}"}} {cumulative}')
+                lines.append(f'{METRIC_PREFIX}_operation_seconds_bucket{{{labels},le="+Inf"}} {op["count"]}')
+                lines.append(f"{METRIC_PREFIX}_operation_seconds_sum{{{labels}}} {op['sum']:.6f}"); lines.append(f"{METRIC_PREFIX}_operation_seconds_count{{{labels}}} {op['count']}")
+            lines += [f"# HELP {METRIC_PREFIX}_operation_total Instrumented operations by outcome.", f"# TYPE {METRIC_PREFIX}_operation_total counter"]
+            for name in sorted(self._operations):
+                for outcome, n in sorted(self._operations[name]["outcomes"].items()): lines.append(f"{METRIC_PREFIX}_operation_total{{{_label_text([('operation', name), ('outcome', outcome)])}}} {n}")
+            for counter in sorted({name for name, _ in self._counters}):
+                lines.append(f"# TYPE {METRIC_PREFIX}_{counter}_total counter")
+                for (name, labels), n in sorted(self._counters.items()):
+                    if name == counter: lines.append(f"{METRIC_PREFIX}_{name}_total{{{_label_text(labels)}}} {n}" if labels else f"{METRIC_PREFIX}_{name}_total {n}")
+        return "\n".join(lines) + "\n"
+
+    # --- Persistence ---
+    def save(self, path):
+        with self._lock:
+            data = {"buckets": list(self.buckets), "operations": self._operations, "history": list(self._history),
+                    "counters": [{"name": name, "labels": dict(labels), "value": n} for (name, labels), n in self._counters.items()]}
+            payload = json.dumps(data, separators=(',', ':'))
+        temp_path = path + ".tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f: f.write(payload)
+            os.replace(temp_path, path); return True
+        except OSError as e: logging.error(f"Failed save metrics '{path}': {e}"); return False
+
+    def load(self, path):
+        # Adds the saved totals to what is already recorded. Histograms saved with different buckets are not restored.
+        if not os.path.exists(path): return False
+        try:
+            with open(path, 'r', encoding='utf-8') as f: data = json.load(f)
+        except (OSError, ValueError) as e: logging.error(f"Failed load metrics '{path}': {e}. Starting empty."); return False
+        with self._lock:
+            if tuple(data.get("buckets", ())) == self.buckets:
+                for name, saved in data.get("operations", {}).items():
+                    op = self._operation(name); op["buckets"] = [a + b for a, b in zip(op["buckets"], saved["buckets"])]; op["sum"] += saved["sum"]; op["count"] += saved["count"]
+                    for outcome, n in saved["outcomes"].items(): op["outcomes"][outcome] = op["outcomes"].get(outcome, 0) + n
+            else: logging.warning("Saved metrics use different histogram buckets. Latency history not restored.")
+            for counter in data.get("counters", []):
+                key = (counter["name"], tuple(sorted(counter["labels"].items()))); self._counters[key] = self._counters.get(key, 0) + counter["value"]
+            # Saved hours before the live ones go first; the saved rollup of the live first hour (a restart within the hour) is added into it.
+            current = list(self._history); first_hour = current[0]["hour"] if current else None; older = []
+            for saved in data.get("history", []):
+                if first_hour is None or saved["hour"] < first_hour: older.append(saved)
+                elif saved["hour"] == first_hour:
+                    for name, (n, errors, seconds) in saved["ops"].items(): r = current[0]["ops"].setdefault(name, [0, 0, 0.0]); r[0] += n; r[1] += errors; r[2] += seconds
+            self._history.clear(); self._history.extend(older + current)
+        logging.info(f"Restored metrics for {len(data.get('operations', {}))} operations from '{path}'.")
+        return True
+
+
+_registry = MetricsRegistry()
+
+def get_registry(): return _registry
+def observe(operation, seconds, outcome="ok"): _registry.observe(operation, seconds, outcome)
+def count(name, amount=1, **labels): _registry.count(name, amount, **labels)
+def timer(operation): return _registry.timer(operation)
+
+
+def timed(operation):
+    # Decorator form of timer() for module-level functions.
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with _registry.timer(operation): return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__; wrapper.__doc__ = func.__doc__; wrapper.__wrapped__ = func
+        return wrapper
+    return decorator
+
+
+# --- Export ---
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"): self.send_error(404); return
+        body = _registry.render_prometheus().encode('utf-8')
+        self.send_response(200); self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8"); self.send_header("Content-Length", str(len(body))); self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): logging.debug(f"Metrics HTTP: {format % args}")
+
+
+def start_http_server(host, port):
+    # Serves the registry on http://host:port/metrics from a daemon thread. Returns the server or None if the port is taken.
+    try: server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    except OSError as e: logging.error(f"Metrics endpoint not started on {host}:{port}: {e}"); return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logging.info(f"Metrics endpoint listening on http://{host}:{port}/metrics"); return server
+
+
+def start_autosave(path, interval_seconds):
+    def saver():
+        while True: time.sleep(interval_seconds); _registry.save(path)
+    threading.Thread(target=saver, name="metrics-autosave", daemon=True).start()
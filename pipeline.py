@@ -0,0 +1,163 @@
+# pipeline.py
+# Post-download track pipeline: named stage queues with their own worker threads, so analysis, upload and profile
+# updates never hold up the next Kaggle trigger. All queues live in one JSON document that is rewritten atomically on
+# every change, so handing an item from one stage to the next is a single write and survives a restart. Stage
+# handlers are plain callables passed in by the caller; this module knows nothing about Kaggle, Drive or the state.
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+import metrics
+
+TAKE_TIMEOUT_SECONDS = 1.0   # Workers re-check for shutdown at least this often while their queue is empty
+
+
+class RetryLater(Exception):
+    # Raised by a stage handler to put its item back on the queue until `delay_seconds` from now.
+    def __init__(self, delay_seconds, reason=""):
+        super().__init__(reason or f"retry in {delay_seconds}s"); self.delay_seconds = delay_seconds
+
+
+class PipelineQueues:
+    def __init__(self, path, capacities):
+        # capacities: {queue_name: max items (None = unbounded)}. Items are JSON-serializable dicts; each gets an "id".
+        self.path = path; self.capacities = dict(capacities)
+        self._queues = {name: deque() for name in self.capacities}; self._in_flight = {name: {} for name in self.capacities}
+        self._cond = threading.Condition(); self._stopping = False
+        self._load()
+
+    # --- Persistence ---
+    def _load(self):
+        if not os.path.exists(self.path): return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f: data = json.load(f)
+        except (OSError, ValueError) as e: logging.error(f"Failed load pipeline queues '{self.path}': {e}. Starting empty.", exc_info=True); return
+        restored = 0
+        for name, items in data.items():
+            if name not in self._queues: logging.warning(f"Pipeline queue '{name}' no longer exists. Dropping {len(items)} items."); continue
+            # Items that were being worked on when the process stopped are redone first.
+            items = sorted(items, key=lambda item: not item.get("_in_flight"))
+            for item in items: item.pop("_in_flight", None); self._queues[name].append(item); restored += 1
+        if restored: logging.info(f"Restored {restored} pipeline items: {self.sizes()}.")
+
+    def _persist(self):
+        data = {name: list(queue) + [dict(item, _in_flight=True) for item in self._in_flight[name].values()] for name, queue in self._queues.items()}
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f: json.dump(data, f, separators=(',', ':')); f.flush(); os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        except (OSError, TypeError, ValueError) as e: logging.error(f"Failed persist pipeline queues: {e}", exc_info=True)
+
+    # --- Queue Operations ---
+    def _room(self, name):
+        capacity = self.capacities[name]
+        return float('inf') if capacity is None else capacity - len(self._queues[name]) - len(self._in_flight[name])
+
+    def has_room(self, name):
+        with self._cond: return self._room(name) >= 1
+
+    def sizes(self):
+        with self._cond: return {name: len(queue) + len(self._in_flight[name]) for name, queue in self._queues.items()}
+
+    def offer(self, name, item):
+        # Non-blocking put for the orchestrator: False if the queue is full (the caller keeps the item and retries later).
+        with self._cond:
+            if self._room(name) < 1: return False
+            self._queues[name].append(dict(item, id=item.get("id") or uuid.uuid4().hex, queued_at=time.time())); self._persist(); self._cond.notify_all()
+            return True
+
+    def take(self, name, timeout=TAKE_TIMEOUT_SECONDS):
+        # Oldest item that is not waiting on a retry delay, or None after `timeout`. It stays persisted until complete()/retry().
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not self._stopping:
+                now = time.time(); queue = self._queues[name]
+                for i, item in enumerate(queue):
+                    if item.get("not_before", 0) <= now:
+                        del queue[i]; self._in_flight[name][item["id"]] = item; self._persist()
+                        return item
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: return None
+                self._cond.wait(remaining)
+            return None
+
+    def complete(self, name, item_id, outputs=()):
+        # Finishes an in-flight item and appends its outputs [(queue_name, item), ...] in the same write. Waits while a
+        # destination is full (backpressure); returns False if shutdown came first, leaving the item to be redone.
+        outputs = [(queue_name, dict(item, id=item.get("id") or uuid.uuid4().hex, queued_at=time.time())) for queue_name, item in outputs]
+        needed = {}
+        for queue_name, _ in outputs: needed[queue_name] = needed.get(queue_name, 0) + 1
+        with self._cond:
+            while any(self._room(queue_name) < count for queue_name, count in needed.items()):
+                if self._stopping: return False
+                self._cond.wait(TAKE_TIMEOUT_SECONDS)
+            self._in_flight[name].pop(item_id, None)
+            for queue_name, item in outputs: self._queues[queue_name].append(item)
+            self._persist(); self._cond.notify_all()
+            return True
+
+    def retry(self, name, item_id, delay_seconds):
+        with self._cond:
+            item = self._in_flight[name].pop(item_id, None)
+            if item is None: return
+            item["attempts"] = item.get("attempts", 0) + 1; item["not_before"] = time.time() + delay_seconds
+            self._queues[name].append(item); self._persist(); self._cond.notify_all()
+
+    def peek(self, name):
+        # Snapshot of what is queued on `name`, e.g. the results queue the orchestrator applies to the state before remove()-ing them.
+        with self._cond: return [dict(item) for item in self._queues[name]]
+
+    def remove(self, name, item_ids):
+        item_ids = set(item_ids)
+        with self._cond:
+            kept = [item for item in self._queues[name] if item["id"] not in item_ids]
+            if len(kept) != len(self._queues[name]): self._queues[name] = deque(kept); self._persist(); self._cond.notify_all()
+
+    def stop(self):
+        with self._cond: self._stopping = True; self._cond.notify_all()
+
+
+class Stage:
+    def __init__(self, name, handler, workers=1):
+        # handler(item) -> [(queue_name, item), ...] outputs; raise RetryLater to requeue. Reads from the queue named `name`.
+        self.name = name; self.handler = handler; self.workers = workers
+
+
+class Pipeline:
+    def __init__(self, queues, stages):
+        self.queues = queues; self.stages = list(stages); self._threads = []; self._stop_event = threading.Event()
+
+    def _worker(self, stage):
+        while not self._stop_event.is_set():
+            item = self.queues.take(stage.name)
+            if item is None: continue
+            started = time.monotonic()
+            # Queue wait runs from when the item became eligible (queued, or its retry delay ended) to this take.
+            metrics.observe(f"pipeline_{stage.name}_wait", time.time() - max(item.get("queued_at", time.time()), item.get("not_before", 0)))
+            try: outputs = stage.handler(item) or []
+            except RetryLater as e:
+                metrics.observe(f"pipeline_{stage.name}", time.monotonic() - started, "retry"); logging.warning(f"Pipeline {stage.name}: item {item['id']} retry in {e.delay_seconds:.0f}s ({e})."); self.queues.retry(stage.name, item["id"], e.delay_seconds); continue
+            except Exception as e:
+                metrics.observe(f"pipeline_{stage.name}", time.monotonic() - started, "error"); logging.error(f"Pipeline {stage.name}: item {item['id']} failed and was dropped: {e}", exc_info=True); outputs = []
+            else: metrics.observe(f"pipeline_{stage.name}", time.monotonic() - started)
+            if self.queues.complete(stage.name, item["id"], outputs): logging.debug(f"Pipeline {stage.name}: item {item['id']} done in {time.monotonic() - started:.1f}s.")
+
+    def start(self):
+        if self._threads: return
+        for stage in self.stages:
+            for n in range(stage.workers):
+                thread = threading.Thread(target=self._worker, args=(stage,), name=f"pipeline-{stage.name}-{n}", daemon=True); thread.start(); self._threads.append(thread)
+        logging.info(f"Pipeline started: {', '.join(f'{s.name} x{s.workers}' for s in self.stages)}. Queued: {self.queues.sizes()}.")
+
+    def stop(self, timeout=30.0):
+        # Items a worker is still on are left in flight and redone after the next start.
+        self._stop_event.set(); self.queues.stop(); deadline = time.monotonic() + timeout
+        for thread in self._threads: thread.join(max(0.0, deadline - time.monotonic()))
+        alive = [t.name for t in self._threads if t.is_alive()]
+        if alive: logging.warning(f"Pipeline workers still busy at shutdown: {alive}.")
+        self._threads = []; logging.info("Pipeline stopped.")
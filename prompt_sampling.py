@@ -0,0 +1,148 @@
+# prompt_sampling.py
+# Weighted prompt sampling for generate_riffusion_prompt. The genre/instrument/mood weights derived from the style
+# profile (+ Spotify trends) are compiled into alias-method tables once per profile version, so each draw is O(1).
+# PromptQueue keeps a bounded stock of ready prompt+seed entries topped up by a background thread.
+
+import json
+import logging
+import random
+import threading
+from collections import deque
+
+EXPLORATION_CHANCE = 0.15     # Per dimension: chance of ignoring the profile weights and drawing uniformly
+FAST_MOODS = ["energetic", "upbeat", "driving", "happy", "intense", "fast"]
+SLOW_MOODS = ["chill", "relaxing", "ambient", "calm", "peaceful", "slow", "atmospheric", "dreamy"]
+
+
+class AliasSampler:
+    # Vose's alias method: O(n) build, O(1) per draw.
+    def __init__(self, choices, weights=None):
+        if not choices: raise ValueError("AliasSampler needs at least one choice.")
+        n = len(choices); weights = [max(0.0, float(w)) for w in (weights or [1.0] * n)]
+        if len(weights) != n: raise ValueError("choices and weights differ in length.")
+        total = sum(weights)
+        if total <= 0: weights = [1.0] * n; total = float(n)
+        self.choices = list(choices); self._prob = [0.0] * n; self._alias = [0] * n
+        scaled = [w * n / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]; large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self._prob[s] = scaled[s]; self._alias[s] = l; scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        for i in small + large: self._prob[i] = 1.0
+
+    def sample(self, rng=random):
+        i = rng.randrange(len(self.choices))
+        return self.choices[i] if rng.random() < self._prob[i] else self.choices[self._alias[i]]
+
+
+def bpm_bucket(style_profile):
+    # "fast", "slow" or None: all that recent_bpms contributes to the mood weights (needs at least 5 numeric BPMs).
+    numeric_bpms = [b for b in style_profile.get("recent_bpms", []) if isinstance(b, (int, float))]
+    if len(numeric_bpms) < 5: return None
+    avg_bpm = sum(numeric_bpms) / len(numeric_bpms); logging.debug(f"Avg BPM: {avg_bpm:.1f}")
+    return "fast" if avg_bpm > 115 else "slow" if avg_bpm < 90 else None
+
+
+def profile_version(style_profile, spotify_keywords=()):
+    # Samplers are rebuilt only when this changes: the counts, the BPM bucket and the trend keywords. A new BPM that
+    # keeps the average in the same bucket leaves the weights, and so the version, unchanged.
+    if not style_profile: return ("none", tuple(spotify_keywords))
+    relevant = {k: style_profile.get(k) for k in ("genre_counts", "instrument_counts", "mood_counts")}; relevant["bpm_bucket"] = bpm_bucket(style_profile)
+    return (json.dumps(relevant, sort_keys=True, default=str), tuple(spotify_keywords))
+
+
+def _count_weights(choices, counts, spotify_keywords, trend_boost):
+    weights = [counts.get(c, 0) + 1.0 for c in choices] if counts else [1.0] * len(choices)
+    return [w * trend_boost if (c in spotify_keywords and c in counts) else w for c, w in zip(choices, weights)]
+
+
+def _mood_weights(choices, style_profile, spotify_keywords):
+    weights = [1.0] * len(choices); bucket = bpm_bucket(style_profile)
+    for i, m in enumerate(choices):
+        if bucket == "fast" and m in FAST_MOODS: weights[i] *= 1.5
+        elif bucket == "slow" and m in SLOW_MOODS: weights[i] *= 1.5
+    mood_counts = style_profile.get("mood_counts", {}) or {}
+    for i, m in enumerate(choices):
+        weights[i] *= mood_counts.get(m, 0) + 1.0
+        if m in spotify_keywords and m in mood_counts: weights[i] *= 1.2
+    return weights
+
+
+class PromptSamplers:
+    # Compiled samplers for one profile version: a weighted and a uniform table per prompt dimension.
+    def __init__(self, genres, instruments, moods, templates, style_profile=None, spotify_keywords=()):
+        profile = style_profile or {}; trends = set(spotify_keywords)
+        self.templates = AliasSampler(templates or ["{mood} {genre} with {instrument}"])
+        self.uniform = {"genre": AliasSampler(genres or ["music"]), "instrument": AliasSampler(instruments or ["sound"]), "mood": AliasSampler(moods or ["neutral"])}
+        if not style_profile: self.weighted = dict(self.uniform); return
+        self.weighted = {
+            "genre": AliasSampler(genres, _count_weights(genres, profile.get("genre_counts", {}) or {}, trends, 1.5)) if genres else self.uniform["genre"],
+            "instrument": AliasSampler(instruments, _count_weights(instruments, profile.get("instrument_counts", {}) or {}, trends, 1.2)) if instruments else self.uniform["instrument"],
+            "mood": AliasSampler(moods, _mood_weights(moods, profile, trends)) if moods else self.uniform["mood"],
+        }
+
+    def prompt(self, rng=random):
+        # Returns (prompt, explored) where explored is True if any dimension was drawn uniformly.
+        picks = {}; explored = False
+        for dimension in ("genre", "instrument", "mood"):
+            explore = rng.random() < EXPLORATION_CHANCE; explored = explored or explore
+            picks[dimension] = (self.uniform if explore else self.weighted)[dimension].sample(rng)
+        return self.templates.sample(rng).format(**picks), explored
+
+
+class SamplerCache:
+    # Holds the samplers for the most recent profile version; compile() is a no-op while the version is unchanged.
+    def __init__(self, genres, instruments, moods, templates):
+        self._vocab = (genres, instruments, moods, templates); self._lock = threading.Lock(); self._version = None; self._samplers = None
+
+    def get(self, style_profile, spotify_keywords=()):
+        version = profile_version(style_profile, spotify_keywords)
+        with self._lock:
+            if self._samplers is None or version != self._version:
+                self._samplers = PromptSamplers(*self._vocab, style_profile=style_profile, spotify_keywords=spotify_keywords); self._version = version
+                logging.debug("Prompt samplers recompiled for new style profile version.")
+            return self._samplers, version
+
+
+class PromptQueue:
+    # Bounded stock of {"prompt", "seed", ...} entries. make_entries(n) -> (entries, version) produces new ones and
+    # current_version() identifies the profile they must match; entries from an older version are dropped on take().
+    def __init__(self, make_entries, current_version, maxsize=32, low_watermark=None):
+        self._make_entries = make_entries; self._current_version = current_version
+        self.maxsize = maxsize; self.low_watermark = maxsize // 2 if low_watermark is None else low_watermark
+        self._entries = deque(); self._lock = threading.Lock(); self._refill_needed = threading.Event(); self._thread = None
+
+    def _fill(self, count):
+        entries, version = self._make_entries(count)
+        with self._lock:
+            for entry in entries:
+                if len(self._entries) >= self.maxsize: break
+                self._entries.append((version, entry))
+
+    def _refill_loop(self):
+        while True:
+            self._refill_needed.wait(); self._refill_needed.clear()
+            try:
+                with self._lock: missing = self.maxsize - len(self._entries)
+                if missing > 0: self._fill(missing); logging.debug(f"Prompt queue refilled with {missing} entries.")
+            except Exception as e: logging.error(f"Prompt queue refill failed: {e}", exc_info=True)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive(): return
+        self._thread = threading.Thread(target=self._refill_loop, name="prompt-queue-refill", daemon=True); self._thread.start(); self._refill_needed.set()
+
+    def take(self, count):
+        # Returns `count` entries for the current profile version; any shortfall is generated inline (O(1) per entry).
+        version = self._current_version(); taken = []; stale = 0
+        with self._lock:
+            while self._entries and len(taken) < count:
+                entry_version, entry = self._entries.popleft()
+                if entry_version == version: taken.append(entry)
+                else: stale += 1
+            if stale: logging.info(f"Dropped {stale} queued prompts from an older style profile version.")
+            low = len(self._entries) <= self.low_watermark
+        if len(taken) < count:
+            entries, _ = self._make_entries(count - len(taken)); taken.extend(entries)
+        if low: self._refill_needed.set()
+        return taken
@@ -0,0 +1,72 @@
+# quota_model.py
+# Kaggle GPU quota accounting from measured run times. Every finished run (complete, error or cancelled) is recorded per
+# account with its trigger->finish time. The per-account duration model built from those records drives the quota
+# check, the account scheduler and the /usage forecast. Pure functions over plain state data; no Kaggle calls here.
+
+import math
+import statistics
+from datetime import datetime, timedelta
+
+
+def record_run(histories, account_index, seconds, status, batch_size, finished_iso, history_size=20):
+    # histories: state["kaggle_run_history"], {str(account_index): [run, ...]} with the newest run last.
+    runs = histories.setdefault(str(account_index), [])
+    runs.append({"seconds": round(seconds, 1), "status": status, "batch_size": batch_size, "tracks": None, "finished": finished_iso})
+    del runs[:-history_size]
+    return runs[-1]
+
+
+def _completed(runs, batch_size):
+    return [r for r in runs if r.get("status") == "complete" and r.get("batch_size") == batch_size and isinstance(r.get("seconds"), (int, float)) and r["seconds"] > 0]
+
+
+def expected_run_seconds(histories, account_index, batch_size, default_seconds):
+    # Median completed-run time of this account at this batch size, then of all accounts, then the configured estimate.
+    own = _completed(histories.get(str(account_index), []), batch_size)
+    if own: return statistics.median(r["seconds"] for r in own)
+    pooled = [r for runs in histories.values() for r in _completed(runs, batch_size)]
+    return statistics.median(r["seconds"] for r in pooled) if pooled else default_seconds
+
+
+def expected_tracks_per_run(histories, account_index, batch_size):
+    # Tracks a run actually delivers (batch runs can come back short); the batch size until downloads have been counted.
+    counted = [r["tracks"] for r in _completed(histories.get(str(account_index), []), batch_size) if isinstance(r.get("tracks"), int)]
+    return statistics.median(counted) if counted else batch_size
+
+
+def next_quota_reset(last_reset_iso, now):
+    # Mirrors the weekly reset in run_main_cycle: on a Monday (UTC), usage not yet reset since that Monday 00:00 is reset.
+    # Returns this Monday 00:00 while such a reset is due (<= now until the next cycle applies it), else the next Monday 00:00.
+    this_monday = (now - timedelta(days=now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0); last_reset = None
+    if last_reset_iso:
+        try: last_reset = datetime.fromisoformat(last_reset_iso)
+        except ValueError: pass
+    if now.weekday() == 0 and (last_reset is None or last_reset < this_monday): return this_monday
+    return this_monday + timedelta(days=7)
+
+
+def forecast_account(usage_entry, histories, account_index, now, quota_limit_hours, batch_size, default_run_seconds):
+    used_hours = usage_entry.get("gpu_hours_used_this_week", 0.0) if isinstance(usage_entry, dict) else 0.0
+    run_hours = expected_run_seconds(histories, account_index, batch_size, default_run_seconds) / 3600
+    tracks_per_run = expected_tracks_per_run(histories, account_index, batch_size)
+    hours_left = max(0.0, quota_limit_hours - used_hours); runs_left = int(hours_left // run_hours) if run_hours > 0 else 0
+    reset_at = next_quota_reset(usage_entry.get("last_reset_time") if isinstance(usage_entry, dict) else None, now)
+    runs_until_reset = max(0, math.floor((reset_at - now).total_seconds() / 3600 / run_hours)) if run_hours > 0 else 0
+    runs_before_reset = min(runs_left, runs_until_reset)
+    # With back-to-back runs from now: when the quota runs out, or None if the reset comes first.
+    exhausted_at = now + timedelta(hours=runs_left * run_hours) if runs_left <= runs_until_reset else None
+    return {"account_index": account_index, "used_hours": used_hours, "hours_left": hours_left, "run_hours": run_hours, "measured": bool(_completed(histories.get(str(account_index), []), batch_size)),
+            "tracks_per_run": tracks_per_run, "runs_left": runs_left, "tracks_left": int(runs_left * tracks_per_run),
+            "reset_at": reset_at, "runs_before_reset": runs_before_reset, "tracks_before_reset": int(runs_before_reset * tracks_per_run), "exhausted_at": exhausted_at}
+
+
+def quota_priority(forecast):
+    # Sort key: quota left at an account's reset is lost, so the account that resets first goes first (earliest
+    # deadline), then the one with the most tracks still obtainable before its reset.
+    return (forecast["reset_at"], -forecast["tracks_before_reset"], forecast["account_index"])
+
+
+def pick_account(forecasts):
+    # The forecast of the account to run next, or None if no account fits another run.
+    eligible = [f for f in forecasts if f["runs_left"] >= 1]
+    return min(eligible, key=quota_priority) if eligible else None
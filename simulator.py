@@ -0,0 +1,324 @@
+# simulator.py
+# Discrete-event capacity simulator. Runs the real orchestrator loop (main.run_orchestrator_iteration: quota reset,
+# account choice, slot scheduling, adaptive polls, intervention timeouts, uniqueness check) on a virtual clock against
+# a modelled Kaggle (queue delay, boot + per-track run time, run/trigger/poll/download failures, true weekly quota) and
+# a near-duplicate rate for generated tracks. Each policy runs in a fresh process and temp directory; a simulated week
+# takes seconds. Tracks are processed inline (the background pipeline is not started, its workers run on wall time).
+#
+#   python simulator.py                                                # current config, one week
+#   python simulator.py --policy 2acc:NUM_KAGGLE_ACCOUNTS=2 --policy single:KAGGLE_MULTI_SLOT_ENABLED=False
+#   python simulator.py --policy strict:UNIQUENESS_SIMILARITY_THRESHOLD=0.8 --duplicate-rate 0.2 --days 14 --json sim.json
+#
+# A policy overrides any upper-case setting main.py reads (config values, MAIN_LOOP_SLEEP_SECONDS, ...), values as Python literals.
+
+import argparse
+import ast
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from multiprocessing import get_context
+from types import SimpleNamespace
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_START = "2024-01-01T00:00:00+00:00"  # A Monday: the first cycle performs the weekly quota reset
+FINGERPRINT_LENGTH = 64
+QUOTA_EPSILON_SECONDS = 1.0
+
+
+# --- Virtual Clock ---
+class VirtualClock:
+    def __init__(self, start_ts):
+        self.now = start_ts; self._listeners = []
+
+    def on_advance(self, listener): self._listeners.append(listener)
+
+    def advance(self, seconds):
+        if seconds <= 0: return
+        start = self.now; self.now += seconds
+        for listener in self._listeners: listener(start, self.now)
+
+    def datetime(self): return datetime.fromtimestamp(self.now, tz=timezone.utc)
+
+
+def make_sim_datetime(clock):
+    # Replaces main.datetime: now() reads the virtual clock, everything else (fromisoformat, arithmetic) is unchanged.
+    class SimDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            current = clock.datetime()
+            return current.astimezone(tz) if tz else current.replace(tzinfo=None)
+    return SimDatetime
+
+
+class SimTime:
+    # Replaces utils.time: retry backoff sleeps advance the virtual clock instead of blocking.
+    def __init__(self, clock): self._clock = clock
+    def sleep(self, seconds): self._clock.advance(seconds)
+    def time(self): return self._clock.now
+    def monotonic(self): return self._clock.now
+    def __getattr__(self, name): return getattr(time, name)
+
+
+def week_start(ts):
+    day = datetime.fromtimestamp(ts, tz=timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (day - timedelta(days=day.weekday())).timestamp()
+
+
+# --- Kaggle Model ---
+class SimKaggle:
+    # One kernel per account. A trigger starts a run: queued for queue_delay, then boot + per-track GPU time (lognormal
+    # noise), then complete or error. The true weekly GPU quota is enforced the way Kaggle does it: a session is killed
+    # when the account's quota runs out, and a trigger on an exhausted account fails.
+    def __init__(self, clock, args, num_accounts, quota_hours):
+        self.clock = clock; self.args = args; self.num_accounts = num_accounts; self.quota_seconds = quota_hours * 3600
+        self.rng = random.Random(args.seed); self.runs = {}; self.all_runs = []; self.used = {}; self.fingerprints = []; self.tracks = {}
+        self.idle_with_quota = 0.0; self.idle_exhausted = 0.0; self.trigger_failures = 0; self.quota_refusals = 0
+        self.discarded = 0; self.charged_seconds = 0.0
+        clock.on_advance(self._account_time)
+
+    def _used(self, account_index, ts):
+        return self.used.get((account_index, week_start(ts)), 0.0)
+
+    def _account_time(self, start, end):
+        # Splits every account's wall time into GPU busy, idle with Kaggle quota left and idle because the quota is gone.
+        for i in range(self.num_accounts):
+            run = self.runs.get(i); busy = max(0.0, min(end, run["gpu_end"]) - max(start, run["gpu_start"])) if run else 0.0
+            idle = (end - start) - busy
+            if self._used(i, start) >= self.quota_seconds - QUOTA_EPSILON_SECONDS: self.idle_exhausted += idle
+            else: self.idle_with_quota += idle
+
+    def trigger(self, notebook_slug, params_dict, work_dir=".", account_index=0):
+        self.clock.advance(self.args.trigger_seconds); now = self.clock.now; rng = self.rng
+        current = self.runs.get(account_index)
+        if current and current["end"] > now: current["end"] = current["gpu_end"] = now; current["status"] = "cancelled"  # A new push replaces a running version
+        if rng.random() < self.args.trigger_failure_rate: self.trigger_failures += 1; return False
+        remaining = self.quota_seconds - self._used(account_index, now)
+        if remaining <= QUOTA_EPSILON_SECONDS: self.quota_refusals += 1; return False
+        batch = params_dict.get("batch") if isinstance(params_dict, dict) and "batch" in params_dict else [params_dict]
+        queue_delay = rng.expovariate(1 / self.args.queue_minutes / 60) if self.args.queue_minutes > 0 else 0.0
+        gpu_seconds = (self.args.boot_minutes + self.args.track_minutes * len(batch)) * 60 * rng.lognormvariate(0, self.args.run_time_sigma)
+        status = "complete"
+        if rng.random() < self.args.run_failure_rate: gpu_seconds *= rng.random(); status = "error"
+        if gpu_seconds > remaining: gpu_seconds = remaining; status = "error"  # Quota ran out mid-session
+        gpu_start = now + queue_delay; run = {"account_index": account_index, "triggered": now, "gpu_start": gpu_start, "gpu_end": gpu_start + gpu_seconds, "end": gpu_start + gpu_seconds,
+                                              "status": status, "batch_size": len(batch), "gpu_seconds": gpu_seconds, "delivered": 0, "uploaded": 0}
+        key = (account_index, week_start(now)); self.used[key] = self.used.get(key, 0.0) + gpu_seconds
+        self.runs[account_index] = run; self.all_runs.append(run); return True
+
+    def status(self, account_index):
+        run = self.runs.get(account_index)
+        if run is None: return "complete"
+        now = self.clock.now
+        if now < run["gpu_start"]: return "queued"
+        if now < run["end"]: return "running"
+        return run["status"]
+
+    def check_statuses(self, kernels):
+        if not kernels: return {}
+        self.clock.advance(self.args.poll_seconds)
+        return {i: (None if self.rng.random() < self.args.poll_failure_rate else self.status(i)) for i in kernels}
+
+    def _fingerprint(self):
+        # A fresh track, or with duplicate_rate a near-copy of an earlier one (similarity drawn from [duplicate_similarity, 1]).
+        rng = self.rng
+        if self.fingerprints and rng.random() < self.args.duplicate_rate:
+            fingerprint = list(rng.choice(self.fingerprints)); changed = round((1 - rng.uniform(self.args.duplicate_similarity, 1.0)) * FINGERPRINT_LENGTH)
+            for position in rng.sample(range(FINGERPRINT_LENGTH), changed): fingerprint[position] = rng.getrandbits(32)
+        else: fingerprint = [rng.getrandbits(32) for _ in range(FINGERPRINT_LENGTH)]
+        self.fingerprints.append(fingerprint); return fingerprint
+
+    def _write_track(self, run, mp3_path, json_path, prompt):
+        with open(mp3_path, 'wb') as f: f.write(b"sim")
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump({"prompt": prompt, "estimated_bpm": self.rng.randint(70, 160), "estimated_key": "C", "duration": 5.0, "mp3_check_ok": True, "fingerprint": self._fingerprint(), "fingerprint_error": None}, f)
+        self.tracks[os.path.abspath(mp3_path)] = run; run["delivered"] += 1
+
+    def download(self, notebook_slug, destination_dir=".", download_image=False, account_index=0, batch_size=None):
+        # Same return shapes and IncompleteOutputError as utils.download_kaggle_output. A transfer fails with
+        # download_failure_rate per attempt; a track the run did not produce (track_failure_rate) stays missing on retries.
+        from downloads import IncompleteOutputError
+        run = self.runs.get(account_index); self.clock.advance(self.args.download_seconds * (batch_size or 1))
+        if run is None or run["status"] != "complete": raise IncompleteOutputError("no finished run output")
+        if self.rng.random() < self.args.download_failure_rate: raise IncompleteOutputError("simulated transfer failure")
+        if "missing" not in run: run["missing"] = {n for n in range(batch_size or 1) if self.rng.random() < self.args.track_failure_rate}
+        os.makedirs(destination_dir, exist_ok=True)
+        if not batch_size:
+            if run["missing"]: raise IncompleteOutputError("output.mp3 not in the kernel output")
+            mp3_path = os.path.join(destination_dir, "output.mp3"); json_path = os.path.join(destination_dir, "result.json")
+            self._write_track(run, mp3_path, json_path, None); return mp3_path, json_path, None
+        outputs = []
+        for n in range(batch_size):
+            if n in run["missing"]: continue
+            mp3_path = os.path.join(destination_dir, f"output_{n}.mp3"); json_path = os.path.join(destination_dir, f"result_{n}.json")
+            self._write_track(run, mp3_path, json_path, None); outputs.append({"index": n, "mp3": mp3_path, "json": json_path, "sha256": None})
+        if not outputs: raise IncompleteOutputError("no complete batch track in the kernel output")
+        return outputs
+
+    def upload(self, service, local_filepath, gdrive_folder_id, gdrive_filename):
+        self.clock.advance(self.args.upload_seconds)
+        if self.rng.random() < self.args.upload_failure_rate: return None
+        run = self.tracks.get(os.path.abspath(local_filepath))
+        if run is not None: run["uploaded"] += 1
+        return f"sim-{len(self.tracks)}"
+
+
+# --- Policy Run (child process) ---
+def apply_policy(main, settings):
+    for name, value in settings.items():
+        if not name.isupper() or not hasattr(main, name): raise ValueError(f"Unknown setting '{name}' (not a main.py/config value)")
+        setattr(main, name, value)
+
+
+def run_policy(name, settings, args):
+    # Executed in a fresh process: imports main inside a temp working directory, patches the external calls and the
+    # clocks, then runs run_orchestrator_iteration until the simulated period ends.
+    work_dir = tempfile.mkdtemp(prefix=f"musicai-sim-{name}-"); os.chdir(work_dir); sys.path.insert(0, REPO_DIR)
+    os.environ.update({"GOOGLE_CREDS_JSON": json.dumps({"installed": {}}), "TELEGRAM_BOT_TOKEN": "", "TELEGRAM_CHAT_ID": ""})
+    for i in range(1, 5): os.environ[f"KAGGLE_JSON_{i}"] = json.dumps({"username": f"sim{i}", "key": "sim"})
+    try:
+        import main, utils
+        logging.getLogger().setLevel(getattr(logging, args.log_level))
+        apply_policy(main, settings)
+        start_ts = datetime.fromisoformat(args.start).timestamp(); end_ts = start_ts + args.days * 86400
+        clock = VirtualClock(start_ts); kaggle = SimKaggle(clock, args, main.NUM_KAGGLE_ACCOUNTS, main.KAGGLE_WEEKLY_GPU_QUOTA)
+        main.datetime = make_sim_datetime(clock); utils.time = SimTime(clock)
+        main.setup_kaggle_api = lambda account_index: True; main.kaggle_health_check = lambda account_index: True
+        main.trigger_kaggle_notebook = kaggle.trigger; main.check_kaggle_statuses = kaggle.check_statuses; main.download_kaggle_output = kaggle.download
+        main.upload_to_gdrive = kaggle.upload; main.start_gdrive_cleanup = lambda current_state, gdrive_service: True
+        main.send_telegram_message = lambda message, level="INFO", reply_markup=None: True; main.telegram_health_check = lambda: True
+        main.LOCAL_ANALYSIS_ENABLED = False; main.LOCAL_FINGERPRINT_ENABLED = False  # The simulated MP3s are placeholders; result.json carries the fingerprint
+        charge_kaggle_run = main.charge_kaggle_run; check_track_uniqueness = main.check_track_uniqueness
+        def charge(current_state, job, account_index, now_dt, status):
+            charged = bool(job.get("run_charged_time")); run = charge_kaggle_run(current_state, job, account_index, now_dt, status)
+            if not charged: kaggle.charged_seconds += run["seconds"]  # A repeat charge returns the first record
+            return run
+        def uniqueness(mp3_path, analysis_data, prompt, track_key=None):
+            proceed, error = check_track_uniqueness(mp3_path, analysis_data, prompt, track_key=track_key); kaggle.discarded += not proceed; return proceed, error
+        main.charge_kaggle_run = charge; main.check_track_uniqueness = uniqueness
+        gdrive = SimpleNamespace(about=lambda: SimpleNamespace(get=lambda fields=None: SimpleNamespace(execute=lambda: {"storageQuota": {}})))
+        state = main.load_state(main.STATE_FILE_PATH); state["status"] = "running"
+        state["kaggle_usage"] = [{"account_index": i, "gpu_hours_used_this_week": 0.0, "last_reset_time": None} for i in range(main.NUM_KAGGLE_ACCOUNTS)]
+        main.save_state(state, main.STATE_FILE_PATH)
+        status_seconds = {}; current = {"status": "running"}; interventions = 0; operator_restarts = 0; iterations = 0; wall_started = time.perf_counter()
+        def status_time(start, end): status_seconds[current["status"]] = status_seconds.get(current["status"], 0.0) + end - start
+        clock.on_advance(status_time)
+        while clock.now < end_ts:
+            iterations += 1; sleep_seconds = main.run_orchestrator_iteration(gdrive); state = main.load_state(main.STATE_FILE_PATH); status = state.get("status")
+            if status == "error" and current["status"] != "error": interventions += 1
+            current["status"] = status
+            if sleep_seconds is None:
+                # The loop thread would exit on 'stopped' (e.g. after a weekly reset from stopped_exhausted) until someone sends /start.
+                if args.operator_delay_minutes is None: clock.advance(end_ts - clock.now); break
+                clock.advance(min(args.operator_delay_minutes * 60, end_ts - clock.now))
+                state["status"] = "running"; state["last_error"] = None; main.save_state(state, main.STATE_FILE_PATH); operator_restarts += 1; current["status"] = "running"; continue
+            clock.advance(min(sleep_seconds, end_ts - clock.now))
+        state = main.load_state(main.STATE_FILE_PATH); main.close_state_stores()
+        return summarize(name, settings, args, main, kaggle, state, status_seconds, interventions, operator_restarts, iterations, time.perf_counter() - wall_started)
+    finally:
+        os.chdir(REPO_DIR)
+        if not args.keep_work_dir: shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def summarize(name, settings, args, main, kaggle, state, status_seconds, interventions, operator_restarts, iterations, wall_seconds):
+    runs = kaggle.all_runs; uploaded = sum(r["uploaded"] for r in runs); week_factor = 7 / args.days
+    gpu_hours = sum(r["gpu_seconds"] for r in runs) / 3600
+    # GPU time that produced nothing uploaded: failed/cancelled runs, short batches, lost downloads, discarded or failed uploads.
+    wasted_hours = sum(r["gpu_seconds"] * (1 - r["uploaded"] / r["batch_size"]) for r in runs) / 3600
+    delivered = sum(r["delivered"] for r in runs)
+    return {"policy": name, "settings": settings, "days": args.days, "tracks": uploaded, "tracks_per_week": uploaded * week_factor,
+            "runs": len(runs), "runs_failed": sum(1 for r in runs if r["status"] != "complete"), "trigger_failures": kaggle.trigger_failures, "quota_refusals": kaggle.quota_refusals,
+            "tracks_delivered": delivered, "tracks_discarded": kaggle.discarded, "tracks_lost": delivered - uploaded - kaggle.discarded, "gpu_hours": gpu_hours, "gpu_hours_wasted": wasted_hours,
+            "gpu_hours_per_track": gpu_hours / uploaded if uploaded else None, "quota_hours": main.KAGGLE_WEEKLY_GPU_QUOTA * main.NUM_KAGGLE_ACCOUNTS * args.days / 7,
+            "account_idle_hours_with_quota": kaggle.idle_with_quota / 3600, "account_idle_hours_exhausted": kaggle.idle_exhausted / 3600,
+            "status_hours": {status: seconds / 3600 for status, seconds in sorted(status_seconds.items())}, "interventions": interventions, "operator_restarts": operator_restarts,
+            "orchestrator_charged_hours": kaggle.charged_seconds / 3600, "iterations": iterations, "wall_seconds": wall_seconds}
+
+
+# --- Report ---
+REPORT_COLUMNS = [("tracks/wk", "tracks_per_week", "{:.0f}"), ("runs", "runs", "{}"), ("failed", "runs_failed", "{}"), ("discard", "tracks_discarded", "{}"), ("lost", "tracks_lost", "{}"),
+                  ("GPU h", "gpu_hours", "{:.1f}"), ("wasted h", "gpu_hours_wasted", "{:.1f}"), ("idle h", "account_idle_hours_with_quota", "{:.1f}"), ("exhaust h", "account_idle_hours_exhausted", "{:.1f}"),
+                  ("interv", "interventions", "{}"), ("wall s", "wall_seconds", "{:.1f}")]
+
+
+def format_report(results):
+    width = max([len(r["policy"]) for r in results] + [6])
+    lines = [f"{'policy':<{width}} " + " ".join(f"{title:>9}" for title, _, _ in REPORT_COLUMNS)]
+    for r in results: lines.append(f"{r['policy']:<{width}} " + " ".join(f"{fmt.format(r[key]) if r[key] is not None else '-':>9}" for _, key, fmt in REPORT_COLUMNS))
+    lines.append("")
+    for r in results:
+        status = ", ".join(f"{status} {hours:.1f}h" for status, hours in r["status_hours"].items())
+        lines.append(f"{r['policy']}: {r['settings'] or 'config defaults'}; orchestrator charged {r['orchestrator_charged_hours']:.1f}h of {r['quota_hours']:.0f}h quota; status time: {status}; {r['iterations']} loop passes.")
+    return "\n".join(lines)
+
+
+def parse_policy(spec):
+    # "name:KEY=VALUE,KEY=VALUE" -> (name, {KEY: literal}); a bare name runs the current config under that name.
+    name, _, assignments = spec.partition(":"); settings = {}
+    for assignment in filter(None, assignments.split(",")):
+        key, _, value = assignment.partition("=")
+        try: settings[key.strip()] = ast.literal_eval(value.strip())
+        except (ValueError, SyntaxError): settings[key.strip()] = value.strip()
+    return name, settings
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate the orchestrator on a virtual clock and report weekly capacity per policy.")
+    parser.add_argument("--policy", action="append", default=[], metavar="NAME:KEY=VALUE,...", help="Settings to compare (repeatable); default: the current config")
+    parser.add_argument("--days", type=float, default=7.0)
+    parser.add_argument("--start", default=DEFAULT_START, help="Simulated start time (ISO 8601, UTC)")
+    parser.add_argument("--seed", type=int, default=1234, help="Same seed = same Kaggle behaviour for every policy")
+    parser.add_argument("--queue-minutes", type=float, default=3.0, help="Mean Kaggle queue delay before a session starts")
+    parser.add_argument("--boot-minutes", type=float, default=None, help="GPU minutes per run before the first track (default: ESTIMATED_KAGGLE_RUN_HOURS)")
+    parser.add_argument("--track-minutes", type=float, default=None, help="GPU minutes per track (default: ESTIMATED_KAGGLE_TRACK_HOURS)")
+    parser.add_argument("--run-time-sigma", type=float, default=0.15, help="Lognormal spread of run times")
+    parser.add_argument("--run-failure-rate", type=float, default=0.03)
+    parser.add_argument("--trigger-failure-rate", type=float, default=0.01)
+    parser.add_argument("--poll-failure-rate", type=float, default=0.02)
+    parser.add_argument("--download-failure-rate", type=float, default=0.01)
+    parser.add_argument("--track-failure-rate", type=float, default=0.02, help="Probability a single track of a finished run is missing/corrupt")
+    parser.add_argument("--upload-failure-rate", type=float, default=0.01)
+    parser.add_argument("--duplicate-rate", type=float, default=0.1, help="Share of generated tracks that are near-copies of an earlier one")
+    parser.add_argument("--duplicate-similarity", type=float, default=0.75, help="Lowest similarity of a near-copy (uniform up to 1.0)")
+    parser.add_argument("--trigger-seconds", type=float, default=40.0)
+    parser.add_argument("--poll-seconds", type=float, default=1.0)
+    parser.add_argument("--download-seconds", type=float, default=8.0, help="Per track")
+    parser.add_argument("--upload-seconds", type=float, default=5.0, help="Per track")
+    parser.add_argument("--operator-delay-minutes", type=float, default=None, help="Model someone sending /start this long after the loop stops (default: nobody)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Policies simulated in parallel")
+    parser.add_argument("--log-level", default="ERROR", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"])
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--keep-work-dir", action="store_true")
+    args = parser.parse_args(argv)
+    policies = [parse_policy(spec) for spec in args.policy] or [("current", {})]
+    if len({name for name, _ in policies}) != len(policies): parser.error("Policy names must be unique.")
+    return args, policies
+
+
+def main(argv=None):
+    args, policies = parse_args(argv)
+    if args.boot_minutes is None or args.track_minutes is None:
+        sys.path.insert(0, REPO_DIR); import config
+        if args.boot_minutes is None: args.boot_minutes = config.ESTIMATED_KAGGLE_RUN_HOURS * 60
+        if args.track_minutes is None: args.track_minutes = config.ESTIMATED_KAGGLE_TRACK_HOURS * 60
+    # One process per policy: main.py keeps module-level state (prompt queue, fingerprint index, clocks) that must start fresh.
+    with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(policies))), mp_context=get_context("spawn"), max_tasks_per_child=1) as executor:
+        futures = [executor.submit(run_policy, name, settings, args) for name, settings in policies]
+        results = []
+        for (name, _), future in zip(policies, futures):
+            try: results.append(future.result())
+            except Exception as e: print(f"Policy '{name}' failed: {type(e).__name__}: {e}", file=sys.stderr)
+    if results: print(format_report(results))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f: json.dump({"args": {k: v for k, v in vars(args).items()}, "results": results}, f, indent=1)
+    return 0 if len(results) == len(policies) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
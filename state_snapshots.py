@@ -0,0 +1,201 @@
+# state_snapshots.py
+# Content-addressed state backups. A snapshot is keyed by the state's checksum (the `_checksum` save_state writes), so
+# an unchanged state costs no upload. A changed state is stored gzip-compressed, either in full or as a delta of the
+# top-level keys against the last full snapshot. Every snapshot file is self-describing (checksum, time, base), and
+# a local manifest maps times to snapshots. restore_state() rebuilds the state at any point in time from downloaded
+# snapshot files: `python state_snapshots.py restore OUTPUT DIR [--at ISO_TIME]`. Drive retention goes through prunable(),
+# which never gives up a full snapshot that a kept delta is based on.
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import threading
+from datetime import datetime, timezone
+
+MANIFEST_NAME = "manifest.json"
+BASE_NAME = "base.json.gz"        # Local copy of the last full snapshot, which deltas are computed against
+FULL_EVERY = 24                   # A full snapshot after this many deltas...
+FULL_DELTA_RATIO = 0.5            # ...or once a delta would be this large relative to the full state
+MANIFEST_MAX_ENTRIES = 2000
+SNAPSHOT_NAME_PATTERN = re.compile(r"^state_[0-9a-f]{16}(\.delta)?\.json\.gz$")
+
+
+def state_checksum(state):
+    # Same canonical form as save_state's `_checksum`.
+    payload = {k: v for k, v in state.items() if k != '_checksum'}
+    return hashlib.sha256(json.dumps(payload, separators=(',', ':'), sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def snapshot_name(checksum, kind): return f"state_{checksum[:16]}.json.gz" if kind == "full" else f"state_{checksum[:16]}.delta.json.gz"
+
+
+def is_snapshot_name(name): return SNAPSHOT_NAME_PATTERN.match(name) is not None
+
+
+def _write_gzip_json(path, data):
+    temp_path = path + ".tmp"
+    with gzip.open(temp_path, 'wt', encoding='utf-8') as f: json.dump(data, f, separators=(',', ':'))
+    os.replace(temp_path, path)
+
+
+def _read_gzip_json(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f: return json.load(f)
+
+
+class SnapshotBackup:
+    def __init__(self, snapshot_dir, full_every=FULL_EVERY):
+        self.snapshot_dir = snapshot_dir; self.full_every = full_every
+        self.manifest_path = os.path.join(snapshot_dir, MANIFEST_NAME); self.base_path = os.path.join(snapshot_dir, BASE_NAME)
+        self.manifest = self._load_manifest(); self._lock = threading.Lock()  # backup() and the cleanup thread share the manifest
+
+    # --- Manifest ---
+    def _load_manifest(self):
+        # {"entries": [{"time", "checksum", "kind", "name", "base", "file_id"}, ...] oldest first}
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f: manifest = json.load(f)
+            if isinstance(manifest, dict) and isinstance(manifest.get("entries"), list): return manifest
+        except FileNotFoundError: pass
+        except (OSError, ValueError) as e: logging.error(f"Failed load snapshot manifest '{self.manifest_path}': {e}. Starting a new one.")
+        return {"entries": []}
+
+    def _save_manifest(self):
+        del self.manifest["entries"][:-MANIFEST_MAX_ENTRIES]
+        temp_path = self.manifest_path + ".tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f: json.dump(self.manifest, f, indent=1)
+            os.replace(temp_path, self.manifest_path); return True
+        except OSError as e: logging.error(f"Failed save snapshot manifest '{self.manifest_path}': {e}"); return False
+
+    def _load_base(self):
+        # The last full snapshot's payload, if it is still the one the manifest refers to.
+        fulls = [e for e in self.manifest["entries"] if e["kind"] == "full"]
+        if not fulls or not os.path.exists(self.base_path): return None
+        try: base = _read_gzip_json(self.base_path)
+        except (OSError, ValueError) as e: logging.warning(f"Snapshot base unreadable ({e}). Next snapshot is full."); return None
+        return base if base.get("checksum") == fulls[-1]["checksum"] else None
+
+    # --- Backup ---
+    def backup(self, state_path, upload):
+        # upload(local_path, name) -> Drive file ID or None. Returns the manifest entry for this state, or None on failure.
+        # An unchanged state (or one identical to an earlier snapshot) is recorded without uploading anything.
+        with self._lock: return self._backup(state_path, upload)
+
+    def _backup(self, state_path, upload):
+        try:
+            with open(state_path, 'r', encoding='utf-8') as f: state = json.load(f)
+        except (OSError, ValueError) as e: logging.error(f"State snapshot: cannot read '{state_path}': {e}"); return None
+        state.pop('_checksum', None); checksum = state_checksum(state); now_iso = datetime.now(timezone.utc).isoformat()
+        entries = self.manifest["entries"]
+        if entries and entries[-1]["checksum"] == checksum: logging.info(f"State unchanged since snapshot {entries[-1]['name']}. No upload."); return entries[-1]
+        known = next((e for e in reversed(entries) if e["checksum"] == checksum), None)
+        if known:
+            entry = dict(known, time=now_iso); entries.append(entry); self._save_manifest()
+            logging.info(f"State matches earlier snapshot {known['name']}. Recorded without upload."); return entry
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        base = self._load_base(); deltas_since_full = 0
+        for e in reversed(entries):
+            if e["kind"] == "full": break
+            deltas_since_full += 1
+        payload = None
+        if base is not None and deltas_since_full < self.full_every:
+            base_state = base["state"]
+            delta = {"format": "delta", "checksum": checksum, "time": now_iso, "base": base["checksum"],
+                     "set": {k: v for k, v in state.items() if k not in base_state or base_state[k] != v}, "delete": [k for k in base_state if k not in state]}
+            if len(json.dumps(delta, separators=(',', ':'))) < FULL_DELTA_RATIO * len(json.dumps(state, separators=(',', ':'))): payload = delta
+        if payload is None: payload = {"format": "full", "checksum": checksum, "time": now_iso, "state": state}
+        kind = payload["format"]; name = snapshot_name(checksum, kind); local_path = os.path.join(self.snapshot_dir, name)
+        try: _write_gzip_json(local_path, payload)
+        except OSError as e: logging.error(f"State snapshot: failed write '{local_path}': {e}"); return None
+        size = os.path.getsize(local_path); file_id = upload(local_path, name)
+        if not file_id:
+            logging.error(f"State snapshot upload of '{name}' failed. Next backup retries."); os.remove(local_path); return None
+        if kind == "full": os.replace(local_path, self.base_path)
+        else: os.remove(local_path)
+        entry = {"time": now_iso, "checksum": checksum, "kind": kind, "name": name, "base": payload.get("base"), "file_id": file_id}
+        entries.append(entry); self._save_manifest()
+        logging.info(f"Uploaded {kind} state snapshot '{name}' ({size} bytes compressed).")
+        return entry
+
+    # --- Retention ---
+    def prunable(self, names, keep_seconds, now=None):
+        # The subset of `names` (snapshot files on Drive) that no restore from the last keep_seconds needs: every entry
+        # since then, the entry in effect at the cutoff, and the full base of each of those deltas stay. Names the manifest
+        # does not know are never returned, so a lost manifest keeps everything rather than guessing.
+        now = now or datetime.now(timezone.utc); cutoff = now.timestamp() - keep_seconds
+        with self._lock:
+            entries = self.manifest["entries"]
+            needed = set(); known = {e["name"] for e in entries}
+            in_effect = [e for e in entries if datetime.fromisoformat(e["time"]).timestamp() <= cutoff][-1:]
+            for e in in_effect + [e for e in entries if datetime.fromisoformat(e["time"]).timestamp() > cutoff]:
+                needed.add(e["name"])
+                if e["kind"] == "delta": needed.add(snapshot_name(e["base"], "full"))
+        return {name for name in names if name in known and name not in needed}
+
+    def forget(self, names):
+        # Drops manifest entries whose file (or base) was deleted from Drive; they can no longer be restored.
+        names = set(names)
+        if not names: return
+        with self._lock:
+            entries = self.manifest["entries"]
+            self.manifest["entries"] = [e for e in entries if e["name"] not in names and not (e["kind"] == "delta" and snapshot_name(e["base"], "full") in names)]
+            logging.info(f"Forgot {len(entries) - len(self.manifest['entries'])} state snapshot entries after cleanup."); self._save_manifest()
+
+
+# --- Restore ---
+def _scan_snapshots(directory):
+    # Manifest-like entries read from the snapshot files themselves, for when the manifest is lost.
+    entries = []
+    for name in sorted(os.listdir(directory)):
+        if not (name.startswith("state_") and name.endswith(".json.gz")): continue
+        try: payload = _read_gzip_json(os.path.join(directory, name))
+        except (OSError, ValueError) as e: logging.warning(f"Skipping unreadable snapshot {name}: {e}"); continue
+        entries.append({"time": payload["time"], "checksum": payload["checksum"], "kind": payload["format"], "name": name, "base": payload.get("base")})
+    return sorted(entries, key=lambda e: e["time"])
+
+
+def restore_state(directory, at=None, manifest_path=None):
+    # The state as of `at` (aware datetime; latest if None) from snapshot files in `directory`, or None if unavailable.
+    entries = None
+    if manifest_path and os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f: entries = json.load(f).get("entries")
+    if entries is None: entries = _scan_snapshots(directory)
+    candidates = [e for e in entries if at is None or datetime.fromisoformat(e["time"]) <= at]
+    if not candidates: logging.error(f"No state snapshot at or before {at}."); return None
+    entry = candidates[-1]
+    try:
+        payload = _read_gzip_json(os.path.join(directory, entry["name"]))
+        if payload["format"] == "full": state = payload["state"]
+        else:
+            state = dict(_read_gzip_json(os.path.join(directory, snapshot_name(payload["base"], "full")))["state"])
+            for key in payload["delete"]: state.pop(key, None)
+            state.update(payload["set"])
+    except (OSError, ValueError, KeyError) as e: logging.error(f"Failed restore snapshot {entry['name']}: {e}"); return None
+    if state_checksum(state) != entry["checksum"]: logging.error(f"Restored state does not match checksum of {entry['name']}."); return None
+    logging.info(f"Restored state from {entry['kind']} snapshot {entry['name']} taken {entry['time']}.")
+    return state
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Restore the orchestrator state from downloaded snapshot files.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    restore = commands.add_parser("restore", help="Write the state as of a point in time to OUTPUT.")
+    restore.add_argument("output"); restore.add_argument("directory", help="Directory holding the downloaded state_*.json.gz files")
+    restore.add_argument("--at", help="ISO time (UTC if no offset); latest snapshot if omitted")
+    restore.add_argument("--manifest", help="Manifest to use instead of reading every snapshot file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
+    args = parse_args()
+    at = datetime.fromisoformat(args.at) if args.at else None
+    if at is not None and at.tzinfo is None: at = at.replace(tzinfo=timezone.utc)
+    state = restore_state(args.directory, at, args.manifest)
+    if state is None: sys.exit(1)
+    state['_checksum'] = state_checksum(state)
+    with open(args.output, 'w', encoding='utf-8') as f: json.dump(state, f, indent=4)
@@ -0,0 +1,159 @@
+# state_store.py
+# Single in-process owner of the orchestrator state. Reads are served from an in-memory snapshot; each write appends
+# only the changed top-level keys to an append-only journal (one checksummed JSON record per line). The full state
+# file is rewritten only on compaction, so a save costs about the size of what changed rather than the whole document.
+# load() hands out a TrackedState that copies a value only when the caller touches it, and save() looks only at the keys
+# that were touched, so neither side walks the whole state.
+
+import copy
+import hashlib
+import json
+import logging
+import os
+import threading
+
+JOURNAL_SUFFIX = ".journal"
+COMPACT_EVERY_RECORDS = 200        # Rewrite the snapshot and truncate the journal after this many records...
+COMPACT_MAX_JOURNAL_BYTES = 1 << 20  # ...or once the journal grows past this size
+
+
+def _record_checksum(payload):
+    return hashlib.sha256(json.dumps(payload, separators=(',', ':'), sort_keys=True).encode('utf-8')).hexdigest()
+
+
+_IMMUTABLE_TYPES = (str, int, float, bool, type(None))
+
+
+class TrackedState(dict):
+    # Shallow copy of the store's state. A mutable top-level value is deep-copied the first time it is handed out, so
+    # the caller can change it in place without touching the store's copy; `touched` collects those keys plus every
+    # key assigned or deleted. save() compares and journals only the touched keys.
+    def __init__(self, snapshot):
+        super().__init__(snapshot); self.touched = set(); self._owned = set()
+
+    def _own(self, key):
+        value = dict.__getitem__(self, key)
+        if key not in self._owned and not isinstance(value, _IMMUTABLE_TYPES):
+            value = copy.deepcopy(value); dict.__setitem__(self, key, value); self._owned.add(key); self.touched.add(key)
+        return value
+
+    def __getitem__(self, key): return self._own(key)
+    def get(self, key, default=None): return self._own(key) if key in self else default
+    def __setitem__(self, key, value): dict.__setitem__(self, key, value); self._owned.add(key); self.touched.add(key)
+    def __delitem__(self, key): dict.__delitem__(self, key); self._owned.discard(key); self.touched.add(key)
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default: return default[0]
+            raise KeyError(key)
+        value = self._own(key); del self[key]; return value
+
+    def popitem(self):
+        if not self: raise KeyError("popitem(): dictionary is empty")
+        key = next(reversed(self)); return key, self.pop(key)
+
+    def setdefault(self, key, default=None):
+        if key in self: return self[key]
+        self[key] = default; return default
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items(): self[key] = value
+
+    def clear(self):
+        for key in list(self): del self[key]
+
+    def values(self): return [self[key] for key in self]
+    def items(self): return [(key, self[key]) for key in self]
+    def copy(self): return {key: self[key] for key in self}
+    def __deepcopy__(self, memo): return {key: copy.deepcopy(dict.__getitem__(self, key), memo) for key in self}
+
+
+class StateStore:
+    def __init__(self, filepath, snapshot_loader, snapshot_writer, compact_every=COMPACT_EVERY_RECORDS, compact_max_bytes=COMPACT_MAX_JOURNAL_BYTES):
+        # snapshot_loader(filepath) -> dict reads and validates the snapshot; snapshot_writer(state, filepath) -> bool writes it atomically.
+        self.filepath = filepath; self.journal_path = filepath + JOURNAL_SUFFIX
+        self._snapshot_loader = snapshot_loader; self._snapshot_writer = snapshot_writer
+        self.compact_every = compact_every; self.compact_max_bytes = compact_max_bytes
+        self._lock = threading.RLock(); self._state = None; self._seq = 0; self._journal_records = 0; self._journal_file = None
+
+    # --- Loading ---
+    def _replay_journal(self, state):
+        if not os.path.exists(self.journal_path): return 0
+        replayed = 0
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line: continue
+                try:
+                    record = json.loads(line); payload = record["payload"]
+                    if _record_checksum(payload) != record.get("checksum"): raise ValueError("checksum mismatch")
+                except (ValueError, KeyError, TypeError) as e:
+                    # A torn last write is expected after a crash; anything after it is untrusted and dropped.
+                    logging.error(f"State journal record {line_no} invalid ({e}). Ignoring it and the rest of the journal."); break
+                state.update(payload.get("set", {}))
+                for key in payload.get("del", []): state.pop(key, None)
+                self._seq = max(self._seq, payload.get("seq", 0)); replayed += 1
+        return replayed
+
+    def _ensure_loaded(self):
+        if self._state is not None: return
+        state = self._snapshot_loader(self.filepath); state.pop('_checksum', None)
+        try: replayed = self._replay_journal(state)
+        except OSError as e: logging.error(f"Failed read state journal '{self.journal_path}': {e}", exc_info=True); replayed = 0
+        self._state = state; self._journal_records = replayed
+        logging.info(f"State store loaded {self.filepath} (+{replayed} journal records).")
+        if replayed: self.compact()
+
+    def load(self):
+        # Returns a TrackedState: callers may mutate it freely and hand it back to save(). The store never changes one of
+        # its values in place (save() swaps in new ones), so values not yet copied can be shared with it.
+        with self._lock:
+            self._ensure_loaded()
+            return TrackedState(self._state)
+
+    # --- Writing ---
+    def _append(self, payload):
+        if self._journal_file is None: self._journal_file = open(self.journal_path, 'a', encoding='utf-8')
+        self._journal_file.write(json.dumps({"payload": payload, "checksum": _record_checksum(payload)}, separators=(',', ':')) + "\n"); self._journal_file.flush()
+
+    def save(self, state_data):
+        with self._lock:
+            self._ensure_loaded()
+            # A TrackedState names the keys that may differ; any other dict is compared key by key.
+            keys = state_data.touched if isinstance(state_data, TrackedState) else set(state_data) | set(self._state)
+            changed = {}; deleted = []
+            for key in keys - {'_checksum'}:
+                if key not in state_data:
+                    if key in self._state: deleted.append(key)
+                    continue
+                value = dict.__getitem__(state_data, key)
+                if key not in self._state or self._state[key] != value: changed[key] = value
+            if not changed and not deleted: logging.debug("State unchanged. Nothing to journal."); return True
+            self._seq += 1; payload = {"seq": self._seq, "set": changed, "del": deleted}
+            try: self._append(payload)
+            except (TypeError, ValueError) as e: logging.critical(f"State not serializable, not saved: {e}", exc_info=True); self._seq -= 1; return False
+            except OSError as e: logging.critical(f"File I/O error appending state journal: {e}", exc_info=True); self._seq -= 1; return False
+            self._state.update(copy.deepcopy(changed))
+            for key in deleted: self._state.pop(key, None)
+            self._journal_records += 1
+            logging.debug(f"State journaled: seq {self._seq}, changed {sorted(changed)}{f', deleted {deleted}' if deleted else ''}.")
+            if self._journal_records >= self.compact_every or (self._journal_file and self._journal_file.tell() >= self.compact_max_bytes): self.compact()
+            return True
+
+    def compact(self):
+        # Writes the full snapshot, then empties the journal. Replaying a stale journal over a newer snapshot is harmless
+        # (records carry whole top-level values), so a crash between the two steps loses nothing.
+        with self._lock:
+            if self._state is None: return False
+            if not self._snapshot_writer(copy.deepcopy(self._state), self.filepath): logging.error("State compaction failed. Journal kept."); return False
+            try:
+                if self._journal_file is not None: self._journal_file.close(); self._journal_file = None
+                open(self.journal_path, 'w').close()
+            except OSError as e: logging.error(f"Failed truncate state journal: {e}", exc_info=True); return False
+            logging.info(f"State compacted into {self.filepath} ({self._journal_records} journal records folded)."); self._journal_records = 0
+            return True
+
+    def close(self):
+        with self._lock:
+            if self._journal_records: self.compact()
+            if self._journal_file is not None: self._journal_file.close(); self._journal_file = None
@@ -0,0 +1,141 @@
+# telegram_notifier.py
+# Fire-and-forget Telegram notifications. Any thread can enqueue a message; a single sender task on the bot
+# application's own event loop delivers them through the application's Bot (and its connection pool), merging
+# bursts into one message and pacing sends to stay under Telegram's per-chat limits. Notifications are sent as plain
+# text: their contents (paths, errors, the [LEVEL] prefix) are arbitrary and MarkdownV2 would reject most of them.
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+from collections import deque
+
+import metrics
+
+COALESCE_WINDOW_SECONDS = 2.0   # Wait this long after the first queued message so a burst goes out as one message
+MIN_SEND_INTERVAL_SECONDS = 1.1 # Telegram allows about one message per second to a single chat
+MAX_SENDS_PER_MINUTE = 20
+MAX_SEND_ATTEMPTS = 4
+MAX_MESSAGE_LENGTH = 4090
+MAX_QUEUED_MESSAGES = 500       # Oldest plain messages are dropped beyond this (e.g. while the bot is not running yet)
+PROBE_TIMEOUT_SECONDS = 15
+_LEVEL_ORDER = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+
+
+def _telegram_errors():
+    # python-telegram-bot is imported when the notifier first talks to Telegram, not when utils imports this module.
+    from telegram import error
+    return error
+
+
+class TelegramNotifier:
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self._pending = deque(); self._pending_lock = threading.Lock()
+        self._bot = None; self._loop = None; self._wakeup = None; self._task = None
+        self._send_times = deque()
+
+    # --- Producer side (any thread) ---
+    def notify(self, message, level="INFO", reply_markup=None):
+        with self._pending_lock:
+            if len(self._pending) >= MAX_QUEUED_MESSAGES: dropped = self._pending.popleft(); logging.warning(f"Telegram queue full. Dropped: {dropped['text'][:80]}")
+            self._pending.append({"text": message, "level": level.upper(), "reply_markup": reply_markup})
+        self._wake()
+        return True
+
+    def probe(self, timeout=PROBE_TIMEOUT_SECONDS):
+        # Round-trips getMe through the bot loop (call from any other thread). notify() only queues, so it proves nothing.
+        loop = self._loop; bot = self._bot
+        if loop is None or loop.is_closed() or bot is None: logging.warning("Telegram probe: notifier not running."); return False
+        errors = _telegram_errors(); future = asyncio.run_coroutine_threadsafe(bot.get_me(), loop)
+        try: future.result(timeout); return True
+        except concurrent.futures.TimeoutError: future.cancel(); logging.warning(f"Telegram probe: no answer within {timeout}s."); return False
+        except errors.TelegramError as e: logging.warning(f"Telegram probe failed: {e}"); return False
+
+    def _wake(self):
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            try: loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError: pass  # Loop shut down between the check and the call
+
+    # --- Consumer side (bot event loop) ---
+    def start(self, bot, loop):
+        # Must be called on `loop` (e.g. from Application.post_init). Messages queued before this are delivered now.
+        self._bot = bot; self._loop = loop; self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._run()); self._wakeup.set()
+        logging.info("Telegram notifier started on the bot event loop.")
+
+    async def stop(self, flush_timeout=10.0):
+        if self._task is None: return
+        self._loop = None; deadline = time.monotonic() + flush_timeout
+        while self._has_pending() and time.monotonic() < deadline: await self._flush()
+        self._task.cancel()
+        try: await self._task
+        except asyncio.CancelledError: pass
+        self._task = None; logging.info("Telegram notifier stopped.")
+
+    def _has_pending(self):
+        with self._pending_lock: return bool(self._pending)
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait(); self._wakeup.clear()
+            await asyncio.sleep(COALESCE_WINDOW_SECONDS)
+            try:
+                while self._has_pending(): await self._flush()
+            except asyncio.CancelledError: raise
+            except Exception as e: logging.error(f"Telegram notifier flush failed: {e}", exc_info=True)
+
+    def _take_batch(self):
+        # Messages with buttons are sent alone (their buttons belong to them); consecutive plain messages are merged.
+        with self._pending_lock:
+            if not self._pending: return None
+            if self._pending[0]["reply_markup"] is not None: return [self._pending.popleft()]
+            batch = []
+            while self._pending and self._pending[0]["reply_markup"] is None: batch.append(self._pending.popleft())
+            return batch
+
+    @staticmethod
+    def _merge(batch):
+        counts = {}; order = []
+        for item in batch:
+            key = (item["level"], item["text"])
+            if key not in counts: order.append(key); counts[key] = 0
+            counts[key] += 1
+        lines = [f"[{level}] {text}" + (f" (x{counts[(level, text)]})" if counts[(level, text)] > 1 else "") for level, text in order]
+        merged = "\n".join(lines)
+        if len(merged) > MAX_MESSAGE_LENGTH: logging.warning("TG message too long. Truncating."); merged = merged[:MAX_MESSAGE_LENGTH] + "..."
+        return merged
+
+    async def _flush(self):
+        batch = self._take_batch()
+        if not batch: return
+        text = self._merge(batch); reply_markup = batch[0]["reply_markup"]
+        if len(batch) > 1: logging.info(f"Coalesced {len(batch)} Telegram notifications into one message.")
+        await self._send(text, reply_markup)
+
+    async def _wait_for_rate_limit(self):
+        now = time.monotonic()
+        while self._send_times and now - self._send_times[0] > 60: self._send_times.popleft()
+        wait = 0.0
+        if self._send_times: wait = max(wait, self._send_times[-1] + MIN_SEND_INTERVAL_SECONDS - now)
+        if len(self._send_times) >= MAX_SENDS_PER_MINUTE: wait = max(wait, self._send_times[0] + 60 - now)
+        if wait > 0: await asyncio.sleep(wait)
+        self._send_times.append(time.monotonic())
+
+    async def _send(self, text, reply_markup):
+        errors = _telegram_errors()
+        for attempt in range(1, MAX_SEND_ATTEMPTS + 1):
+            await self._wait_for_rate_limit(); started = time.perf_counter()
+            try:
+                await self._bot.send_message(chat_id=self.chat_id, text=text, reply_markup=reply_markup)
+                metrics.observe("telegram_send", time.perf_counter() - started); logging.info(f"Sent Telegram message to chat_id {self.chat_id}."); return True
+            except errors.RetryAfter as e:
+                metrics.observe("telegram_send", time.perf_counter() - started, "rate_limited"); retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+                logging.warning(f"Telegram rate limit hit. Retrying in {retry_after:.0f}s (attempt {attempt}/{MAX_SEND_ATTEMPTS})."); await asyncio.sleep(retry_after)
+            except errors.BadRequest as e: metrics.observe("telegram_send", time.perf_counter() - started, "bad_request"); logging.error(f"Telegram API error sending message: {e}", exc_info=True); return False
+            except (errors.TimedOut, errors.NetworkError) as e:
+                metrics.observe("telegram_send", time.perf_counter() - started, "network_error"); delay = 2 ** attempt; logging.warning(f"Telegram network error: {e}. Retrying in {delay}s (attempt {attempt}/{MAX_SEND_ATTEMPTS})."); await asyncio.sleep(delay)
+            except errors.TelegramError as e: metrics.observe("telegram_send", time.perf_counter() - started, "error"); logging.error(f"Telegram API error sending message: {e}", exc_info=True); return False
+        logging.error(f"Telegram message dropped after {MAX_SEND_ATTEMPTS} attempts."); return False
@@ -0,0 +1,60 @@
+# MP3 integrity walk on synthetic frame streams (and how much of the file it reads), plus the tempo/key estimators on
+# signals with a known answer.
+
+import io
+
+import numpy as np
+import pytest
+
+import audio_analysis
+from audio_analysis import estimate_key, estimate_tempo, verify_mp3
+
+FRAME = bytes([0xFF, 0xFB, 0x90, 0x00]) + bytes(413)   # MPEG-1 Layer III, 128 kbps, 44.1 kHz: 417 bytes, 1152 samples
+ID3_HEADER = b"ID3\x04\x00\x00\x00\x00\x00\x20" + bytes(32)   # 32-byte tag body
+ID3V1_TRAILER = b"TAG" + bytes(125)
+
+
+@pytest.fixture
+def write(tmp_path):
+    def write(data):
+        path = tmp_path / "track.mp3"; path.write_bytes(data); return str(path)
+    return write
+
+
+def test_whole_stream_with_tags_is_ok(write):
+    result = verify_mp3(write(ID3_HEADER + FRAME * 100 + ID3V1_TRAILER))
+    assert result["ok"] and result["frames"] == 100 and result["duration"] == round(100 * 1152 / 44100, 2)
+
+
+def test_truncated_last_frame_fails(write):
+    result = verify_mp3(write(FRAME * 100 + FRAME[:200]))
+    assert not result["ok"] and result["frames"] == 100 and result["error"].startswith("truncated")
+
+
+def test_short_junk_is_skipped_but_long_junk_loses_sync(write):
+    assert verify_mp3(write(FRAME * 20 + bytes(1000) + FRAME * 20))["frames"] == 40
+    result = verify_mp3(write(FRAME * 20 + bytes(10000) + FRAME * 20))
+    assert not result["ok"] and result["error"].startswith("lost frame sync")
+
+
+def test_only_headers_are_read(write, monkeypatch):
+    path = write(ID3_HEADER + FRAME * 500); read = []
+    class CountingFile(io.FileIO):
+        def read(self, size=-1):
+            data = super().read(size); read.append(len(data)); return data
+    monkeypatch.setattr(audio_analysis, "open", lambda path, mode, buffering=-1: CountingFile(path, mode.replace("b", "")), raising=False)
+    assert verify_mp3(path)["ok"] and sum(read) < 4 * 500 + 200
+
+
+def test_tempo_of_a_120_bpm_pulse():
+    frame_rate = 86.0; envelope = np.zeros(int(frame_rate * 20))
+    envelope[np.round(np.arange(0, 20, 0.5) * frame_rate).astype(int)] = 1.0
+    assert abs(estimate_tempo(envelope, frame_rate) - 120) < 2
+
+
+def test_key_of_a_major_and_minor_triad():
+    chroma = np.zeros(12); chroma[[0, 4, 7]] = 1.0                       # C E G
+    assert estimate_key(chroma)[0] == "C"
+    chroma = np.zeros(12); chroma[[9, 0, 4]] = 1.0; chroma[9] = 2.0      # A C E, A strongest
+    assert estimate_key(chroma)[0] == "Am"
+    assert estimate_key(np.zeros(12)) == (None, 0.0)
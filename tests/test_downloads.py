@@ -0,0 +1,74 @@
+# Kernel output downloads against a local HTTP server with Range support: an interrupted transfer leaves a .part that
+# the next attempt resumes, and download_kaggle_output raises on it so retry_operation retries right away.
+
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import utils
+from downloads import IncompleteOutputError, download_file
+
+ETAG = '"v1"'
+MP3 = (bytes([0xFF, 0xFB, 0x90, 0x00]) + bytes(413)) * 2000   # 2000 MPEG-1 Layer III frames, 128 kbps, 44.1 kHz
+RESULT = b'{"prompt": "test", "fingerprint": [1, 2, 3]}'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        name = self.path.lstrip("/"); body = self.server.files[name]; start = 0
+        if self.headers.get("Range") and self.headers.get("If-Range") == ETAG: start = int(self.headers["Range"].split("=")[1].split("-")[0])
+        self.server.requests.append((name, start))
+        self.send_response(206 if start else 200); self.send_header("ETag", ETAG); self.send_header("Content-Length", str(len(body) - start))
+        if start: self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+        self.end_headers()
+        payload = body[start:]
+        if self.server.truncate.pop(name, False): payload = payload[:len(payload) // 2]; self.close_connection = True  # Connection drops mid-file
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args): pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler); server.files = {"output.mp3": MP3, "result.json": RESULT}; server.truncate = {}; server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+
+
+def test_interrupted_download_resumes_from_part(server, tmp_path):
+    server.truncate["output.mp3"] = True; dest = str(tmp_path / "output.mp3")
+    with pytest.raises(Exception): download_file(f"{server.url}/output.mp3", dest)
+    kept = (tmp_path / "output.mp3.part").stat().st_size
+    assert 0 < kept < len(MP3)
+    info = download_file(f"{server.url}/output.mp3", dest)
+    assert info["resumed_from"] == kept and info["sha256"] == hashlib.sha256(MP3).hexdigest()
+    assert (tmp_path / "output.mp3").read_bytes() == MP3 and not (tmp_path / "output.mp3.part").exists()
+
+
+class _FakeKaggleApi:
+    def __init__(self, server): self.server = server
+    def kernel_output_with_http_info(self, owner_slug, kernel_slug): return {"files": [{"fileName": name, "url": f"{self.server.url}/{name}"} for name in self.server.files]}
+    def process_response(self, response): return response
+
+
+@pytest.fixture
+def kaggle_api(server, monkeypatch):
+    monkeypatch.setattr(utils, "get_kaggle_client", lambda account_index: _FakeKaggleApi(server))
+    monkeypatch.setitem(utils._kaggle_client_locks, 0, threading.Lock())
+
+
+def test_incomplete_output_raises_and_the_retry_resumes(server, kaggle_api, tmp_path):
+    server.truncate["output.mp3"] = True
+    with pytest.raises(IncompleteOutputError): utils.download_kaggle_output("owner/kernel", destination_dir=str(tmp_path))
+    mp3_path, json_path, _ = utils.retry_operation(utils.download_kaggle_output, args=("owner/kernel",), kwargs={"destination_dir": str(tmp_path)}, max_retries=1, delay_seconds=0)
+    assert open(mp3_path, 'rb').read() == MP3 and open(json_path, 'rb').read() == RESULT
+    assert any(name == "output.mp3" and start > 0 for name, start in server.requests)
+
+
+def test_missing_output_file_raises(server, kaggle_api, tmp_path):
+    del server.files["result.json"]
+    with pytest.raises(IncompleteOutputError): utils.download_kaggle_output("owner/kernel", destination_dir=str(tmp_path))
@@ -0,0 +1,127 @@
+# Drives DriveFolderIndex through a fake Drive service: the full listing, the Changes feed, and cleanup selection.
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from drive_index import DriveFolderIndex, _created_ts
+
+FOLDER = "folder"
+DAY = 86400
+
+
+class _Request:
+    def __init__(self, result): self._result = result
+    def execute(self):
+        if isinstance(self._result, Exception): raise self._result
+        return self._result
+
+
+class FakeDrive:
+    # The files()/changes() surface DriveFolderIndex uses. Changes are queued with change()/remove() and delivered
+    # one per page, so the nextPageToken/newStartPageToken paging is exercised too.
+    def __init__(self, files=()):
+        self.listing = {f["id"]: f for f in files}; self.feed = []; self.cursor = 0; self.list_calls = 0; self.reject_token = False
+
+    def files(self): return self
+    def changes(self): return self
+
+    def list(self, q=None, pageToken=None, **kwargs):
+        if q is not None: self.list_calls += 1; return _Request({"files": list(self.listing.values())})
+        if self.reject_token: return _Request(HttpError(httplib2.Response({"status": 410}), b"token expired"))
+        position = int(pageToken)
+        if position >= len(self.feed): return _Request({"changes": [], "newStartPageToken": str(position)})
+        return _Request({"changes": [self.feed[position]], "nextPageToken": str(position + 1)})
+
+    def getStartPageToken(self): return _Request({"startPageToken": str(len(self.feed))})
+
+    def change(self, file_id, name, created, parents=(FOLDER,), trashed=False):
+        file = {"id": file_id, "name": name, "createdTime": created, "parents": list(parents), "trashed": trashed}
+        self.feed.append({"fileId": file_id, "removed": False, "file": file})
+        if FOLDER in parents and not trashed: self.listing[file_id] = file
+        else: self.listing.pop(file_id, None)
+
+    def remove(self, file_id):
+        self.feed.append({"fileId": file_id, "removed": True}); self.listing.pop(file_id, None)
+
+
+def _file(file_id, day):
+    return {"id": file_id, "name": f"{file_id}.mp3", "createdTime": f"2026-01-{day:02d}T00:00:00Z"}
+
+
+def _ids(candidates): return [file_id for file_id, _ in candidates]
+
+
+@pytest.fixture
+def index(tmp_path): return DriveFolderIndex(str(tmp_path / "drive_index.json"), FOLDER)
+
+
+NOW = _created_ts("2026-02-01T00:00:00Z")
+
+
+def test_first_refresh_lists_folder_then_follows_changes(index):
+    drive = FakeDrive([_file("a", 1), _file("b", 2)])
+    assert index.refresh(drive) and len(index) == 2 and drive.list_calls == 1
+    drive.change("c", "c.mp3", "2026-01-03T00:00:00Z"); drive.remove("a")
+    drive.change("b", "b.mp3", "2026-01-02T00:00:00Z", trashed=True)
+    drive.change("x", "x.mp3", "2026-01-04T00:00:00Z", parents=("elsewhere",))
+    assert index.refresh(drive) and drive.list_calls == 1
+    assert set(index.files) == {"c"}
+
+
+def test_cleanup_takes_expired_then_oldest_over_limit(index):
+    index.refresh(FakeDrive([_file(f"f{day}", day) for day in range(1, 11)]))
+    expired, excess = index.take_cleanup_candidates(max_files=5, max_age_seconds=29 * DAY, now_ts=NOW)
+    assert _ids(expired) == ["f1", "f2"] and _ids(excess) == ["f3", "f4", "f5"]
+    index.mark_deleted(_ids(expired) + _ids(excess))
+    assert index.take_cleanup_candidates(max_files=5, max_age_seconds=29 * DAY, now_ts=NOW) == ([], [])
+
+
+def test_released_candidates_come_back_once(index):
+    index.refresh(FakeDrive([_file(f"f{day}", day) for day in range(1, 5)]))
+    _, excess = index.take_cleanup_candidates(max_files=2, max_age_seconds=365 * DAY, now_ts=NOW)
+    index.mark_deleted(["f1"]); index.release(["f2"]); index.release(["f2"])
+    _, excess = index.take_cleanup_candidates(max_files=2, max_age_seconds=365 * DAY, now_ts=NOW)
+    assert _ids(excess) == ["f2"]
+
+
+def test_removed_and_readded_file_is_a_candidate_once(index):
+    drive = FakeDrive([_file("a", 1), _file("b", 2), _file("c", 3)]); index.refresh(drive)
+    drive.remove("a"); drive.change("a", "a.mp3", "2026-01-01T00:00:00Z"); index.refresh(drive)
+    drive.change("a", "renamed.mp3", "2026-01-01T00:00:00Z"); index.refresh(drive)
+    expired, excess = index.take_cleanup_candidates(max_files=0, max_age_seconds=365 * DAY, now_ts=NOW)
+    assert expired == [] and _ids(excess) == ["a", "b", "c"]
+    assert excess[0][1]["name"] == "renamed.mp3"
+
+
+def test_changed_created_time_moves_the_file(index):
+    drive = FakeDrive([_file("a", 1), _file("b", 2)]); index.refresh(drive)
+    drive.change("a", "a.mp3", "2026-01-05T00:00:00Z"); index.refresh(drive)
+    _, excess = index.take_cleanup_candidates(max_files=0, max_age_seconds=365 * DAY, now_ts=NOW)
+    assert _ids(excess) == ["b", "a"]
+
+
+def test_rejected_token_falls_back_to_full_listing(index):
+    drive = FakeDrive([_file("a", 1)]); index.refresh(drive)
+    drive.listing["b"] = _file("b", 2); drive.reject_token = True
+    assert index.refresh(drive) and drive.list_calls == 2 and set(index.files) == {"a", "b"}
+
+
+def test_index_persists_between_runs(index):
+    drive = FakeDrive([_file("a", 1), _file("b", 2)]); index.refresh(drive)
+    drive.change("c", "c.mp3", "2026-01-03T00:00:00Z")
+    reopened = DriveFolderIndex(index.path, FOLDER)
+    assert reopened.refresh(drive) and drive.list_calls == 1 and set(reopened.files) == {"a", "b", "c"}
+    assert DriveFolderIndex(index.path, "other-folder").files == {}
+
+
+def test_kept_files_are_never_candidates_and_do_not_count(tmp_path):
+    index = DriveFolderIndex(str(tmp_path / "drive_index.json"), FOLDER, keep=lambda name: name.endswith(".gz"))
+    drive = FakeDrive([_file("a", 1), _file("b", 2), {"id": "log", "name": "log.gz", "createdTime": "2026-01-01T00:00:00Z"}]); index.refresh(drive)
+    drive.change("b", "b.gz", "2026-01-02T00:00:00Z"); index.refresh(drive)  # Renamed into the kept set after being queued
+    assert index.take_cleanup_candidates(max_files=1, max_age_seconds=365 * DAY, now_ts=NOW) == ([], [])
+    expired, excess = index.take_cleanup_candidates(max_files=0, max_age_seconds=DAY, now_ts=NOW)
+    assert _ids(expired) == ["a"] and excess == []
+    assert _ids(index.kept_files()) == ["log", "b"]
+    index.mark_deleted(["log"]); index.release(["b"])
+    assert _ids(index.kept_files()) == ["b"] and index.take_cleanup_candidates(max_files=0, max_age_seconds=DAY, now_ts=NOW) == ([], [])
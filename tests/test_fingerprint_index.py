@@ -0,0 +1,83 @@
+# Exercises FingerprintIndex lookups: keyed adds that a rerun of the uniqueness step can repeat safely, and recall of
+# the 64 x 2 band layout for landmark pairs around the 0.40 threshold.
+
+import json
+import random
+
+import pytest
+
+from fingerprint_index import FingerprintIndex
+
+THRESHOLD = 0.40
+
+
+def _landmarks(rng, count=2000):
+    return [rng.getrandbits(32) for _ in range(count)]
+
+
+def _near_duplicate(rng, fingerprint, jaccard):
+    # Same size, sharing s hashes: s / (2n - s) = jaccard.
+    shared = round(2 * len(fingerprint) * jaccard / (1 + jaccard))
+    return rng.sample(fingerprint, shared) + _landmarks(rng, len(fingerprint) - shared)
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = FingerprintIndex(str(tmp_path / "fingerprints.sqlite3"))
+    yield index
+    index.close()
+
+
+def test_rerun_with_the_same_key_passes_and_stores_once(index):
+    fingerprint = _landmarks(random.Random(1))
+    assert index.is_unique(fingerprint, THRESHOLD, key="item-1")
+    first_id = index.add(fingerprint, label="first run", key="item-1")
+    # The step is redone after a restart: its own stored fingerprint must not count against it.
+    assert index.is_unique(fingerprint, THRESHOLD, key="item-1")
+    assert index.add(fingerprint, label="second run", key="item-1") == first_id and len(index) == 1
+    assert not index.is_unique(fingerprint, THRESHOLD, key="item-2") and not index.is_unique(fingerprint, THRESHOLD)
+
+
+def test_key_survives_reopen(tmp_path):
+    path = str(tmp_path / "fingerprints.sqlite3"); fingerprint = _landmarks(random.Random(2))
+    index = FingerprintIndex(path); index.add(fingerprint, key="item-1"); index.close()
+    reopened = FingerprintIndex(path)
+    try: assert reopened.is_unique(fingerprint, THRESHOLD, key="item-1") and not reopened.is_unique(fingerprint, THRESHOLD)
+    finally: reopened.close()
+
+
+def test_json_landmark_rows_are_packed_on_open(tmp_path):
+    path = str(tmp_path / "fingerprints.sqlite3"); fingerprint = _landmarks(random.Random(3))
+    index = FingerprintIndex(path); index.add(fingerprint)
+    # Rewrite the row the way the index stored landmarks before the landmarks column existed.
+    with index._conn: index._conn.execute("UPDATE tracks SET fingerprint = ?, landmarks = NULL", (json.dumps(fingerprint),))
+    index.close()
+    reopened = FingerprintIndex(path)
+    try:
+        assert reopened._conn.execute("SELECT fingerprint, length(landmarks) FROM tracks").fetchone() == ("", 4 * len(set(fingerprint)))
+        assert reopened.max_similarity(fingerprint)[0] == 1.0
+    finally: reopened.close()
+
+
+def test_band_layout_recall_at_0_3(index):
+    # The layout comment's claim: a pair at Jaccard 0.3 shares at least one band with probability ~0.997.
+    assert (index.bands, index.rows) == (64, 2) and abs(1 - (1 - 0.3 ** index.rows) ** index.bands - 0.997) < 0.001
+    rng = random.Random(4); pairs = 300; caught = 0
+    for _ in range(pairs):
+        fingerprint = _landmarks(rng)
+        caught += bool(set(index._band_buckets(fingerprint)) & set(index._band_buckets(_near_duplicate(rng, fingerprint, 0.3))))
+    assert caught >= pairs - 3
+
+
+def test_min_shared_bands_follows_threshold(index):
+    assert [index.min_shared_bands(j) for j in (0.3, THRESHOLD, 0.5)] == [1, 2, 6]
+
+
+def test_near_duplicates_found_and_unrelated_pass(index):
+    rng = random.Random(5); stored = [_landmarks(rng) for _ in range(100)]
+    index.add_many((fingerprint, f"track {n}", f"item-{n}") for n, fingerprint in enumerate(stored))
+    for n, fingerprint in enumerate(stored):
+        similarity, track_id = index.max_similarity(_near_duplicate(rng, fingerprint, 0.45), THRESHOLD)
+        assert similarity >= THRESHOLD and track_id == n + 1
+    assert all(index.is_unique(_landmarks(rng), THRESHOLD) for _ in range(100))
+    assert all(index.is_unique(_near_duplicate(rng, fingerprint, 0.2), THRESHOLD) for fingerprint in stored[:20])
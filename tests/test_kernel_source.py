@@ -0,0 +1,46 @@
+# Params injected into the kernel source: the injected cell/block runs and yields the params, re-injection replaces
+# it, and stripping gives back the user's own source.
+
+import json
+
+import pytest
+
+import kernel_source
+from kernel_source import PARAMS_CELL_TAG, inject_params, strip_params
+
+PARAMS = {"prompt": "lo-fi \"rain\" 'jazz'\nwith \\ piano", "seed": 42, "batch": [{"prompt": "é ✓"}]}
+NOTEBOOK = {"cells": [{"cell_type": "code", "execution_count": None, "metadata": {}, "outputs": [], "source": ["import json\n", "print(1)"]}],
+            "metadata": {"kernelspec": {"name": "python3"}}, "nbformat": 4, "nbformat_minor": 5}
+SCRIPT = "import json\nprint(open('/kaggle/input/x').read())\n"
+
+
+@pytest.fixture(autouse=True)
+def runtime_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "params.json"); monkeypatch.setattr(kernel_source, "PARAMS_RUNTIME_PATH", path); return path
+
+
+def _run(code, runtime_path, monkeypatch):
+    monkeypatch.delenv("MUSICAI_PARAMS_PATH", raising=False); namespace = {}; exec(code, namespace)
+    with open(runtime_path, 'r', encoding='utf-8') as f: written = json.load(f)
+    return namespace["MUSICAI_PARAMS"], written
+
+
+def test_notebook_round_trip(runtime_path, monkeypatch):
+    injected = json.loads(inject_params(json.dumps(NOTEBOOK), "notebook.ipynb", PARAMS))
+    first = injected["cells"][0]
+    assert first["metadata"]["tags"] == [PARAMS_CELL_TAG] and injected["cells"][1:] == NOTEBOOK["cells"]
+    assert _run("".join(first["source"]), runtime_path, monkeypatch) == (PARAMS, PARAMS)
+    assert json.loads(strip_params(json.dumps(injected), "notebook.ipynb")) == NOTEBOOK
+
+
+def test_notebook_reinjection_replaces_the_cell(runtime_path, monkeypatch):
+    once = inject_params(json.dumps(NOTEBOOK), "notebook.ipynb", {"seed": 1})
+    twice = json.loads(inject_params(once, "notebook.ipynb", {"seed": 2}))
+    assert len(twice["cells"]) == 2 and _run("".join(twice["cells"][0]["source"]), runtime_path, monkeypatch)[0] == {"seed": 2}
+
+
+def test_script_round_trip(runtime_path, monkeypatch):
+    injected = inject_params(SCRIPT, "script.py", PARAMS)
+    assert injected.endswith(SCRIPT) and strip_params(injected, "script.py") == SCRIPT
+    assert _run(injected.split(SCRIPT)[0], runtime_path, monkeypatch) == (PARAMS, PARAMS)
+    assert strip_params(inject_params(injected, "script.py", {"seed": 2}), "script.py") == SCRIPT
@@ -0,0 +1,95 @@
+# Incremental log shipping: the held-back partial record, the shipped offset following a RotatingFileHandler rename,
+# a failed upload keeping the bytes pending, and rebuild_log reporting the segments missing from a rebuild.
+
+import os
+import shutil
+
+import pytest
+
+from log_shipping import LogShipper, is_segment_name, rebuild_log, segment_number
+
+
+@pytest.fixture
+def log_path(tmp_path):
+    return str(tmp_path / "system_log.txt")
+
+
+@pytest.fixture
+def uploads(tmp_path):
+    # Fake upload(local_path, name): keeps a copy of every segment, like the Drive backup folder would.
+    folder = tmp_path / "uploaded"; folder.mkdir()
+    def upload(path, name): shutil.copy(path, folder / name); return f"id-{name}"
+    upload.folder = folder
+    return upload
+
+
+def _append(path, text):
+    with open(path, 'a', encoding='utf-8') as f: f.write(text)
+
+
+def _rotate(log_path, backup_count):
+    # What RotatingFileHandler.doRollover does: shift .N names up and start an empty live file.
+    for i in range(backup_count - 1, 0, -1):
+        if os.path.exists(f"{log_path}.{i}"): os.replace(f"{log_path}.{i}", f"{log_path}.{i + 1}")
+    os.replace(log_path, f"{log_path}.1"); open(log_path, 'w').close()
+
+
+def _shipper(log_path, tmp_path, backup_count=3):
+    return LogShipper(log_path, backup_count, work_dir=str(tmp_path))
+
+
+def _rebuilt(uploads, tmp_path):
+    output = str(tmp_path / "rebuilt.txt")
+    result = rebuild_log([str(p) for p in uploads.folder.iterdir()], output)
+    with open(output, 'r', encoding='utf-8') as f: return result, f.read()
+
+
+def test_partial_record_waits_for_its_newline(log_path, tmp_path, uploads):
+    _append(log_path, "one\ntwo\nthr"); shipper = _shipper(log_path, tmp_path)
+    first = shipper.ship(uploads)
+    assert first["bytes"] == len("one\ntwo\n") and is_segment_name(first["name"]) and segment_number(first["name"]) == 0
+    assert shipper.ship(uploads) is None                                     # Nothing complete since
+    _append(log_path, "ee\n")
+    assert shipper.ship(uploads)["bytes"] == len("three\n")
+    assert _rebuilt(uploads, tmp_path)[1] == "one\ntwo\nthree\n"
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".gz")]  # Local segments are removed after upload
+
+
+def test_offset_follows_rotation(log_path, tmp_path, uploads):
+    _append(log_path, "a1\na2\n"); _shipper(log_path, tmp_path).ship(uploads)
+    _append(log_path, "a3\n"); _rotate(log_path, 3); _append(log_path, "b1\n")
+    _rotate(log_path, 3); _append(log_path, "c1\nc2\n")
+    # A restarted shipper reloads the saved offset and finds its file at .2: the rest of it, then .1, then the live file.
+    shipper = _shipper(log_path, tmp_path)
+    assert shipper.pending_files() == [(f"{log_path}.2", len("a1\na2\n")), (f"{log_path}.1", 0), (log_path, 0)]
+    assert shipper.ship(uploads)["bytes"] == len("a3\nb1\nc1\nc2\n")
+    _rotate(log_path, 3)                                                     # Rotated with nothing new: no segment, the
+    assert shipper.ship(uploads) is None and shipper.pending_files() == [(log_path, 0)]   # offset moves on to the new live file
+    _append(log_path, "d1\n"); shipper.ship(uploads)
+    result, text = _rebuilt(uploads, tmp_path)
+    assert text == "a1\na2\na3\nb1\nc1\nc2\nd1\n" and result == {"segments": 3, "bytes": len(text), "missing": []}
+
+
+def test_rotated_out_file_ships_what_is_left(log_path, tmp_path, uploads):
+    _append(log_path, "a1\n"); shipper = _shipper(log_path, tmp_path, backup_count=1); shipper.ship(uploads)
+    _append(log_path, "a2\n"); _rotate(log_path, 1); _append(log_path, "b1\n"); _rotate(log_path, 1); _append(log_path, "c1\n")
+    # The shipped file was deleted by the second rotation: "a2" is lost, the rest goes out whole.
+    assert shipper.pending_files() == [(f"{log_path}.1", 0), (log_path, 0)]
+    shipper.ship(uploads); assert _rebuilt(uploads, tmp_path)[1] == "a1\nb1\nc1\n"
+
+
+def test_failed_upload_keeps_bytes_pending(log_path, tmp_path, uploads):
+    _append(log_path, "a1\n"); shipper = _shipper(log_path, tmp_path)
+    assert shipper.ship(lambda path, name: None) is None and shipper.state == {"seq": 0, "file": None}
+    _append(log_path, "a2\n")
+    assert shipper.ship(uploads)["bytes"] == len("a1\na2\n") and shipper.state["seq"] == 1
+
+
+def test_rebuild_reports_gaps(log_path, tmp_path, uploads):
+    shipper = _shipper(log_path, tmp_path)
+    for n in range(4): _append(log_path, f"line{n}\n"); shipper.ship(uploads)
+    (seg1,) = [p for p in uploads.folder.iterdir() if segment_number(p.name) == 1]; seg1.unlink()
+    (uploads.folder / "notes.txt").write_text("not a segment")
+    result, text = _rebuilt(uploads, tmp_path)
+    assert result == {"segments": 3, "bytes": len(text), "missing": [1]} and text == "line0\nline2\nline3\n"
+    assert rebuild_log([str(uploads.folder / "notes.txt")], str(tmp_path / "none.txt")) is None
@@ -0,0 +1,56 @@
+# Log reading without loading whole files: the reverse line reader across block edges, text and JSON-lines entry
+# parsing (continuation lines, context fields), and search_logs stopping before it reaches older rotated files.
+
+import json
+import logging
+from datetime import datetime
+
+import pytest
+
+import log_utils
+from log_utils import iter_lines_reverse, iter_log_entries_reverse, search_logs
+
+
+def _text_line(hour, level, msg):
+    return f"2026-10-17 {hour:02d}:00:00,000 - {level} - main.py:1 - {msg}\n"
+
+
+@pytest.fixture
+def log_path(tmp_path):
+    return str(tmp_path / "system_log.txt")
+
+
+@pytest.mark.parametrize("trailing_newline", [True, False])
+def test_reverse_reader_across_block_edges(tmp_path, trailing_newline):
+    lines = [f"line {n} " + "x" * (n % 7) for n in range(50)]; path = tmp_path / "f.txt"
+    path.write_text("\n".join(lines) + ("\n" if trailing_newline else ""), encoding="utf-8")
+    assert list(iter_lines_reverse(str(path), block_size=8)) == lines[::-1]
+
+
+def test_text_entries_fold_continuation_lines(log_path):
+    with open(log_path, 'w', encoding='utf-8') as f:
+        f.write(_text_line(1, "INFO", "started") + _text_line(2, "ERROR", "boom") + "Traceback (most recent call last):\n  File \"x\"\nValueError: bad\n" + _text_line(3, "WARNING", "slow"))
+    entries = list(iter_log_entries_reverse(log_path))
+    assert [e["levelno"] for e in entries] == [logging.WARNING, logging.ERROR, logging.INFO]
+    assert entries[1]["text"].endswith("boom\nTraceback (most recent call last):\n  File \"x\"\nValueError: bad") and entries[1]["time"] == datetime(2026, 10, 17, 2)
+
+
+def test_json_entries_render_like_the_text_log(log_path):
+    entry = {"ts": "2026-10-17T04:00:00.000", "level": "ERROR", "file": "utils.py", "line": 9, "msg": "upload failed", "step": "upload", "run_id": "r1", "exc": "Traceback..."}
+    with open(log_path, 'w', encoding='utf-8') as f: f.write(json.dumps(entry) + "\n")
+    (parsed,) = iter_log_entries_reverse(log_path)
+    assert parsed["levelno"] == logging.ERROR and parsed["time"] == datetime(2026, 10, 17, 4)
+    assert parsed["text"] == "2026-10-17 04:00:00,000 - ERROR - utils.py:9 - upload failed [step=upload, run_id=r1]\nTraceback..."
+
+
+def test_search_stops_before_older_rotated_files(log_path, monkeypatch):
+    with open(log_path + ".1", 'w', encoding='utf-8') as f: f.write(_text_line(1, "ERROR", "old"))
+    with open(log_path, 'w', encoding='utf-8') as f: f.write(_text_line(5, "INFO", "a") + _text_line(6, "ERROR", "b") + _text_line(7, "ERROR", "c"))
+    opened = []; real_reader = log_utils.iter_lines_reverse
+    monkeypatch.setattr(log_utils, "iter_lines_reverse", lambda path, *args: opened.append(path) or real_reader(path, *args))
+    found = search_logs(log_path, backup_count=1, since=datetime(2026, 10, 17, 5, 30), min_level=logging.ERROR)
+    assert [line.rsplit(" - ", 1)[1] for line in found] == ["b", "c"]
+    # The live file's oldest entry is already before `since`, so the .1 file is never opened.
+    assert opened == [log_path]
+    assert [line.rsplit(" - ", 1)[1] for line in search_logs(log_path, backup_count=1, min_level=logging.ERROR, limit=2)] == ["b", "c"]
+    assert search_logs(log_path, backup_count=1, contains="old") == [_text_line(1, "ERROR", "old").rstrip("\n")]
@@ -0,0 +1,58 @@
+# MetricsRegistry: quantiles interpolated inside histogram buckets, timer outcomes, the Prometheus rendering, and
+# save/load adding a saved registry's totals, counters and hourly history to the live one.
+
+import pytest
+
+from metrics import MetricsRegistry
+
+BUCKETS = (1, 2, 4)
+
+
+@pytest.fixture
+def registry():
+    return MetricsRegistry(buckets=BUCKETS)
+
+
+def test_quantiles_interpolate_within_buckets(registry):
+    for seconds in (0.5, 0.5, 1.5, 1.5): registry.observe("op", seconds)
+    (row,) = registry.summary()
+    assert row["p50"] == pytest.approx(1.0) and row["p95"] == pytest.approx(1.9) and row["mean"] == pytest.approx(1.0)
+    registry.observe("slow", 60)
+    assert registry.summary()[1]["p50"] == 4          # Beyond the last bucket: reported as its upper bound
+
+
+def test_timer_records_errors(registry):
+    with registry.timer("op"): pass
+    with pytest.raises(ValueError):
+        with registry.timer("op"): raise ValueError("boom")
+    (row,) = registry.summary()
+    assert (row["count"], row["errors"], row["recent_count"], row["recent_errors"]) == (2, 1, 2, 1)
+
+
+def test_prometheus_buckets_are_cumulative(registry):
+    for seconds in (0.5, 1.5, 3, 9): registry.observe("op", seconds, "ok" if seconds < 5 else "error")
+    registry.count("retries", 2, stage="upload")
+    text = registry.render_prometheus()
+    for line in ('musicai_operation_seconds_bucket{operation="op",le="1"} 1', 'musicai_operation_seconds_bucket{operation="op",le="4"} 3',
+                 'musicai_operation_seconds_bucket{operation="op",le="+Inf"} 4', 'musicai_operation_total{operation="op",outcome="error"} 1',
+                 'musicai_retries_total{stage="upload"} 2'):
+        assert line in text.splitlines()
+
+
+def test_load_adds_saved_totals(registry, tmp_path):
+    path = str(tmp_path / "metrics.json")
+    registry.observe("op", 0.5); registry.observe("op", 3, "error"); registry.count("retries", stage="upload")
+    registry._history.appendleft({"hour": registry._history[0]["hour"] - 30, "ops": {"op": [5, 0, 2.5]}})
+    assert registry.save(path)
+    restarted = MetricsRegistry(buckets=BUCKETS); restarted.observe("op", 1.5); restarted.count("retries", stage="upload")
+    assert restarted.load(path)
+    (row,) = restarted.summary(recent_hours=48)
+    assert (row["count"], row["errors"], row["mean"]) == (3, 1, pytest.approx(5 / 3))
+    assert row["recent_count"] == 3 + 5 and restarted._counters[("retries", (("stage", "upload"),))] == 2
+    assert [h["hour"] for h in restarted._history] == sorted(h["hour"] for h in restarted._history)
+
+
+def test_load_skips_histograms_saved_with_other_buckets(registry, tmp_path):
+    path = str(tmp_path / "metrics.json"); registry.observe("op", 0.5); registry.count("retries"); registry.save(path)
+    other = MetricsRegistry(buckets=(1, 10))
+    assert other.load(path) and other.summary() == [] and other._counters[("retries", ())] == 1
@@ -0,0 +1,46 @@
+# PipelineQueues persistence and backpressure: an item in flight when the process stops is redone first after a
+# restart, and complete() waits for room downstream instead of overfilling the next queue.
+
+import threading
+
+import pytest
+
+from pipeline import PipelineQueues
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "pipeline.json")
+
+
+def test_in_flight_item_is_redone_first_after_restart(path):
+    queues = PipelineQueues(path, {"analyze": None, "upload": None})
+    queues.offer("analyze", {"mp3": "a.mp3"}); queues.offer("analyze", {"mp3": "b.mp3"})
+    taken = queues.take("analyze", timeout=0)
+    assert taken["mp3"] == "a.mp3"
+    # Process dies before complete(): the reopened queues hand out the same item again, ahead of the waiting one.
+    restarted = PipelineQueues(path, {"analyze": None, "upload": None})
+    assert restarted.sizes() == {"analyze": 2, "upload": 0}
+    redo = restarted.take("analyze", timeout=0)
+    assert redo["id"] == taken["id"] and "_in_flight" not in redo
+    assert restarted.complete("analyze", redo["id"], [("upload", {"mp3": redo["mp3"]})])
+    assert PipelineQueues(path, {"analyze": None, "upload": None}).sizes() == {"analyze": 1, "upload": 1}
+
+
+def test_complete_waits_for_room_downstream(path):
+    queues = PipelineQueues(path, {"analyze": None, "upload": 1})
+    queues.offer("upload", {"mp3": "waiting.mp3"}); queues.offer("analyze", {"mp3": "next.mp3"})
+    item = queues.take("analyze", timeout=0); done = threading.Event()
+    worker = threading.Thread(target=lambda: queues.complete("analyze", item["id"], [("upload", {"mp3": "next.mp3"})]) and done.set()); worker.start()
+    assert not done.wait(0.3) and queues.sizes() == {"analyze": 1, "upload": 1}
+    upload = queues.take("upload", timeout=0); queues.complete("upload", upload["id"])
+    assert done.wait(3) and queues.sizes() == {"analyze": 0, "upload": 1}
+    worker.join()
+
+
+def test_complete_gives_up_on_shutdown_and_keeps_the_item(path):
+    queues = PipelineQueues(path, {"analyze": None, "upload": 1})
+    queues.offer("upload", {"mp3": "waiting.mp3"}); queues.offer("analyze", {"mp3": "next.mp3"})
+    item = queues.take("analyze", timeout=0); queues.stop()
+    assert not queues.complete("analyze", item["id"], [("upload", {"mp3": "next.mp3"})])
+    assert PipelineQueues(path, {"analyze": None, "upload": 1}).sizes() == {"analyze": 1, "upload": 1}
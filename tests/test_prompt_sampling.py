@@ -0,0 +1,37 @@
+# Prompt sampling: the profile version only moves when the weights would, alias tables draw in proportion to their
+# weights, and PromptQueue drops entries made for an older profile version.
+
+import random
+
+from prompt_sampling import AliasSampler, PromptQueue, profile_version
+
+
+def _profile(bpms, mood_counts=None):
+    return {"genre_counts": {"lofi": 3}, "instrument_counts": {}, "mood_counts": mood_counts or {}, "recent_bpms": bpms}
+
+
+def test_version_follows_bpm_bucket_not_raw_bpms():
+    fast = profile_version(_profile([120, 125, 130, 122, 128]))
+    assert profile_version(_profile([120, 125, 130, 122, 128, 126])) == fast          # Another fast track: same weights
+    assert profile_version(_profile([100, 101, 99, 100, 102])) != fast                # Average drops into the middle
+    assert profile_version(_profile([100, 101, 99, 100])) == profile_version(_profile([80, 82, 84]))  # Under 5 BPMs: no bucket
+    assert profile_version(_profile([120] * 5, {"chill": 1})) != fast                 # Counts still count
+    assert profile_version(_profile([120] * 5), ["lofi"]) != fast
+
+
+def test_alias_sampler_matches_weights():
+    sampler = AliasSampler(["a", "b", "c"], [1, 2, 7]); rng = random.Random(3); draws = 20000
+    counts = {c: 0 for c in "abc"}
+    for _ in range(draws): counts[sampler.sample(rng)] += 1
+    assert abs(counts["a"] / draws - 0.1) < 0.01 and abs(counts["b"] / draws - 0.2) < 0.015 and abs(counts["c"] / draws - 0.7) < 0.015
+
+
+def test_queue_drops_entries_from_an_older_version():
+    state = {"version": 1, "made": 0}
+    def make_entries(count):
+        entries = [{"prompt": f"v{state['version']}-{state['made'] + n}"} for n in range(count)]; state["made"] += count
+        return entries, state["version"]
+    queue = PromptQueue(make_entries, lambda: state["version"], maxsize=4); queue._fill(4)
+    assert [e["prompt"] for e in queue.take(2)] == ["v1-0", "v1-1"]
+    state["version"] = 2
+    assert [e["prompt"] for e in queue.take(2)] == ["v2-4", "v2-5"] and not queue._entries
@@ -0,0 +1,46 @@
+# Quota model: the weekly reset boundary the forecast assumes, run-time estimates falling back from the account to
+# the pool to the configured default, and which account the scheduler picks.
+
+from datetime import datetime, timedelta, timezone
+
+from quota_model import expected_run_seconds, forecast_account, next_quota_reset, pick_account, record_run
+
+MONDAY = datetime(2026, 10, 12, tzinfo=timezone.utc)   # 00:00 UTC
+NEXT_MONDAY = MONDAY + timedelta(days=7)
+
+
+def test_reset_is_the_next_monday_midnight():
+    tuesday = MONDAY + timedelta(days=1, hours=10)
+    assert next_quota_reset(tuesday.isoformat(), tuesday + timedelta(days=1)) == NEXT_MONDAY
+    # Six days after a Tuesday 10:00 reset is Monday 10:00, but the reset still lands on the Monday 00:00 boundary.
+    assert next_quota_reset(tuesday.isoformat(), NEXT_MONDAY + timedelta(hours=1)) == NEXT_MONDAY
+    assert next_quota_reset(None, MONDAY + timedelta(days=3)) == NEXT_MONDAY
+    assert next_quota_reset("not a time", MONDAY + timedelta(days=3)) == NEXT_MONDAY
+
+
+def test_reset_on_a_monday():
+    now = MONDAY + timedelta(hours=9)
+    assert next_quota_reset(None, now) == MONDAY                                                 # Due: the next cycle applies it
+    assert next_quota_reset((MONDAY - timedelta(days=7)).isoformat(), now) == MONDAY
+    assert next_quota_reset((MONDAY + timedelta(minutes=5)).isoformat(), now) == NEXT_MONDAY     # Already reset today
+
+
+def test_run_seconds_fall_back_from_account_to_pool_to_default():
+    histories = {}
+    assert expected_run_seconds(histories, 0, 4, 900) == 900
+    for seconds in (600, 700, 800): record_run(histories, 1, seconds, "complete", 4, None)
+    record_run(histories, 1, 50, "error", 4, None); record_run(histories, 1, 300, "complete", 1, None)
+    assert expected_run_seconds(histories, 0, 4, 900) == 700 and expected_run_seconds(histories, 1, 1, 900) == 300
+    record_run(histories, 0, 1000, "complete", 4, None)
+    assert expected_run_seconds(histories, 0, 4, 900) == 1000
+
+
+def test_forecast_and_pick_with_a_shared_reset():
+    now = MONDAY + timedelta(days=5); histories = {}
+    usage = [{"gpu_hours_used_this_week": 10.0, "last_reset_time": (MONDAY + timedelta(minutes=1)).isoformat()},
+             {"gpu_hours_used_this_week": 29.0, "last_reset_time": (MONDAY - timedelta(days=7)).isoformat()},
+             {"gpu_hours_used_this_week": 30.0, "last_reset_time": MONDAY.isoformat()}]
+    forecasts = [forecast_account(entry, histories, i, now, 30, 4, 3600) for i, entry in enumerate(usage)]
+    assert [f["runs_left"] for f in forecasts] == [20, 1, 0] and forecasts[0]["reset_at"] == NEXT_MONDAY
+    assert forecasts[0]["runs_before_reset"] == 20 and forecasts[0]["tracks_before_reset"] == 80 and forecasts[0]["exhausted_at"] == now + timedelta(hours=20)
+    assert pick_account(forecasts)["account_index"] == 0 and pick_account(forecasts[2:]) is None
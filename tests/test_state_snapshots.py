@@ -0,0 +1,86 @@
+# State snapshots: unchanged states cost no upload, deltas against the last full snapshot restore to the same checksum
+# (with or without the manifest), a damaged snapshot is refused, and prunable() keeps the full base of every kept delta.
+
+import gzip
+import json
+import os
+import shutil
+from datetime import datetime, timedelta
+
+import pytest
+
+from state_snapshots import SnapshotBackup, is_snapshot_name, restore_state, state_checksum
+
+STATE = {"generated_tracks": [f"track_{n}" for n in range(200)], "kaggle_usage": [{"gpu_hours_used_this_week": 1.0}], "last_prompt": "rain"}
+
+
+@pytest.fixture
+def uploads(tmp_path):
+    # Fake upload(local_path, name): the Drive folder the restore downloads from.
+    folder = tmp_path / "drive"; folder.mkdir(); sent = []
+    def upload(path, name): shutil.copy(path, folder / name); sent.append(name); return f"id-{name}"
+    upload.folder = folder; upload.sent = sent
+    return upload
+
+
+@pytest.fixture
+def backup(tmp_path):
+    return SnapshotBackup(str(tmp_path / "snapshots"), full_every=2)
+
+
+def _write_state(path, state):
+    with open(path, 'w', encoding='utf-8') as f: json.dump(dict(state, _checksum=state_checksum(state)), f)
+
+
+def _snapshot(backup, tmp_path, uploads, state):
+    path = str(tmp_path / "state.json"); _write_state(path, state); return backup.backup(path, uploads)
+
+
+def test_deltas_restore_to_the_same_state(backup, tmp_path, uploads):
+    states = [STATE, dict(STATE, last_prompt="jazz"), {k: v for k, v in STATE.items() if k != "last_prompt"}, dict(STATE, last_prompt="lofi")]
+    entries = [_snapshot(backup, tmp_path, uploads, s) for s in states]
+    assert [e["kind"] for e in entries] == ["full", "delta", "delta", "full"]        # full_every=2 deltas, then a full again
+    assert entries[1]["base"] == entries[0]["checksum"] and all(is_snapshot_name(name) for name in uploads.sent)
+    for manifest_path in (backup.manifest_path, None):                                # Without the manifest: read from the files
+        for entry, state in zip(entries, states):
+            assert restore_state(str(uploads.folder), datetime.fromisoformat(entry["time"]), manifest_path) == state
+    assert restore_state(str(uploads.folder), datetime.fromisoformat(entries[0]["time"]) - timedelta(seconds=1)) is None
+
+
+def test_unchanged_or_earlier_state_is_not_uploaded(backup, tmp_path, uploads):
+    first = _snapshot(backup, tmp_path, uploads, STATE); _snapshot(backup, tmp_path, uploads, dict(STATE, last_prompt="jazz"))
+    assert _snapshot(backup, tmp_path, uploads, dict(STATE, last_prompt="jazz"))["name"] == uploads.sent[-1]
+    again = _snapshot(backup, tmp_path, uploads, STATE)
+    assert len(uploads.sent) == 2 and again["name"] == first["name"] and again["time"] > first["time"]
+    assert restore_state(str(uploads.folder), None, backup.manifest_path) == STATE
+
+
+def test_failed_upload_records_nothing(backup, tmp_path, uploads):
+    assert _snapshot(backup, tmp_path, lambda path, name: None, STATE) is None and backup.manifest["entries"] == []
+    assert _snapshot(backup, tmp_path, uploads, STATE)["kind"] == "full"
+
+
+def test_damaged_snapshot_is_refused(backup, tmp_path, uploads):
+    _snapshot(backup, tmp_path, uploads, STATE); delta = _snapshot(backup, tmp_path, uploads, dict(STATE, last_prompt="jazz"))
+    path = uploads.folder / delta["name"]
+    with gzip.open(path, 'rt', encoding='utf-8') as f: payload = json.load(f)
+    payload["set"]["last_prompt"] = "tampered"
+    with gzip.open(path, 'wt', encoding='utf-8') as f: json.dump(payload, f)
+    assert restore_state(str(uploads.folder), None, backup.manifest_path) is None
+    os.remove(uploads.folder / backup.manifest["entries"][0]["name"])                # A delta without its base cannot restore
+    assert restore_state(str(uploads.folder), None, backup.manifest_path) is None
+
+
+def test_prunable_keeps_bases_of_kept_deltas(backup, tmp_path, uploads):
+    states = [dict(STATE, last_prompt=f"p{n}") for n in range(6)]                    # full, delta, delta, full, delta, delta
+    entries = [_snapshot(backup, tmp_path, uploads, s) for s in states]
+    start = datetime.fromisoformat(entries[0]["time"])
+    for n, entry in enumerate(backup.manifest["entries"]): entry["time"] = (start + timedelta(days=n)).isoformat()
+    names = set(uploads.sent) | {"state_0123456789abcdef.json.gz"}                  # Unknown to the manifest: never pruned
+    full0, delta1, delta2, full3, delta4, delta5 = (e["name"] for e in entries)
+    # Keeping 2.5 days from day 5: days 3-5 plus the entry in effect at the cutoff (day 2, a delta on day 0's full).
+    assert backup.prunable(names, 2.5 * 86400, now=start + timedelta(days=5)) == {delta1}
+    assert backup.prunable(names, 1.5 * 86400, now=start + timedelta(days=5)) == {full0, delta1, delta2}
+    assert backup.prunable(names, 0.5 * 86400, now=start + timedelta(days=5)) == {full0, delta1, delta2}   # delta5 still needs full3
+    backup.forget({full0})
+    assert [e["name"] for e in backup.manifest["entries"]] == [full3, delta4, delta5]
@@ -0,0 +1,64 @@
+# StateStore journal: only touched keys are journaled, records replay on the next open, a torn last record is dropped
+# with everything before it kept, and compaction folds the journal into the snapshot file.
+
+import json
+import os
+
+import pytest
+
+from state_store import StateStore
+
+
+def _read(path):
+    if not os.path.exists(path): return {"status": "stopped", "slots": [{"step": "idle"}], "history": []}
+    with open(path, 'r', encoding='utf-8') as f: return json.load(f)
+
+
+def _write(state, path):
+    with open(path, 'w', encoding='utf-8') as f: json.dump(state, f)
+    return True
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "state.txt")
+
+
+def _journal(path):
+    with open(path + ".journal", 'r', encoding='utf-8') as f: return [json.loads(line)["payload"] for line in f if line.strip()]
+
+
+def test_only_touched_keys_are_journaled(path):
+    store = StateStore(path, _read, _write); state = store.load()
+    state["slots"][0]["step"] = "polling"; state.get("history"); state["status"]
+    assert store.save(state)
+    assert [sorted(record["set"]) for record in _journal(path)] == [["slots"]]   # history was read but is unchanged
+    assert store.load()["slots"] == [{"step": "polling"}]
+
+
+def test_unsaved_changes_do_not_leak_into_the_store(path):
+    store = StateStore(path, _read, _write)
+    store.load()["slots"][0]["step"] = "polling"; store.load().pop("history")
+    assert store.load()["slots"] == [{"step": "idle"}] and "history" in store.load()
+
+
+def test_journal_replays_on_reopen(path):
+    store = StateStore(path, _read, _write); state = store.load()
+    state["status"] = "running"; store.save(state); state["history"].append(1); del state["slots"]; store.save(state)
+    reopened = StateStore(path, _read, _write).load()   # No close(): the snapshot file was never written
+    assert reopened["status"] == "running" and reopened["history"] == [1] and "slots" not in reopened
+
+
+def test_torn_last_record_is_dropped(path):
+    store = StateStore(path, _read, _write); state = store.load()
+    state["status"] = "running"; store.save(state); state["status"] = "error"; store.save(state)
+    with open(path + ".journal", 'r+', encoding='utf-8') as f: data = f.read(); f.seek(0); f.truncate(); f.write(data[:-20])  # Crash mid-write
+    assert StateStore(path, _read, _write).load()["status"] == "running"
+
+
+def test_compaction_folds_the_journal_into_the_snapshot(path):
+    store = StateStore(path, _read, _write, compact_every=3); state = store.load()
+    for n in range(3): state["history"].append(n); store.save(state)
+    assert os.path.getsize(path + ".journal") == 0 and _read(path)["history"] == [0, 1, 2]
+    state["status"] = "running"; store.save(state); store.close()
+    assert os.path.getsize(path + ".journal") == 0 and _read(path)["status"] == "running"
@@ -0,0 +1,85 @@
+# TelegramNotifier: bursts merged into one message with repeat counts, messages with buttons sent alone and in order,
+# messages queued before start() or from other threads delivered on the bot loop, and RetryAfter/BadRequest handling.
+
+import asyncio
+import threading
+
+import pytest
+from telegram.error import BadRequest, RetryAfter
+
+import telegram_notifier
+from telegram_notifier import TelegramNotifier
+
+
+class FakeBot:
+    # Records send_message calls; `failures` are raised, one per call, before sends start succeeding.
+    def __init__(self, failures=()):
+        self.sent = []; self.failures = list(failures); self.attempts = 0
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        self.attempts += 1
+        if self.failures: raise self.failures.pop(0)
+        self.sent.append((chat_id, text, reply_markup))
+
+    async def get_me(self): return {"id": 1}
+
+
+@pytest.fixture(autouse=True)
+def fast_timing(monkeypatch):
+    monkeypatch.setattr(telegram_notifier, "COALESCE_WINDOW_SECONDS", 0.01); monkeypatch.setattr(telegram_notifier, "MIN_SEND_INTERVAL_SECONDS", 0)
+
+
+def _deliver(notifier, bot, produce):
+    # Starts the notifier on a fresh loop, runs produce() on another thread, then stops (which flushes what is left).
+    async def main():
+        notifier.start(bot, asyncio.get_running_loop())
+        await asyncio.to_thread(produce); await asyncio.sleep(0.05)
+        await notifier.stop()
+    asyncio.run(main())
+
+
+def test_burst_is_merged_with_repeat_counts():
+    notifier = TelegramNotifier(42); bot = FakeBot()
+    def produce():
+        for _ in range(3): notifier.notify("upload failed", "error")
+        notifier.notify("retrying", "warning")
+    _deliver(notifier, bot, produce)
+    assert bot.sent == [(42, "[ERROR] upload failed (x3)\n[WARNING] retrying", None)]
+
+
+def test_buttons_are_sent_alone_in_order():
+    notifier = TelegramNotifier(42); bot = FakeBot(); markup = object()
+    for text, reply_markup in (("a", None), ("b", None), ("choose", markup), ("c", None)): notifier.notify(text, reply_markup=reply_markup)
+    _deliver(notifier, bot, lambda: None)                                # All queued before start()
+    assert bot.sent == [(42, "[INFO] a\n[INFO] b", None), (42, "[INFO] choose", markup), (42, "[INFO] c", None)]
+
+
+def test_long_merge_is_truncated_and_queue_is_bounded(monkeypatch):
+    monkeypatch.setattr(telegram_notifier, "MAX_QUEUED_MESSAGES", 3)
+    notifier = TelegramNotifier(42)
+    for n in range(5): notifier.notify(f"m{n}")
+    assert [item["text"] for item in notifier._pending] == ["m2", "m3", "m4"]
+    merged = TelegramNotifier._merge([{"level": "INFO", "text": "x" * 5000, "reply_markup": None}])
+    assert len(merged) == telegram_notifier.MAX_MESSAGE_LENGTH + 3 and merged.endswith("...")
+
+
+@pytest.mark.filterwarnings("ignore::telegram.warnings.PTBDeprecationWarning")    # retry_after read as seconds or timedelta
+def test_retry_after_is_retried_and_bad_request_dropped():
+    notifier = TelegramNotifier(42); bot = FakeBot([RetryAfter(0), BadRequest("can't parse"), RetryAfter(0)])
+    async def main():
+        notifier._bot = bot
+        assert await notifier._send("one", None) is False                 # RetryAfter, then BadRequest: dropped
+        assert await notifier._send("two", None) is True                  # RetryAfter, then delivered
+    asyncio.run(main())
+    assert bot.attempts == 4 and bot.sent == [(42, "two", None)]
+
+
+def test_probe_round_trips_through_the_bot_loop():
+    notifier = TelegramNotifier(42); results = []
+    assert notifier.probe() is False                                      # Not started
+    async def main():
+        notifier.start(FakeBot(), asyncio.get_running_loop())
+        results.append(await asyncio.to_thread(notifier.probe, 5))
+        await notifier.stop()
+    asyncio.run(main())
+    assert results == [True]
@@ -1,185 +1,766 @@
-                            # utils.py (Updated after RETHINK FIX)
-
-                            import json
-                            import os
-                            import logging
-                            import hashlib
-                            import subprocess
-                            import pickle
-                            from google_auth_oauthlib.flow import InstalledAppFlow
-                            from google.auth.transport.requests import Request
-                            from googleapiclient.discovery import build
-                            from googleapiclient.errors import HttpError
-                            from google.auth.exceptions import RefreshError
-                            from googleapiclient.http import MediaFileUpload
-                            from difflib import SequenceMatcher
-                            import requests
-                            import socket
-                            import time
-                            import telegram
-                            from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-                            from telegram.constants import ParseMode # <<< ADDED ParseMode
-                            import asyncio
-                            import random
-
-                            # --- Import Config and State ---
-                            try:
-                                from main import DEFAULT_STATE
-                                from config import DRY_RUN, NUM_KAGGLE_ACCOUNTS # Import NUM_KAGGLE_ACCOUNTS here too
-                            except ImportError:
-                                logging.warning("Could not import from main. Using fallbacks/env vars.")
-                                DEFAULT_STATE = { "status": "stopped", "active_kaggle_account_index": 0, "active_drive_account_index": 0, "current_step": "idle", "current_prompt": None, "last_kaggle_run_id": None, "last_kaggle_trigger_time": None, "last_downloaded_mp3": None, "last_downloaded_json": None, "retry_count": 0, "total_tracks_generated": 0, "style_profile_id": "default", "fallback_active": False, "kaggle_usage": [{"account_index": i, "gpu_hours_used_this_week": 0.0, "last_reset_time": None} for i in range(4)], "last_error": None, "_checksum": None, "recent_fingerprints": [], "last_gdrive_cleanup_time": None, "last_health_check_time": None, "intervention_pending_since": None }
-                                try:
-                                     from config import DRY_RUN, NUM_KAGGLE_ACCOUNTS
-                                except ImportError:
-                                     logging.error("Could not import DRY_RUN/NUM_KAGGLE_ACCOUNTS from config. Using defaults.")
-                                     DRY_RUN = False
-                                     NUM_KAGGLE_ACCOUNTS = 4 # Default if config import fails
-
-                            DEFAULT_STYLE_PROFILE = { "profile_id": "default", "last_updated": None, "recent_bpms": [], "recent_keys": [], "genre_counts": {}, "instrument_counts": {}, "mood_counts": {}, "prompt_keyword_counts": {}, "last_reset_track_count": 0, "_checksum": None }
-                            STYLE_PROFILE_FILE_PATH = "style_profile.json"
-
-                            # --- Kaggle Output Filenames --- ## <<< ADDED SECTION >>> ##
-                            # Ensure these match the filenames saved by your Kaggle notebook
-                            KAGGLE_OUTPUT_MP3 = "output.mp3"
-                            KAGGLE_OUTPUT_JSON = "result.json"
-                            KAGGLE_OUTPUT_IMG = "output_spectrogram.png"
-
-
-                            try:
-                                import spotipy
-                                from spotipy.oauth2 import SpotifyClientCredentials
-                                from spotipy.exceptions import SpotifyException
-                                SPOTIPY_AVAILABLE = True
-                            except ImportError:
-                                logging.warning("Spotipy library not found."); SPOTIPY_AVAILABLE = False; SpotifyException = None
-
-                            # --- Resiliency Utilities ---
-                            def retry_operation(func, args=None, kwargs=None, max_retries=3, delay_seconds=5, allowed_exceptions=None, operation_name="Operation"):
-                                # ... (retry_operation function remains unchanged) ...
-                                if args is None: args = ()
-                                if kwargs is None: kwargs = {}
-                                if allowed_exceptions is None:
-                                     allowed_exceptions = ( requests.exceptions.RequestException, socket.timeout, TimeoutError, HttpError, SpotifyException, subprocess.TimeoutExpired, )
-                                     allowed_exceptions = tuple(e for e in allowed_exceptions if e is not None)
-                                retries = 0
-                                while retries <= max_retries:
-                                    try:
-                                        logging.info(f"Attempting {operation_name} (Attempt {retries + 1}/{max_retries + 1})...")
-                                        result = func(*args, **kwargs)
-                                        logging.info(f"{operation_name} successful.")
-                                        return result
-                                    except allowed_exceptions as e:
-                                        logging.warning(f"{operation_name} failed on attempt {retries + 1}: {type(e).__name__} - {e}")
-                                        retries += 1
-                                        if retries <= max_retries:
-                                            current_delay = delay_seconds * (2 ** (retries - 1)); jitter = current_delay * random.uniform(0.1, 0.5); wait_time = current_delay + jitter
-                                            logging.info(f"Retrying {operation_name} in {wait_time:.2f} seconds...")
-                                            time.sleep(wait_time)
-                                        else: logging.error(f"{operation_name} failed after {max_retries + 1} attempts."); logging.exception(f"Final failure details for {operation_name}:"); return None
-                                    except Exception as e: logging.critical(f"Unexpected error during {operation_name} (Attempt {retries + 1}): {e}", exc_info=True); return None
-                                return None
-
-                            # --- State Management Functions ---
-                            def load_state(filepath):
-                                # ... (load_state remains unchanged) ...
-                                logging.info(f"Attempting load state: {filepath}"); try: if not os.path.exists(filepath): logging.warning(f"State file '{filepath}' not found."); return DEFAULT_STATE.copy(); with open(filepath, 'r', encoding='utf-8') as f: state_str = f.read(); if not state_str.strip(): logging.warning(f"State file '{filepath}' empty."); return DEFAULT_STATE.copy(); loaded_state = json.loads(state_str); stored_checksum = loaded_state.get('_checksum'); if stored_checksum: state_copy_for_checksum = loaded_state.copy(); state_copy_for_checksum.pop('_checksum', None); try: checksum_str = json.dumps(state_copy_for_checksum, separators=(',', ':'), sort_keys=True).encode('utf-8'); calculated_checksum = hashlib.sha256(checksum_str).hexdigest(); if calculated_checksum != stored_checksum: logging.error(f"STATE CHECKSUM MISMATCH!"); return DEFAULT_STATE.copy(); else: logging.debug("State checksum verified."); except Exception as checksum_e: logging.error(f"Failed verify checksum: {checksum_e}."); else: logging.warning("No checksum in state file."); state_updated = False; for key, default_value in DEFAULT_STATE.items(): if key not in loaded_state: logging.warning(f"Key '{key}' missing."); loaded_state[key] = default_value; state_updated = True; if not isinstance(loaded_state.get("recent_fingerprints"), list): logging.warning("State 'recent_fingerprints' not list."); loaded_state["recent_fingerprints"] = []; state_updated = True; if not isinstance(loaded_state.get("kaggle_usage"), list): logging.warning("State 'kaggle_usage' not list."); loaded_state["kaggle_usage"] = DEFAULT_STATE["kaggle_usage"]; state_updated = True; if loaded_state.get("last_gdrive_cleanup_time") is not None and not isinstance(loaded_state.get("last_gdrive_cleanup_time"), str): logging.warning("State 'last_gdrive_cleanup_time' not None/string."); loaded_state["last_gdrive_cleanup_time"] = None; state_updated = True; if loaded_state.get("last_health_check_time") is not None and not isinstance(loaded_state.get("last_health_check_time"), str): logging.warning("State 'last_health_check_time' not None/string."); loaded_state["last_health_check_time"] = None; state_updated = True; if loaded_state.get("intervention_pending_since") is not None and not isinstance(loaded_state.get("intervention_pending_since"), str): logging.warning("State 'intervention_pending_since' not None/string."); loaded_state["intervention_pending_since"] = None; state_updated = True; if state_updated: logging.info("Loaded state updated."); return loaded_state; except FileNotFoundError: logging.warning(f"State file '{filepath}' not found."); return DEFAULT_STATE.copy(); except json.JSONDecodeError as e: logging.error(f"Failed decode state JSON: {e}."); return DEFAULT_STATE.copy(); except Exception as e: logging.critical(f"Unexpected error loading state: {e}", exc_info=True); return DEFAULT_STATE.copy()
-                            def save_state(state_data, filepath):
-                                # ... (save_state remains unchanged) ...
-                                temp_filepath = filepath + ".tmp"; try: state_copy_for_checksum = state_data.copy(); state_copy_for_checksum.pop('_checksum', None); try: checksum_str = json.dumps(state_copy_for_checksum, separators=(',', ':'), sort_keys=True).encode('utf-8'); state_data['_checksum'] = hashlib.sha256(checksum_str).hexdigest(); logging.debug(f"Calculated state checksum."); except Exception as checksum_e: logging.error(f"Failed calculate checksum: {checksum_e}."); state_data['_checksum'] = None; state_str = json.dumps(state_data, indent=4); with open(temp_filepath, 'w', encoding='utf-8') as f: f.write(state_str); os.replace(temp_filepath, filepath); logging.info(f"State saved to {filepath}."); return True; except (IOError, OSError) as e: logging.critical(f"File I/O error saving state: {e}", exc_info=True); except Exception as e: logging.critical(f"Unexpected error saving state: {e}", exc_info=True); if os.path.exists(temp_filepath): try: os.remove(temp_filepath); except OSError as rm_e: logging.error(f"Failed remove temp state file: {rm_e}"); return False
-
-                            # --- Style Profile Management Functions ---
-                            def load_style_profile(filepath=STYLE_PROFILE_FILE_PATH):
-                                # ... (load_style_profile remains unchanged) ...
-                                logging.info(f"Attempting load style profile: {filepath}"); try: if not os.path.exists(filepath): logging.warning(f"Style profile '{filepath}' not found."); return DEFAULT_STYLE_PROFILE.copy(); with open(filepath, 'r', encoding='utf-8') as f: profile_str = f.read(); if not profile_str.strip(): logging.warning(f"Style profile '{filepath}' empty."); return DEFAULT_STYLE_PROFILE.copy(); loaded_profile = json.loads(profile_str); stored_checksum = loaded_profile.get('_checksum'); if stored_checksum: profile_copy_for_checksum = loaded_profile.copy(); profile_copy_for_checksum.pop('_checksum', None); try: checksum_str = json.dumps(profile_copy_for_checksum, separators=(',', ':'), sort_keys=True).encode('utf-8'); calculated_checksum = hashlib.sha256(checksum_str).hexdigest(); if calculated_checksum != stored_checksum: logging.error(f"STYLE PROFILE CHECKSUM MISMATCH!"); return DEFAULT_STYLE_PROFILE.copy(); else: logging.debug("Style profile checksum verified."); except Exception as checksum_e: logging.error(f"Failed verify style profile checksum: {checksum_e}."); else: logging.warning("No checksum in style profile."); profile_updated = False; for key, default_value in DEFAULT_STYLE_PROFILE.items(): if key not in loaded_profile: logging.warning(f"Style profile key '{key}' missing."); loaded_profile[key] = default_value; profile_updated = True; if not isinstance(loaded_profile.get("recent_bpms"), list): logging.warning("Style 'recent_bpms' not list."); loaded_profile["recent_bpms"] = []; profile_updated = True; if not isinstance(loaded_profile.get("recent_keys"), list): logging.warning("Style 'recent_keys' not list."); loaded_profile["recent_keys"] = []; profile_updated = True; if not isinstance(loaded_profile.get("genre_counts"), dict): logging.warning("Style 'genre_counts' not dict."); loaded_profile["genre_counts"] = {}; profile_updated = True; if not isinstance(loaded_profile.get("instrument_counts"), dict): logging.warning("Style 'instrument_counts' not dict."); loaded_profile["instrument_counts"] = {}; profile_updated = True; if not isinstance(loaded_profile.get("mood_counts"), dict): logging.warning("Style 'mood_counts' not dict."); loaded_profile["mood_counts"] = {}; profile_updated = True; if not isinstance(loaded_profile.get("prompt_keyword_counts"), dict): logging.warning("Style 'prompt_keyword_counts' not dict."); loaded_profile["prompt_keyword_counts"] = {}; profile_updated = True; if not isinstance(loaded_profile.get("last_reset_track_count"), int): logging.warning("Style 'last_reset_track_count' not int."); loaded_profile["last_reset_track_count"] = 0; profile_updated = True; if profile_updated: logging.info("Loaded style profile updated."); return loaded_profile; except FileNotFoundError: logging.warning(f"Style profile '{filepath}' not found."); return DEFAULT_STYLE_PROFILE.copy(); except json.JSONDecodeError as e: logging.error(f"Failed decode style profile JSON: {e}."); return DEFAULT_STYLE_PROFILE.copy(); except Exception as e: logging.critical(f"Unexpected error loading style profile: {e}", exc_info=True); return DEFAULT_STYLE_PROFILE.copy()
-                            def save_style_profile(profile_data, filepath=STYLE_PROFILE_FILE_PATH):
-                                # ... (save_style_profile remains unchanged) ...
-                                temp_filepath = filepath + ".tmp"; try: profile_copy_for_checksum = profile_data.copy(); profile_copy_for_checksum.pop('_checksum', None); try: checksum_str = json.dumps(profile_copy_for_checksum, separators=(',', ':'), sort_keys=True).encode('utf-8'); profile_data['_checksum'] = hashlib.sha256(checksum_str).hexdigest(); logging.debug(f"Calculated style profile checksum."); except Exception as checksum_e: logging.error(f"Failed calculate style profile checksum: {checksum_e}."); profile_data['_checksum'] = None; profile_str = json.dumps(profile_data, indent=4); with open(temp_filepath, 'w', encoding='utf-8') as f: f.write(profile_str); os.replace(temp_filepath, filepath); logging.info(f"Style profile saved to {filepath}."); return True; except (IOError, OSError) as e: logging.critical(f"File I/O error saving style profile: {e}", exc_info=True); except Exception as e: logging.critical(f"Unexpected error saving style profile: {e}", exc_info=True); if os.path.exists(temp_filepath): try: os.remove(temp_filepath); except OSError as rm_e: logging.error(f"Failed remove temp style profile file: {rm_e}"); return False
-
-                            # --- Google Drive Authentication ---
-                            # ... (authenticate_gdrive remains unchanged) ...
-                            SCOPES = ['https://www.googleapis.com/auth/drive.file']; TOKEN_PICKLE_PATH = 'token.pickle'; _gdrive_service = None
-                            def authenticate_gdrive(): global _gdrive_service; if _gdrive_service: return _gdrive_service; creds = None; if os.path.exists(TOKEN_PICKLE_PATH): try: with open(TOKEN_PICKLE_PATH, 'rb') as token_file: creds = pickle.load(token_file); logging.info("Loaded GDrive token."); except (FileNotFoundError, EOFError, pickle.UnpicklingError) as e: logging.warning(f"Failed load token: {e}. Re-auth."); creds = None; except Exception as e: logging.error(f"Unexpected error loading token: {e}. Re-auth.", exc_info=True); creds = None; if not creds or not creds.valid: if creds and creds.expired and creds.refresh_token: try: logging.info("GDrive token expired. Refreshing..."); creds.refresh(Request()); logging.info("Token refreshed."); except RefreshError as e: logging.error(f"Failed refresh GDrive token (RefreshError): {e}. Re-auth."); creds = None; except requests.exceptions.RequestException as e: logging.error(f"Network error during GDrive refresh: {e}. Re-auth."); creds = None; except Exception as e: logging.error(f"Unexpected error refreshing GDrive token: {e}. Re-auth.", exc_info=True); creds = None; else: try: try: from main import GOOGLE_CREDS_INFO; except ImportError: logging.warning("Could not import GOOGLE_CREDS_INFO. Trying env."); google_creds_json_str_env = os.environ.get('GOOGLE_CREDS_JSON'); if google_creds_json_str_env: try: GOOGLE_CREDS_INFO = json.loads(google_creds_json_str_env); logging.info("Loaded GOOGLE_CREDS_INFO from env."); except json.JSONDecodeError as env_json_e: logging.critical(f"Failed parse GOOGLE_CREDS_JSON from env: {env_json_e}"); GOOGLE_CREDS_INFO = None; else: GOOGLE_CREDS_INFO = None; if not GOOGLE_CREDS_INFO: logging.critical("GDrive creds info missing."); return None; flow = InstalledAppFlow.from_client_info(GOOGLE_CREDS_INFO, SCOPES); logging.info("Attempting GDrive auth flow..."); creds = flow.run_console(); logging.info("Auth flow completed."); except Exception as e: logging.critical(f"Failed GDrive interactive auth flow: {e}", exc_info=True); return None; if creds: try: with open(TOKEN_PICKLE_PATH, 'wb') as token_file: pickle.dump(creds, token_file); logging.info(f"GDrive token saved."); except (IOError, OSError) as e: logging.error(f"Failed save GDrive token pickle: {e}"); except Exception as e: logging.error(f"Unexpected error saving token pickle: {e}", exc_info=True); else: logging.error("Auth resulted in invalid GDrive creds."); return None; if not creds: logging.error("Cannot build GDrive service: No valid creds."); return None; try: _gdrive_service = build('drive', 'v3', credentials=creds); logging.info("GDrive service built."); return _gdrive_service; except HttpError as e: logging.critical(f"Failed build GDrive service (HttpError): {e}", exc_info=True); return None; except Exception as e: logging.critical(f"Unexpected error building GDrive service: {e}", exc_info=True); return None
-
-                            # --- Google Drive File Operations ---
-                            def upload_to_gdrive(service, local_filepath, gdrive_folder_id, gdrive_filename):
-                                if DRY_RUN: logging.warning(f"[DRY RUN] Skipping GDrive upload of '{local_filepath}' as '{gdrive_filename}'"); return f"dry_run_fake_id_{random.randint(1000,9999)}"
-                                if not service: logging.error("GDrive service invalid for upload."); return None; try: if not os.path.exists(local_filepath): logging.error(f"Local file '{local_filepath}' not found."); return None; logging.info(f"Uploading '{local_filepath}' to Drive as '{gdrive_filename}'..."); file_metadata = {'name': gdrive_filename, 'parents': [gdrive_folder_id]}; media = MediaFileUpload(local_filepath, resumable=True); file = service.files().create(body=file_metadata, media_body=media, fields='id').execute(); uploaded_file_id = file.get('id'); logging.info(f"File uploaded. ID: {uploaded_file_id}"); return uploaded_file_id; except HttpError as e: logging.error(f"Google API HTTP error during upload: {e}", exc_info=True); if e.resp.status == 403 and 'quota' in str(e).lower(): logging.critical("Google Drive Quota Exceeded!"); return None; except (socket.timeout, requests.exceptions.Timeout, TimeoutError) as e: logging.error(f"Timeout error during GDrive upload: {e}", exc_info=True); return None; except requests.exceptions.RequestException as e: logging.error(f"Network error during GDrive upload: {e}", exc_info=True); return None; except FileNotFoundError: logging.error(f"Local file '{local_filepath}' unavailable during upload."); return None; except Exception as e: logging.critical(f"Unexpected error during GDrive upload: {e}", exc_info=True); return None
-                            def get_gdrive_files(service, folder_id):
-                                # ... (get_gdrive_files remains unchanged) ...
-                                if not service: logging.error("GDrive service invalid."); return []; files_list = []; page_token = None; try: logging.info(f"Listing files in GDrive folder: {folder_id}"); while True: response = service.files().list(q=f"'{folder_id}' in parents and trashed=false", spaces='drive', fields='nextPageToken, files(id, name, createdTime)', pageSize=100, pageToken=page_token).execute(); files = response.get('files', []); if not files and page_token is None and not files_list: logging.info("No files found."); break; files_list.extend(files); page_token = response.get('nextPageToken', None); if page_token is None: break; logging.info(f"Found {len(files_list)} total files."); return files_list; except HttpError as e: logging.error(f"Google API HTTP error listing files: {e}", exc_info=True); return []; except (socket.timeout, requests.exceptions.Timeout, TimeoutError) as e: logging.error(f"Timeout error listing files: {e}", exc_info=True); return []; except requests.exceptions.RequestException as e: logging.error(f"Network error listing files: {e}", exc_info=True); return []; except Exception as e: logging.critical(f"Unexpected error listing files: {e}", exc_info=True); return []
-                            def delete_gdrive_file(service, file_id):
-                                if DRY_RUN: logging.warning(f"[DRY RUN] Skipping GDrive deletion of file ID: {file_id}"); return True
-                                if not service: logging.error("GDrive service invalid."); return False; if not file_id: logging.error("No file ID provided."); return False; try: logging.warning(f"Attempting delete GDrive file ID: {file_id}"); service.files().delete(fileId=file_id).execute(); logging.info(f"Deleted GDrive file ID: {file_id}"); return True; except HttpError as e: if e.resp.status == 404: logging.warning(f"File ID {file_id} not found."); return True; elif e.resp.status == 403: logging.error(f"Permission error deleting {file_id}: {e}"); return False; else: logging.error(f"Google API HTTP error deleting {file_id}: {e}", exc_info=True); return False; except (socket.timeout, requests.exceptions.Timeout, TimeoutError) as e: logging.error(f"Timeout error deleting {file_id}: {e}", exc_info=True); return False; except requests.exceptions.RequestException as e: logging.error(f"Network error deleting {file_id}: {e}", exc_info=True); return False; except Exception as e: logging.critical(f"Unexpected error deleting {file_id}: {e}", exc_info=True); return False
-
-                            # --- Kaggle API Setup ---
-                            # ... (setup_kaggle_api remains unchanged) ...
-                            KAGGLE_CONFIG_DIR = os.path.expanduser("~/.kaggle"); KAGGLE_JSON_PATH = os.path.join(KAGGLE_CONFIG_DIR, "kaggle.json")
-                            def setup_kaggle_api(account_index): logging.info(f"Setting up Kaggle API index: {account_index}"); try: try: from main import KAGGLE_CREDENTIALS_LIST; except ImportError: logging.warning("Could not import KAGGLE_CREDENTIALS_LIST. Trying env."); KAGGLE_CREDENTIALS_LIST = [os.environ.get(f'KAGGLE_JSON_{i+1}') for i in range(NUM_KAGGLE_ACCOUNTS)]; if not any(KAGGLE_CREDENTIALS_LIST): logging.critical("Kaggle creds missing from env."); return False; if None in KAGGLE_CREDENTIALS_LIST: logging.warning("Some Kaggle creds missing from env."); logging.info("Loaded KAGGLE_CREDENTIALS_LIST from env."); except Exception as import_e: logging.critical(f"Failed load KAGGLE_CREDENTIALS_LIST: {import_e}"); return False; num_creds = len(KAGGLE_CREDENTIALS_LIST); if not 0 <= account_index < num_creds: logging.error(f"Invalid Kaggle index: {account_index} (of {num_creds})."); return False; kaggle_json_str = KAGGLE_CREDENTIALS_LIST[account_index]; if not kaggle_json_str: logging.error(f"Kaggle creds JSON missing index {account_index}."); return False; try: os.makedirs(KAGGLE_CONFIG_DIR, exist_ok=True); with open(KAGGLE_JSON_PATH, 'w') as f: f.write(kaggle_json_str); os.chmod(KAGGLE_JSON_PATH, 0o600); logging.info(f"Kaggle API setup ok index {account_index}."); return True; except (IOError, OSError) as e: logging.critical(f"File I/O error Kaggle setup: {e}", exc_info=True); return False; except Exception as e: logging.critical(f"Unexpected error Kaggle setup: {e}", exc_info=True); return False
-
-                            # --- Kaggle Notebook Execution ---
-                            PARAMS_JSON_FILENAME = "params.json"; PARAMS_DATASET_SLUG = "notebook-params-temp"
-                            def trigger_kaggle_notebook(notebook_slug, params_dict):
-                                if DRY_RUN: logging.warning(f"[DRY RUN] Skipping Kaggle trigger for {notebook_slug}"); return True
-                                # ... (rest of function remains unchanged) ...
-                                logging.info(f"Triggering Kaggle notebook: {notebook_slug}"); try: params_json_str = json.dumps(params_dict); except TypeError as e: logging.error(f"Failed serialize params: {e}"); return False; try: with open(PARAMS_JSON_FILENAME, 'w') as f: f.write(params_json_str); logging.info(f"Created {PARAMS_JSON_FILENAME}"); except (IOError, OSError) as e: logging.error(f"Failed write params file: {e}"); return False; metadata_content = {"title": "Notebook Params Temp", "id": f"{notebook_slug.split('/')[0]}/{PARAMS_DATASET_SLUG}", "licenses": [{"name": "CC0-1.0"}]}; metadata_filename = "dataset-metadata.json"; dataset_created = False; try: with open(metadata_filename, 'w') as f: json.dump(metadata_content, f, indent=4); logging.info(f"Created {metadata_filename}"); logging.info(f"Uploading {PARAMS_JSON_FILENAME} as dataset..."); command = ["kaggle", "datasets", "create", "-p", ".", "-m", "Update params", "--dir-mode", "skip"]; result = subprocess.run(command, capture_output=True, text=True, check=False, timeout=120); if result.stdout: logging.info(f"Kaggle ds create stdout:\n{result.stdout}"); if result.stderr: logging.warning(f"Kaggle ds create stderr:\n{result.stderr}"); if result.returncode != 0 or ("error" in result.stderr.lower() and "error updating dataset" not in result.stderr.lower()): logging.error(f"Kaggle ds create/update failed. Code: {result.returncode}. Stderr: {result.stderr.strip()}"); dataset_created = False; else: logging.info("Kaggle dataset created/updated."); dataset_created = True; except FileNotFoundError as e: logging.critical(f"Kaggle command not found: {e}"); dataset_created = False; except subprocess.TimeoutExpired: logging.error("Timeout Kaggle dataset creation."); dataset_created = False; except (IOError, OSError) as e: logging.error(f"File I/O error dataset metadata: {e}"); dataset_created = False; except Exception as e: logging.critical(f"Unexpected error Kaggle dataset creation: {e}", exc_info=True); dataset_created = False; finally: if os.path.exists(PARAMS_JSON_FILENAME): try: os.remove(PARAMS_JSON_FILENAME); except OSError: pass; if os.path.exists(metadata_filename): try: os.remove(metadata_filename); except OSError: pass; if not dataset_created: return False; try: logging.info(f"Triggering Kaggle kernel push: {notebook_slug}"); params_dataset_full_slug = f"{notebook_slug.split('/')[0]}/{PARAMS_DATASET_SLUG}"; dummy_dir = "kaggle_push_dummy"; os.makedirs(dummy_dir, exist_ok=True); kernel_metadata = {"id": notebook_slug, "language": "python", "kernel_type": "notebook", "is_private": "true", "enable_gpu": "true", "enable_internet": "true", "dataset_sources": [params_dataset_full_slug], "competition_sources": [], "kernel_sources": []}; kernel_metadata_path = os.path.join(dummy_dir, "kernel-metadata.json"); with open(kernel_metadata_path, 'w') as f: json.dump(kernel_metadata, f); logging.info(f"Pushing kernel {notebook_slug}..."); command_push = ["kaggle", "kernels", "push", "-p", dummy_dir]; result_push = subprocess.run(command_push, capture_output=True, text=True, check=False, timeout=120); if result_push.stdout: logging.info(f"Kaggle push stdout:\n{result_push.stdout}"); if result_push.stderr: logging.warning(f"Kaggle push stderr:\n{result_push.stderr}"); if result_push.returncode == 0 and "successfully" in result_push.stdout.lower(): logging.info("Kaggle kernel push initiated."); return True; else: logging.error(f"Kaggle push failed/no success msg. Code: {result_push.returncode}."); return False; except FileNotFoundError as e: logging.critical(f"Kaggle command not found: {e}"); return False; except subprocess.TimeoutExpired: logging.error("Timeout Kaggle kernel push."); return False; except (IOError, OSError) as e: logging.error(f"File I/O error kernel push setup: {e}"); return False; except Exception as e: logging.critical(f"Unexpected error Kaggle kernel push: {e}", exc_info=True); return False; finally: if 'dummy_dir' in locals() and os.path.exists(dummy_dir): try: if os.path.exists(kernel_metadata_path): os.remove(kernel_metadata_path); os.rmdir(dummy_dir); except OSError as e: logging.warning(f"Could not cleanup dummy push dir: {e}")
-                            def check_kaggle_status(notebook_slug):
-                                # ... (check_kaggle_status remains unchanged) ...
-                                logging.debug(f"Checking Kaggle status: {notebook_slug}"); command = ["kaggle", "kernels", "status", notebook_slug]; try: result = subprocess.run(command, capture_output=True, text=True, check=False, timeout=60); output_line = result.stdout.strip(); if not output_line and result.stderr and "status" in result.stderr.lower(): output_line = result.stderr.strip().split('\n')[-1]; if result.returncode != 0: logging.error(f"Kaggle status cmd failed. Code: {result.returncode}. Stderr: {result.stderr.strip()}"); if "401" in result.stderr: logging.error("Kaggle API auth error (401)."); elif "404" in result.stderr: logging.error("Kaggle kernel not found (404)."); elif "429" in result.stderr: logging.warning("Kaggle API rate limit (429)."); return None; if not output_line: logging.warning("Kaggle status empty output."); return None; status_part = None; if ":" in output_line: status_part = output_line.split(':')[-1].strip().lower(); elif "-" in output_line: status_part = output_line.split('-')[-1].strip().lower(); if status_part: if "error" in status_part: return "error"; if "complete" in status_part: return "complete"; if "running" in status_part: return "running"; if "cancelled" in status_part: return "cancelled"; if "queued" in status_part: return "queued"; logging.warning(f"Unknown status parsed: '{status_part}'"); return None; else: logging.warning(f"Could not parse status line: '{output_line}'"); return None; except FileNotFoundError as e: logging.critical(f"Kaggle command not found: {e}"); return None; except subprocess.TimeoutExpired: logging.error("Timeout Kaggle status check."); return None; except Exception as e: logging.critical(f"Unexpected error Kaggle status check: {e}", exc_info=True); return None
-                            def download_kaggle_output(notebook_slug, destination_dir=".", download_image=False): ## <<< MODIFIED >>> ##
-                                logging.info(f"Attempting download from Kaggle kernel: {notebook_slug}")
-                                try: os.makedirs(destination_dir, exist_ok=True); except OSError as e: logging.error(f"Failed create dest dir: {e}"); return None, None, None;
-                                command = ["kaggle", "kernels", "output", notebook_slug, "-p", destination_dir, "--force"]; mp3_path, json_path, img_path = None, None, None;
-                                try:
-                                    logging.info(f"Running Kaggle download..."); result = subprocess.run(command, capture_output=True, text=True, check=False, timeout=300);
-                                    if result.stdout: logging.info(f"Kaggle download stdout:\n{result.stdout}");
-                                    if result.stderr: logging.warning(f"Kaggle download stderr:\n{result.stderr}");
-                                    if result.returncode != 0:
-                                        stderr_lower = result.stderr.lower();
-                                        if "404" in stderr_lower or "not found" in stderr_lower: logging.error("Kaggle download failed: 404.");
-                                        elif "no output files" in stderr_lower: logging.warning("Kaggle download: No output files.");
-                                        elif "401" in stderr_lower: logging.error("Kaggle download failed: 401.");
-                                        elif "429" in stderr_lower: logging.warning("Kaggle download failed: 429.");
-                                        else: logging.error(f"Kaggle download cmd failed. Code: {result.returncode}. Stderr: {result.stderr.strip()}");
-                                        return None, None, None;
-                                    logging.info("Kaggle download finished. Verifying...");
-                                    # Use defined constants <<< MODIFIED >>>
-                                    potential_mp3_path = os.path.join(destination_dir, KAGGLE_OUTPUT_MP3);
-                                    if os.path.exists(potential_mp3_path) and os.path.getsize(potential_mp3_path) > 100: mp3_path = potential_mp3_path; logging.info(f"Verified MP3: {mp3_path}");
-                                    else: logging.warning(f"MP3 '{KAGGLE_OUTPUT_MP3}' missing/empty.");
-                                    potential_json_path = os.path.join(destination_dir, KAGGLE_OUTPUT_JSON);
-                                    if os.path.exists(potential_json_path) and os.path.getsize(potential_json_path) > 2: json_path = potential_json_path; logging.info(f"Verified JSON: {json_path}");
-                                    else: logging.warning(f"JSON '{KAGGLE_OUTPUT_JSON}' missing/empty.");
-                                    if download_image:
-                                        potential_img_path = os.path.join(destination_dir, KAGGLE_OUTPUT_IMG);
-                                        if os.path.exists(potential_img_path) and os.path.getsize(potential_img_path) > 100: img_path = potential_img_path; logging.info(f"Verified Image: {img_path}");
-                                        else: logging.warning(f"Image '{KAGGLE_OUTPUT_IMG}' missing/empty.");
-                                    return mp3_path, json_path, img_path;
-                                except FileNotFoundError as e: logging.critical(f"Kaggle command not found: {e}"); return None, None, None;
-                                except subprocess.TimeoutExpired: logging.error("Timeout Kaggle download."); return None, None, None;
-                                except Exception as e: logging.critical(f"Unexpected error Kaggle download: {e}", exc_info=True); return None, None, None
-
-                            # --- Uniqueness Check ---
-                            # ... (compare_fingerprints, is_unique_enough remain unchanged) ...
-                            def compare_fingerprints(fp1_str, fp2_str): if not fp1_str or not fp2_str: return 0.0; return SequenceMatcher(None, fp1_str, fp2_str).ratio()
-                            def is_unique_enough(new_fingerprint, recent_fingerprints, threshold): if not new_fingerprint: logging.warning("New fingerprint empty."); return False; if not recent_fingerprints: return True; max_similarity = 0.0; for old_fingerprint in recent_fingerprints: similarity = compare_fingerprints(new_fingerprint, old_fingerprint); logging.debug(f"Comparing fingerprints: Sim = {similarity:.4f}"); if similarity > max_similarity: max_similarity = similarity; if similarity > threshold: logging.warning(f"Track too similar (Sim: {similarity:.4f} > Thr: {threshold})."); return False; logging.info(f"Uniqueness check passed. Max sim: {max_similarity:.4f} (Thr: {threshold})"); return True
-
-                            # --- Spotify API Interaction ---
-                            # ... (get_spotify_client, get_spotify_trending_keywords remain unchanged) ...
-                            _spotify_client = None
-                            def get_spotify_client(): global _spotify_client; if _spotify_client: return _spotify_client; if not SPOTIPY_AVAILABLE: logging.error("Spotipy not installed."); return None; logging.info("Authenticating with Spotify..."); try: client_id=os.environ.get('SPOTIPY_CLIENT_ID'); client_secret=os.environ.get('SPOTIPY_CLIENT_SECRET'); if not client_id or not client_secret: logging.error("Spotify creds missing."); return None; client_credentials_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret); sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager); sp.categories(limit=1); logging.info("Spotify client authenticated."); _spotify_client = sp; return _spotify_client; except SpotifyException as e: logging.error(f"Spotify API auth/call error: {e}", exc_info=True); return None; except requests.exceptions.RequestException as e: logging.error(f"Network error Spotify auth: {e}", exc_info=True); return None; except Exception as e: logging.critical(f"Unexpected error Spotify auth: {e}", exc_info=True); return None
-                            def get_spotify_trending_keywords(limit=10): sp = get_spotify_client(); if not sp: logging.error("Cannot fetch Spotify keywords: client unavailable."); return []; keywords = set(); final_keywords = []; try: logging.info("Fetching Spotify categories..."); categories = sp.categories(country='US', limit=max(limit // 2, 5))['categories']['items']; for category in categories: keywords.add(category['name'].lower()); logging.info("Fetching Spotify new releases..."); new_releases = sp.new_releases(limit=limit)['albums']['items']; for album in new_releases: for artist in album['artists']: try: artist_info = sp.artist(artist['id']); keywords.update(g.lower() for g in artist_info.get('genres', [])); except SpotifyException as art_e: logging.warning(f"Spotify API error artist genres {artist.get('name', artist['id'])}: {art_e}"); except requests.exceptions.RequestException as net_e: logging.warning(f"Network error artist genres {artist.get('name', artist['id'])}: {net_e}"); except Exception as e: logging.warning(f"Unexpected error artist genres {artist.get('name', artist['id'])}: {e}"); final_keywords = list(keywords)[:limit]; logging.info(f"Fetched {len(final_keywords)} Spotify keywords."); except SpotifyException as e: logging.error(f"Spotify API error fetching keywords: {e}", exc_info=True); except requests.exceptions.RequestException as e: logging.error(f"Network error fetching keywords: {e}", exc_info=True); except Exception as e: logging.critical(f"Unexpected error fetching keywords: {e}", exc_info=True); return final_keywords
-
-                            # --- Telegram Notification Utility --- ## <<< MODIFIED >>> ##
-                            _telegram_bot_instance = None
-                            def _get_telegram_bot(): global _telegram_bot_instance; if _telegram_bot_instance is None: token = os.environ.get('TELEGRAM_BOT_TOKEN'); if not token: logging.error("Cannot init Telegram Bot: Token secret missing."); return None; try: _telegram_bot_instance = telegram.Bot(token=token); logging.info("Telegram Bot instance initialized."); except Exception as e: logging.error(f"Failed init Telegram Bot: {e}", exc_info=True); _telegram_bot_instance = None; return _telegram_bot_instance
-                            async def _send_message_async(bot, chat_id, text, reply_markup=None):
-                                 try:
-                                      # <<< Use ParseMode.MARKDOWN_V2 >>>
-                                      await bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=reply_markup)
-                                      logging.info(f"Sent Telegram message to chat_id {chat_id}.")
-                                      return True
-                                 except telegram.error.TelegramError as e: logging.error(f"Telegram API error sending message: {e}", exc_info=True); return False
-                                 except Exception as e: logging.error(f"Unexpected error sending Telegram message: {e}", exc_info=True); return False
-                            def send_telegram_message(message, level="INFO", reply_markup=None):
-                                bot = _get_telegram_bot(); chat_id = os.environ.get('TELEGRAM_CHAT_ID'); if not bot: logging.error("TG message not sent: Bot not initialized."); return False; if not chat_id: logging.error("TG message not sent: Chat ID secret missing."); return False; prefix = f"[{level.upper()}]"; full_message = f"{prefix} {message}"; max_len = 4090; if len(full_message) > max_len: logging.warning(f"TG message too long. Truncating."); full_message = full_message[:max_len] + "..."; logging.info(f"Attempting send Telegram message (Level: {level})..."); try: success = asyncio.run(_send_message_async(bot, chat_id, full_message, reply_markup=reply_markup)); return success; except RuntimeError as e: logging.error(f"RuntimeError calling asyncio.run for Telegram: {e}. Loop running?"); return False; except Exception as e: logging.error(f"Unexpected error setting up asyncio for Telegram send: {e}", exc_info=True); return False
\ No newline at end of file
+# utils.py (Updated after RETHINK FIX)
+
+import json
+import os
+import logging
+import hashlib
+import subprocess
+import pickle
+import importlib.util
+# Only the light exception modules are imported here; Drive discovery, the OAuth flow and Spotipy load on first use.
+from googleapiclient.errors import HttpError
+from google.auth.exceptions import RefreshError
+import requests
+import socket
+import time
+import asyncio
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fingerprint_index import FingerprintIndex, similarity as fingerprint_similarity
+from state_store import StateStore
+from telegram_notifier import TelegramNotifier
+from kernel_source import inject_params, strip_params
+from downloads import download_files, IncompleteOutputError
+from audio_analysis import verify_mp3
+import metrics
+
+# --- Import Config and State ---
+from config import DRY_RUN, NUM_KAGGLE_ACCOUNTS, KAGGLE_PARAMS_IN_SOURCE
+from defaults import DEFAULT_STATE # Side-effect-free module; importing main here would run it a second time
+
+DEFAULT_STYLE_PROFILE = { "profile_id": "default", "last_updated": None, "recent_bpms": [], "recent_keys": [], "genre_counts": {}, "instrument_counts": {}, "mood_counts": {}, "prompt_keyword_counts": {}, "last_reset_track_count": 0, "_checksum": None }
+STYLE_PROFILE_FILE_PATH = "style_profile.json"
+FINGERPRINT_INDEX_PATH = "fingerprint_index.sqlite3" # Every kept track's fingerprint (see fingerprint_index.py); replaces state["recent_fingerprints"]
+
+# --- Kaggle Output Filenames --- ## <<< ADDED SECTION >>> ##
+# Ensure these match the filenames saved by your Kaggle notebook
+KAGGLE_OUTPUT_MP3 = "output.mp3"
+KAGGLE_OUTPUT_JSON = "result.json"
+KAGGLE_OUTPUT_IMG = "output_spectrogram.png"
+KAGGLE_OUTPUT_BATCH_MP3 = "output_{n}.mp3"   # Batch runs number their outputs from 0 in batch order
+KAGGLE_OUTPUT_BATCH_JSON = "result_{n}.json"
+
+
+SPOTIPY_AVAILABLE = importlib.util.find_spec("spotipy") is not None # Imported by get_spotify_client on first use
+class _SpotifyExceptionFallback(Exception): pass # Stand-in so `except SpotifyException` is valid before spotipy is imported
+SpotifyException = _SpotifyExceptionFallback # get_spotify_client() rebinds it to spotipy's class on first use
+if not SPOTIPY_AVAILABLE: logging.warning("Spotipy library not found.")
+
+# --- Resiliency Utilities ---
+def retry_operation(func, args=None, kwargs=None, max_retries=3, delay_seconds=5, allowed_exceptions=None, operation_name="Operation", metric_name=None):
+    # Every attempt is timed into metrics under metric_name (default: operation_name without its "(...)" suffix, snake_cased).
+    if metric_name is None: metric_name = operation_name.split(" (")[0].strip().lower().replace(" ", "_")
+    if args is None: args = ()
+    if kwargs is None: kwargs = {}
+    if allowed_exceptions is None:
+         allowed_exceptions = ( requests.exceptions.RequestException, socket.timeout, TimeoutError, HttpError, SpotifyException, subprocess.TimeoutExpired, IncompleteOutputError, )
+    retries = 0
+    while retries <= max_retries:
+        attempt_started = time.perf_counter()
+        try:
+            logging.info(f"Attempting {operation_name} (Attempt {retries + 1}/{max_retries + 1})...")
+            result = func(*args, **kwargs)
+            metrics.observe(metric_name, time.perf_counter() - attempt_started, "ok" if result is not None and result is not False else "failed")
+            logging.info(f"{operation_name} successful.")
+            return result
+        except allowed_exceptions as e:
+            metrics.observe(metric_name, time.perf_counter() - attempt_started, "error")
+            logging.warning(f"{operation_name} failed on attempt {retries + 1}: {type(e).__name__} - {e}")
+            retries += 1
+            if retries <= max_retries:
+                metrics.count("retries", operation=metric_name); current_delay = delay_seconds * (2 ** (retries - 1)); jitter = current_delay * random.uniform(0.1, 0.5); wait_time = current_delay + jitter
+                logging.info(f"Retrying {operation_name} in {wait_time:.2f} seconds...")
+                time.sleep(wait_time)
+            else: metrics.count("retries_exhausted", operation=metric_name); logging.error(f"{operation_name} failed after {max_retries + 1} attempts."); logging.exception(f"Final failure details for {operation_name}:"); return None
+        except Exception as e: metrics.observe(metric_name, time.perf_counter() - attempt_started, "exception"); logging.critical(f"Unexpected error during {operation_name} (Attempt {retries + 1}): {e}", exc_info=True); return None
+    return None
+
+# --- State Management Functions ---
+def _read_state_file(filepath):
+    logging.info(f"Attempting load state: {filepath}")
+    try:
+        if not os.path.exists(filepath): logging.warning(f"State file '{filepath}' not found."); return DEFAULT_STATE.copy()
+        with open(filepath, 'r', encoding='utf-8') as f: state_str = f.read()
+        if not state_str.strip(): logging.warning(f"State file '{filepath}' empty."); return DEFAULT_STATE.copy()
+        loaded_state = json.loads(state_str); stored_checksum = loaded_state.get('_checksum')
+        if stored_checksum:
+            state_copy_for_checksum = loaded_state.copy(); state_copy_for_checksum.pop('_checksum', None)
+            try:
+                checksum_str = json.dumps(state_copy_for_checksum, separators=(',', ':'), sort_keys=True).encode('utf-8'); calculated_checksum = hashlib.sha256(checksum_str).hexdigest()
+                if calculated_checksum != stored_checksum: logging.error(f"STATE CHECKSUM MISMATCH!"); return DEFAULT_STATE.copy()
+                else: logging.debug("State checksum verified.")
+            except Exception as checksum_e: logging.error(f"Failed verify checksum: {checksum_e}.")
+        else: logging.warning("No checksum in state file.")
+        state_updated = False
+        for key, default_value in DEFAULT_STATE.items():
+            if key not in loaded_state: logging.warning(f"Key '{key}' missing."); loaded_state[key] = default_value; state_updated = True
+        # Legacy "recent_fingerprints" is left in place only so migrate_recent_fingerprints() can move it into the index.
+        if "recent_fingerprints" in loaded_state and not isinstance(loaded_state.get("recent_fingerprints"), list): logging.warning("State 'recent_fingerprints' not list."); loaded_state.pop("recent_fingerprints"); state_updated = True
+        if not isinstance(loaded_state.get("kaggle_usage"), list): logging.warning("State 'kaggle_usage' not list."); loaded_state["kaggle_usage"] = DEFAULT_STATE["kaggle_usage"]; state_updated = True
+        for time_key in ("last_gdrive_cleanup_time", "last_health_check_time", "intervention_pending_since"):
+            if loaded_state.get(time_key) is not None and not isinstance(loaded_state.get(time_key), str): logging.warning(f"State '{time_key}' not None/string."); loaded_state[time_key] = None; state_updated = True
+        if state_updated: logging.info("Loaded state updated.")
+        return loaded_state
+    except FileNotFoundError: logging.warning(f"State file '{filepath}' not found."); return DEFAULT_STATE.copy()
+    except json.JSONDecodeError as e: logging.error(f"Failed decode state JSON: {e}."); return DEFAULT_STATE.copy()
+    except Exception as e: logging.critical(f"Unexpected error loading state: {e}", exc_info=True); return DEFAULT_STATE.copy()
+def _write_state_file(state_data, filepath):
+    temp_filepath = filepath + ".tmp"
+    try:
+        state_copy_for_checksum = state_data.copy(); state_copy_for_checksum.pop('_checksum', None)
+        try: checksum_str = json.dumps(state_copy_for_checksum, separators=(',', ':'), sort_keys=True).encode('utf-8'); state_data['_checksum'] = hashlib.sha256(checksum_str).hexdigest(); logging.debug(f"Calculated state checksum.")
+        except Exception as checksum_e: logging.error(f"Failed calculate checksum: {checksum_e}."); state_data['_checksum'] = None
+        state_str = json.dumps(state_data, indent=4)
+        with open(temp_filepath, 'w', encoding='utf-8') as f: f.write(state_str); f.flush(); os.fsync(f.fileno())
+        os.replace(temp_filepath, filepath); logging.info(f"State saved to {filepath}."); return True
+    except (IOError, OSError) as e: logging.critical(f"File I/O error saving state: {e}", exc_info=True)
+    except Exception as e: logging.critical(f"Unexpected error saving state: {e}", exc_info=True)
+    if os.path.exists(temp_filepath):
+        try: os.remove(temp_filepath)
+        except OSError as rm_e: logging.error(f"Failed remove temp state file: {rm_e}")
+    return False
+
+# --- State Store --- ## <<< ADDED SECTION >>> ##
+# load_state/save_state go through one in-process StateStore per file (state_store.py): reads come from memory and
+# saves append only the changed top-level keys to the journal; the full file is rewritten on compaction.
+_state_stores = {}
+_state_stores_lock = threading.Lock()
+def get_state_store(filepath):
+    with _state_stores_lock:
+        store = _state_stores.get(filepath)
+        if store is None: store = StateStore(filepath, _read_state_file, _write_state_file); _state_stores[filepath] = store
+        return store
+def load_state(filepath):
+    try: return get_state_store(filepath).load()
+    except Exception as e: logging.critical(f"Unexpected error loading state: {e}", exc_info=True); return DEFAULT_STATE.copy()
+def save_state(state_data, filepath):
+    try: return get_state_store(filepath).save(state_data)
+    except Exception as e: logging.critical(f"Unexpected error saving state: {e}", exc_info=True); return False
+def compact_state(filepath):
+    # Makes the state file itself current (e.g. before it is uploaded as a backup).
+    try: return get_state_store(filepath).compact()
+    except Exception as e: logging.error(f"Failed compact state {filepath}: {e}", exc_info=True); return False
+def close_state_stores():
+    # Folds every journal into its state file; called on shutdown so the next start reads one compact file.
+    with _state_stores_lock:
+        for store in _state_stores.values():
+            try: store.close()
+            except Exception as e: logging.error(f"Failed close state store {store.filepath}: {e}", exc_info=True)
+
+# --- Style Profile Management Functions ---
+def load_style_profile(filepath=STYLE_PROFILE_FILE_PATH):
+    # ... (load_style_profile remains unchanged) ...
+    logging.info(f"Attempting load style profile: {filepath}")
+    try:
+        if not os.path.exists(filepath): logging.warning(f"Style profile '{filepath}' not found."); return DEFAULT_STYLE_PROFILE.copy()
+        with open(filepath, 'r', encoding='utf-8') as f: profile_str = f.read()
+        if not profile_str.strip(): logging.warning(f"Style profile '{filepath}' empty."); return DEFAULT_STYLE_PROFILE.copy()
+        loaded_profile = json.loads(profile_str); stored_checksum = loaded_profile.get('_checksum')
+        if stored_checksum:
+            profile_copy_for_checksum = loaded_profile.copy(); profile_copy_for_checksum.pop('_checksum', None)
+            try:
+                checksum_str = json.dumps(profile_copy_for_checksum, separators=(',', ':'), sort_keys=True).encode('utf-8'); calculated_checksum = hashlib.sha256(checksum_str).hexdigest()
+                if calculated_checksum != stored_checksum: logging.error(f"STYLE PROFILE CHECKSUM MISMATCH!"); return DEFAULT_STYLE_PROFILE.copy()
+                else: logging.debug("Style profile checksum verified.")
+            except Exception as checksum_e: logging.error(f"Failed verify style profile checksum: {checksum_e}.")
+        else: logging.warning("No checksum in style profile.")
+        profile_updated = False
+        for key, default_value in DEFAULT_STYLE_PROFILE.items():
+            if key not in loaded_profile: logging.warning(f"Style profile key '{key}' missing."); loaded_profile[key] = default_value; profile_updated = True
+        if not isinstance(loaded_profile.get("recent_bpms"), list): logging.warning("Style 'recent_bpms' not list."); loaded_profile["recent_bpms"] = []; profile_updated = True
+        if not isinstance(loaded_profile.get("recent_keys"), list): logging.warning("Style 'recent_keys' not list."); loaded_profile["recent_keys"] = []; profile_updated = True
+        if not isinstance(loaded_profile.get("genre_counts"), dict): logging.warning("Style 'genre_counts' not dict."); loaded_profile["genre_counts"] = {}; profile_updated = True
+        if not isinstance(loaded_profile.get("instrument_counts"), dict): logging.warning("Style 'instrument_counts' not dict."); loaded_profile["instrument_counts"] = {}; profile_updated = True
+        if not isinstance(loaded_profile.get("mood_counts"), dict): logging.warning("Style 'mood_counts' not dict."); loaded_profile["mood_counts"] = {}; profile_updated = True
+        if not isinstance(loaded_profile.get("prompt_keyword_counts"), dict): logging.warning("Style 'prompt_keyword_counts' not dict."); loaded_profile["prompt_keyword_counts"] = {}; profile_updated = True
+        if not isinstance(loaded_profile.get("last_reset_track_count"), int): logging.warning("Style 'last_reset_track_count' not int."); loaded_profile["last_reset_track_count"] = 0; profile_updated = True
+        if profile_updated: logging.info("Loaded style profile updated.")
+        return loaded_profile
+    except FileNotFoundError: logging.warning(f"Style profile '{filepath}' not found."); return DEFAULT_STYLE_PROFILE.copy()
+    except json.JSONDecodeError as e: logging.error(f"Failed decode style profile JSON: {e}."); return DEFAULT_STYLE_PROFILE.copy()
+    except Exception as e: logging.critical(f"Unexpected error loading style profile: {e}", exc_info=True); return DEFAULT_STYLE_PROFILE.copy()
+def save_style_profile(profile_data, filepath=STYLE_PROFILE_FILE_PATH):
+    # ... (save_style_profile remains unchanged) ...
+    temp_filepath = filepath + ".tmp"
+    try:
+        profile_copy_for_checksum = profile_data.copy(); profile_copy_for_checksum.pop('_checksum', None)
+        try: checksum_str = json.dumps(profile_copy_for_checksum, separators=(',', ':'), sort_keys=True).encode('utf-8'); profile_data['_checksum'] = hashlib.sha256(checksum_str).hexdigest(); logging.debug(f"Calculated style profile checksum.")
+        except Exception as checksum_e: logging.error(f"Failed calculate style profile checksum: {checksum_e}."); profile_data['_checksum'] = None
+        profile_str = json.dumps(profile_data, indent=4)
+        with open(temp_filepath, 'w', encoding='utf-8') as f: f.write(profile_str)
+        os.replace(temp_filepath, filepath); logging.info(f"Style profile saved to {filepath}."); return True
+    except (IOError, OSError) as e: logging.critical(f"File I/O error saving style profile: {e}", exc_info=True)
+    except Exception as e: logging.critical(f"Unexpected error saving style profile: {e}", exc_info=True)
+    if os.path.exists(temp_filepath):
+        try: os.remove(temp_filepath)
+        except OSError as rm_e: logging.error(f"Failed remove temp style profile file: {rm_e}")
+    return False
+
+# --- Google Drive Authentication ---
+# ... (authenticate_gdrive remains unchanged) ...
+SCOPES = ['https://www.googleapis.com/auth/drive.file']; TOKEN_PICKLE_PATH = 'token.pickle'; _gdrive_service = None
+def _build_drive_service(**kwargs):
+    # googleapiclient.discovery is the slowest import in the process, so it loads with the first Drive service.
+    from googleapiclient.discovery import build
+    return build('drive', 'v3', **kwargs)
+def authenticate_gdrive():
+    global _gdrive_service
+    if _gdrive_service: return _gdrive_service
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.transport.requests import Request
+    creds = None
+    if os.path.exists(TOKEN_PICKLE_PATH):
+        try:
+            with open(TOKEN_PICKLE_PATH, 'rb') as token_file: creds = pickle.load(token_file)
+            logging.info("Loaded GDrive token.")
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError) as e: logging.warning(f"Failed load token: {e}. Re-auth."); creds = None
+        except Exception as e: logging.error(f"Unexpected error loading token: {e}. Re-auth.", exc_info=True); creds = None
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            try: logging.info("GDrive token expired. Refreshing..."); creds.refresh(Request()); logging.info("Token refreshed.")
+            except RefreshError as e: logging.error(f"Failed refresh GDrive token (RefreshError): {e}. Re-auth."); creds = None
+            except requests.exceptions.RequestException as e: logging.error(f"Network error during GDrive refresh: {e}. Re-auth."); creds = None
+            except Exception as e: logging.error(f"Unexpected error refreshing GDrive token: {e}. Re-auth.", exc_info=True); creds = None
+        else:
+            try:
+                google_creds_json_str_env = os.environ.get('GOOGLE_CREDS_JSON')
+                if google_creds_json_str_env:
+                    try: GOOGLE_CREDS_INFO = json.loads(google_creds_json_str_env); logging.info("Loaded GOOGLE_CREDS_INFO from env.")
+                    except json.JSONDecodeError as env_json_e: logging.critical(f"Failed parse GOOGLE_CREDS_JSON from env: {env_json_e}"); GOOGLE_CREDS_INFO = None
+                else: GOOGLE_CREDS_INFO = None
+                if not GOOGLE_CREDS_INFO: logging.critical("GDrive creds info missing."); return None
+                flow = InstalledAppFlow.from_client_info(GOOGLE_CREDS_INFO, SCOPES); logging.info("Attempting GDrive auth flow..."); creds = flow.run_console(); logging.info("Auth flow completed.")
+            except Exception as e: logging.critical(f"Failed GDrive interactive auth flow: {e}", exc_info=True); return None
+        if creds:
+            try:
+                with open(TOKEN_PICKLE_PATH, 'wb') as token_file: pickle.dump(creds, token_file)
+                logging.info(f"GDrive token saved.")
+            except (IOError, OSError) as e: logging.error(f"Failed save GDrive token pickle: {e}")
+            except Exception as e: logging.error(f"Unexpected error saving token pickle: {e}", exc_info=True)
+        else: logging.error("Auth resulted in invalid GDrive creds."); return None
+    if not creds: logging.error("Cannot build GDrive service: No valid creds."); return None
+    try: _gdrive_service = _build_drive_service(credentials=creds); logging.info("GDrive service built."); return _gdrive_service
+    except HttpError as e: logging.critical(f"Failed build GDrive service (HttpError): {e}", exc_info=True); return None
+    except Exception as e: logging.critical(f"Unexpected error building GDrive service: {e}", exc_info=True); return None
+
+# --- Google Drive File Operations ---
+def upload_to_gdrive(service, local_filepath, gdrive_folder_id, gdrive_filename):
+    if DRY_RUN: logging.warning(f"[DRY RUN] Skipping GDrive upload of '{local_filepath}' as '{gdrive_filename}'"); return f"dry_run_fake_id_{random.randint(1000,9999)}"
+    if not service: logging.error("GDrive service invalid for upload."); return None
+    try:
+        if not os.path.exists(local_filepath): logging.error(f"Local file '{local_filepath}' not found."); return None
+        logging.info(f"Uploading '{local_filepath}' to Drive as '{gdrive_filename}'..."); file_metadata = {'name': gdrive_filename, 'parents': [gdrive_folder_id]}
+        from googleapiclient.http import MediaFileUpload
+        media = MediaFileUpload(local_filepath, resumable=True); file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
+        uploaded_file_id = file.get('id'); logging.info(f"File uploaded. ID: {uploaded_file_id}"); return uploaded_file_id
+    except HttpError as e:
+        logging.error(f"Google API HTTP error during upload: {e}", exc_info=True)
+        if e.resp.status == 403 and 'quota' in str(e).lower(): logging.critical("Google Drive Quota Exceeded!")
+        return None
+    except (socket.timeout, requests.exceptions.Timeout, TimeoutError) as e: logging.error(f"Timeout error during GDrive upload: {e}", exc_info=True); return None
+    except requests.exceptions.RequestException as e: logging.error(f"Network error during GDrive upload: {e}", exc_info=True); return None
+    except FileNotFoundError: logging.error(f"Local file '{local_filepath}' unavailable during upload."); return None
+    except Exception as e: logging.critical(f"Unexpected error during GDrive upload: {e}", exc_info=True); return None
+def get_gdrive_files(service, folder_id):
+    # ... (get_gdrive_files remains unchanged) ...
+    if not service: logging.error("GDrive service invalid."); return []
+    files_list = []; page_token = None
+    try:
+        logging.info(f"Listing files in GDrive folder: {folder_id}")
+        while True:
+            response = service.files().list(q=f"'{folder_id}' in parents and trashed=false", spaces='drive', fields='nextPageToken, files(id, name, createdTime)', pageSize=100, pageToken=page_token).execute(); files = response.get('files', [])
+            if not files and page_token is None and not files_list: logging.info("No files found."); break
+            files_list.extend(files); page_token = response.get('nextPageToken', None)
+            if page_token is None: break
+        logging.info(f"Found {len(files_list)} total files."); return files_list
+    except HttpError as e: logging.error(f"Google API HTTP error listing files: {e}", exc_info=True); return []
+    except (socket.timeout, requests.exceptions.Timeout, TimeoutError) as e: logging.error(f"Timeout error listing files: {e}", exc_info=True); return []
+    except requests.exceptions.RequestException as e: logging.error(f"Network error listing files: {e}", exc_info=True); return []
+    except Exception as e: logging.critical(f"Unexpected error listing files: {e}", exc_info=True); return []
+def delete_gdrive_file(service, file_id):
+    if DRY_RUN: logging.warning(f"[DRY RUN] Skipping GDrive deletion of file ID: {file_id}"); return True
+    if not service: logging.error("GDrive service invalid."); return False
+    if not file_id: logging.error("No file ID provided."); return False
+    try: logging.warning(f"Attempting delete GDrive file ID: {file_id}"); service.files().delete(fileId=file_id).execute(); logging.info(f"Deleted GDrive file ID: {file_id}"); return True
+    except HttpError as e:
+        if e.resp.status == 404: logging.warning(f"File ID {file_id} not found."); return True
+        elif e.resp.status == 403: logging.error(f"Permission error deleting {file_id}: {e}"); return False
+        else: logging.error(f"Google API HTTP error deleting {file_id}: {e}", exc_info=True); return False
+    except (socket.timeout, requests.exceptions.Timeout, TimeoutError) as e: logging.error(f"Timeout error deleting {file_id}: {e}", exc_info=True); return False
+    except requests.exceptions.RequestException as e: logging.error(f"Network error deleting {file_id}: {e}", exc_info=True); return False
+    except Exception as e: logging.critical(f"Unexpected error deleting {file_id}: {e}", exc_info=True); return False
+_gdrive_thread_local = threading.local()
+def _get_thread_gdrive_http(service):
+    # httplib2 connections are not thread-safe; each cleanup worker gets its own authorized Http sharing the service's credentials.
+    http = getattr(_gdrive_thread_local, "http", None)
+    if http is None:
+        import google_auth_httplib2, httplib2
+        credentials = getattr(getattr(service, "_http", None), "credentials", None)
+        if credentials is None: return None
+        http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=60)); _gdrive_thread_local.http = http
+    return http
+def get_thread_gdrive_service(service):
+    # Drive service bound to this thread's own Http, for work running off the orchestrator thread (e.g. cleanup).
+    http = _get_thread_gdrive_http(service)
+    if http is None: return None
+    try: return _build_drive_service(http=http, cache_discovery=False)
+    except Exception as e: logging.error(f"Failed build thread-local GDrive service: {e}", exc_info=True); return None
+def _is_gdrive_rate_limited(error):
+    if error.resp.status == 429: return True
+    return error.resp.status == 403 and any(reason in str(error) for reason in ("rateLimitExceeded", "userRateLimitExceeded"))
+def _delete_gdrive_chunk(service, file_ids, max_attempts):
+    # One Drive batch request per round; only rate-limited deletes are retried, with exponential backoff and jitter.
+    import httplib2
+    deleted, failed, pending = set(), set(), list(file_ids)
+    for attempt in range(1, max_attempts + 1):
+        retry = []
+        def on_response(request_id, response, exception):
+            if exception is None: deleted.add(request_id)
+            elif isinstance(exception, HttpError) and exception.resp.status == 404: logging.warning(f"File ID {request_id} not found."); deleted.add(request_id)
+            elif isinstance(exception, HttpError) and _is_gdrive_rate_limited(exception): retry.append(request_id)
+            else: logging.error(f"Failed delete GDrive file {request_id}: {exception}"); failed.add(request_id)
+        batch = service.new_batch_http_request(callback=on_response)
+        for file_id in pending: batch.add(service.files().delete(fileId=file_id), request_id=file_id)
+        try: batch.execute(http=_get_thread_gdrive_http(service))
+        except HttpError as e:
+            if not _is_gdrive_rate_limited(e): logging.error(f"GDrive batch delete failed: {e}", exc_info=True); failed.update(pending); break
+            retry = [f for f in pending if f not in deleted and f not in failed]
+        except (socket.timeout, requests.exceptions.RequestException, httplib2.HttpLib2Error, OSError) as e: logging.warning(f"Network error during GDrive batch delete: {e}"); retry = [f for f in pending if f not in deleted and f not in failed]
+        if not retry: return deleted, failed
+        delay = min(64, 2 ** attempt) + random.uniform(0, 1); logging.warning(f"GDrive rate limit on {len(retry)} deletes. Retrying in {delay:.1f}s (attempt {attempt}/{max_attempts}).")
+        time.sleep(delay); pending = retry
+    failed.update(f for f in pending if f not in deleted); return deleted, failed
+def delete_gdrive_files_batch(service, file_ids, batch_size=50, max_workers=3, max_attempts=5):
+    # Deletes many files with Drive batch requests (batch_size deletes each, max 100), up to max_workers batches in flight.
+    # Returns the set of IDs that are gone (404 counts as deleted).
+    file_ids = [f for f in file_ids if f]
+    if not file_ids: return set()
+    if DRY_RUN: logging.warning(f"[DRY RUN] Skipping GDrive deletion of {len(file_ids)} files."); return set(file_ids)
+    if not service: logging.error("GDrive service invalid."); return set()
+    if _get_thread_gdrive_http(service) is None: logging.warning("No GDrive credentials for batch delete. Deleting one by one."); return {f for f in file_ids if delete_gdrive_file(service, f)}
+    chunks = [file_ids[i:i + batch_size] for i in range(0, len(file_ids), batch_size)]; deleted, failed = set(), set()
+    logging.info(f"Deleting {len(file_ids)} GDrive files in {len(chunks)} batch requests ({max_workers} in parallel)...")
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as executor:
+        for future in as_completed([executor.submit(_delete_gdrive_chunk, service, chunk, max_attempts) for chunk in chunks]):
+            try: chunk_deleted, chunk_failed = future.result(); deleted.update(chunk_deleted); failed.update(chunk_failed)
+            except Exception as e: logging.error(f"Unexpected error in GDrive batch delete worker: {e}", exc_info=True)
+    logging.info(f"GDrive batch delete finished. Deleted: {len(deleted)}, Failed: {len(failed)}")
+    return deleted
+
+# --- Kaggle API Client Pool ---
+# One authenticated in-process KaggleApi per account, keyed by account index. Credentials are parsed once from the
+# KAGGLE_JSON_<n> secrets and never written to ~/.kaggle, so calls for different accounts can run concurrently.
+_kaggle_api_class = None; _kaggle_credentials = None; _kaggle_clients = {}; _kaggle_client_locks = {}; _kaggle_pool_lock = threading.Lock()
+def _load_kaggle_credentials():
+    global _kaggle_credentials
+    if _kaggle_credentials is not None: return _kaggle_credentials
+    credentials = {}
+    for i in range(NUM_KAGGLE_ACCOUNTS):
+        cred_str = os.environ.get(f'KAGGLE_JSON_{i+1}')
+        if not cred_str: logging.warning(f"Kaggle creds JSON missing index {i} (KAGGLE_JSON_{i+1})."); continue
+        try: cred = json.loads(cred_str)
+        except json.JSONDecodeError as e: logging.error(f"Failed parse KAGGLE_JSON_{i+1}: {e}"); continue
+        if not isinstance(cred, dict) or not cred.get("username") or not cred.get("key"): logging.error(f"KAGGLE_JSON_{i+1} lacks username/key."); continue
+        credentials[i] = {"username": cred["username"], "key": cred["key"]}
+    logging.info(f"Parsed Kaggle credentials for account indexes: {sorted(credentials)}")
+    _kaggle_credentials = credentials
+    return _kaggle_credentials
+def get_kaggle_username(account_index):
+    cred = _load_kaggle_credentials().get(account_index)
+    return cred["username"] if cred else None
+def _get_kaggle_api_class():
+    # Importing the kaggle package authenticates at import time (env vars or ~/.kaggle/kaggle.json), so seed the
+    # environment from the first parsed account before the first import instead of writing a config file.
+    global _kaggle_api_class
+    if _kaggle_api_class is None:
+        credentials = _load_kaggle_credentials()
+        if credentials: first = credentials[min(credentials)]; os.environ.setdefault('KAGGLE_USERNAME', first["username"]); os.environ.setdefault('KAGGLE_KEY', first["key"])
+        from kaggle.api.kaggle_api_extended import KaggleApi
+        _kaggle_api_class = KaggleApi
+    return _kaggle_api_class
+def get_kaggle_client(account_index):
+    with _kaggle_pool_lock:
+        client = _kaggle_clients.get(account_index)
+        if client is not None: return client
+        cred = _load_kaggle_credentials().get(account_index)
+        if not cred: logging.error(f"Invalid or missing Kaggle creds for index {account_index}."); return None
+        try:
+            client = _get_kaggle_api_class()()
+            client._load_config({"username": cred["username"], "key": cred["key"]})
+        except ImportError as e: logging.critical(f"Kaggle library not installed: {e}"); return None
+        except Exception as e: logging.critical(f"Failed init Kaggle client index {account_index}: {e}", exc_info=True); return None
+        _kaggle_clients[account_index] = client; _kaggle_client_locks[account_index] = threading.Lock()
+        logging.info(f"Kaggle client ready for index {account_index} ({cred['username']}).")
+        return client
+def _kaggle_error_status(error):
+    status = getattr(error, 'status', None)
+    if status is None: status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status
+def _log_kaggle_api_error(operation, error):
+    status = _kaggle_error_status(error)
+    if status == 401: logging.error(f"Kaggle API auth error (401) during {operation}.")
+    elif status == 404: logging.error(f"Kaggle resource not found (404) during {operation}.")
+    elif status == 429: logging.warning(f"Kaggle API rate limit (429) during {operation}.")
+    else: logging.error(f"Kaggle API error during {operation}: {type(error).__name__} - {error}", exc_info=True)
+def _response_field(response, field):
+    if isinstance(response, dict): return response.get(field)
+    return getattr(response, field, None)
+def setup_kaggle_api(account_index):
+    # Kept for callers that only need to know an account is usable; no global config file is touched anymore.
+    logging.info(f"Setting up Kaggle API index: {account_index}")
+    return get_kaggle_client(account_index) is not None
+def kaggle_health_check(account_index):
+    api = get_kaggle_client(account_index)
+    if api is None: return None
+    try:
+        with _kaggle_client_locks[account_index]: api.kernels_list(mine=True, page_size=1)
+        return True
+    except Exception as e: _log_kaggle_api_error("health check list", e); return None
+
+# --- Kaggle Notebook Execution ---
+PARAMS_JSON_FILENAME = "params.json"; PARAMS_DATASET_SLUG = "notebook-params-temp"
+KERNEL_SOURCE_REFRESH_HOURS = 24    # Re-pull the notebook source this often so edits made on Kaggle are picked up
+_kernel_source_cache = {}; _kernel_source_lock = threading.Lock()
+def _get_kernel_source(api, notebook_slug, account_index, work_dir):
+    # (code_file, source_text, metadata) of the notebook without any injected params cell; pulled at most every KERNEL_SOURCE_REFRESH_HOURS.
+    key = (account_index, notebook_slug)
+    with _kernel_source_lock: cached = _kernel_source_cache.get(key)
+    if cached and time.monotonic() - cached[0] < KERNEL_SOURCE_REFRESH_HOURS * 3600: return cached[1]
+    pull_dir = os.path.join(work_dir, "kernel_source"); source = None
+    try:
+        os.makedirs(pull_dir, exist_ok=True); logging.info(f"Pulling notebook source for {notebook_slug}...")
+        with _kaggle_client_locks[account_index]: api.kernels_pull(notebook_slug, path=pull_dir, metadata=True, quiet=True)
+        with open(os.path.join(pull_dir, "kernel-metadata.json"), 'r', encoding='utf-8') as f: metadata = json.load(f)
+        code_file = os.path.basename(metadata.get("code_file") or "")
+        if code_file:
+            with open(os.path.join(pull_dir, code_file), 'r', encoding='utf-8') as f: source = (code_file, strip_params(f.read(), code_file), metadata)
+        else: logging.error(f"Pulled kernel metadata for {notebook_slug} has no code_file.")
+    except (IOError, OSError, ValueError) as e: logging.error(f"Failed read pulled notebook source for {notebook_slug}: {e}")
+    except Exception as e: _log_kaggle_api_error("kernel pull", e)
+    if source is None:
+        if cached: logging.warning(f"Using cached notebook source for {notebook_slug} (refresh failed)."); return cached[1]
+        return None
+    with _kernel_source_lock: _kernel_source_cache[key] = (time.monotonic(), source)
+    logging.info(f"Cached notebook source for {notebook_slug} ({source[0]})."); return source
+def _forget_kernel_source(account_index, notebook_slug):
+    with _kernel_source_lock: _kernel_source_cache.pop((account_index, notebook_slug), None)
+def _push_kernel_with_params(api, notebook_slug, params_dict, work_dir, account_index):
+    # One API call per run: the cached source with a params cell in front (see kernel_source.py) is pushed as the new version.
+    source = _get_kernel_source(api, notebook_slug, account_index, work_dir)
+    if source is None: logging.error(f"No notebook source for {notebook_slug} to embed params in."); return False
+    code_file, source_text, pulled_metadata = source; push_dir = os.path.join(work_dir, "kaggle_push")
+    dataset_sources = [slug for slug in pulled_metadata.get("dataset_sources", []) if slug.split('/')[-1] != PARAMS_DATASET_SLUG]
+    kernel_metadata = dict(pulled_metadata, id=notebook_slug, code_file=code_file, is_private="true", enable_gpu="true", enable_internet="true", dataset_sources=dataset_sources)
+    try:
+        os.makedirs(push_dir, exist_ok=True)
+        with open(os.path.join(push_dir, code_file), 'w', encoding='utf-8') as f: f.write(inject_params(source_text, code_file, params_dict))
+        with open(os.path.join(push_dir, "kernel-metadata.json"), 'w', encoding='utf-8') as f: json.dump(kernel_metadata, f)
+        logging.info(f"Pushing kernel {notebook_slug} with embedded params...")
+        with _kaggle_client_locks[account_index]: result_push = api.kernels_push(push_dir)
+        push_error = _response_field(result_push, "error")
+        if push_error: logging.error(f"Kaggle push failed: {push_error}"); _forget_kernel_source(account_index, notebook_slug); return False
+        logging.info(f"Kaggle kernel push initiated. Version: {_response_field(result_push, 'versionNumber')}, URL: {_response_field(result_push, 'url')}"); return True
+    except (IOError, OSError, ValueError) as e: logging.error(f"File I/O error kernel push setup: {e}"); return False
+    except Exception as e: _log_kaggle_api_error("kernel push", e); _forget_kernel_source(account_index, notebook_slug); return False
+def trigger_kaggle_notebook(notebook_slug, params_dict, work_dir=".", account_index=0):
+    if DRY_RUN: logging.warning(f"[DRY RUN] Skipping Kaggle trigger for {notebook_slug}"); return True
+    # All files for this trigger live in work_dir, so slots triggering different accounts never share params/metadata files.
+    logging.info(f"Triggering Kaggle notebook: {notebook_slug} (account {account_index}, work dir: {work_dir})")
+    api = get_kaggle_client(account_index)
+    if api is None: return False
+    try: params_json_str = json.dumps(params_dict)
+    except TypeError as e: logging.error(f"Failed serialize params: {e}"); return False
+    if KAGGLE_PARAMS_IN_SOURCE: return _push_kernel_with_params(api, notebook_slug, params_dict, work_dir, account_index)
+    params_dir = os.path.join(work_dir, "kaggle_params"); dummy_dir = os.path.join(work_dir, "kaggle_push_dummy")
+    params_path = os.path.join(params_dir, PARAMS_JSON_FILENAME); metadata_path = os.path.join(params_dir, "dataset-metadata.json"); kernel_metadata_path = os.path.join(dummy_dir, "kernel-metadata.json")
+    metadata_content = {"title": "Notebook Params Temp", "id": f"{notebook_slug.split('/')[0]}/{PARAMS_DATASET_SLUG}", "licenses": [{"name": "CC0-1.0"}]}; dataset_created = False
+    try:
+        os.makedirs(params_dir, exist_ok=True)
+        with open(params_path, 'w') as f: f.write(params_json_str)
+        with open(metadata_path, 'w') as f: json.dump(metadata_content, f, indent=4)
+        logging.info(f"Created {params_path} and dataset metadata. Uploading params as dataset version...")
+        with _kaggle_client_locks[account_index]:
+            response = api.dataset_create_version(params_dir, "Update params", quiet=True, dir_mode="skip")
+            if _response_field(response, "status") != "ok" and _response_field(response, "error"):
+                logging.warning(f"Kaggle ds version failed ({_response_field(response, 'error')}). Creating dataset..."); response = api.dataset_create_new(params_dir, quiet=True, dir_mode="skip")
+        if _response_field(response, "error"): logging.error(f"Kaggle ds create/update failed: {_response_field(response, 'error')}"); dataset_created = False
+        else: logging.info("Kaggle dataset created/updated."); dataset_created = True
+    except (IOError, OSError) as e: logging.error(f"File I/O error dataset metadata: {e}"); dataset_created = False
+    except Exception as e: _log_kaggle_api_error("dataset create", e); dataset_created = False
+    finally:
+        for path in (params_path, metadata_path):
+            if os.path.exists(path):
+                try: os.remove(path)
+                except OSError: pass
+    if not dataset_created: return False
+    try:
+        logging.info(f"Triggering Kaggle kernel push: {notebook_slug}"); params_dataset_full_slug = f"{notebook_slug.split('/')[0]}/{PARAMS_DATASET_SLUG}"
+        os.makedirs(dummy_dir, exist_ok=True)
+        kernel_metadata = {"id": notebook_slug, "language": "python", "kernel_type": "notebook", "is_private": "true", "enable_gpu": "true", "enable_internet": "true", "dataset_sources": [params_dataset_full_slug], "competition_sources": [], "kernel_sources": []}
+        with open(kernel_metadata_path, 'w') as f: json.dump(kernel_metadata, f)
+        logging.info(f"Pushing kernel {notebook_slug}...")
+        with _kaggle_client_locks[account_index]: result_push = api.kernels_push(dummy_dir)
+        push_error = _response_field(result_push, "error")
+        if push_error: logging.error(f"Kaggle push failed: {push_error}"); return False
+        logging.info(f"Kaggle kernel push initiated. Version: {_response_field(result_push, 'versionNumber')}, URL: {_response_field(result_push, 'url')}"); return True
+    except (IOError, OSError) as e: logging.error(f"File I/O error kernel push setup: {e}"); return False
+    except Exception as e: _log_kaggle_api_error("kernel push", e); return False
+    finally:
+        try:
+            if os.path.exists(kernel_metadata_path): os.remove(kernel_metadata_path)
+            if os.path.isdir(dummy_dir): os.rmdir(dummy_dir)
+        except OSError as e: logging.warning(f"Could not cleanup dummy push dir: {e}")
+def _parse_kaggle_status(raw_status):
+    # Older clients return plain strings ("complete"), newer ones enum values ("KernelWorkerStatus.COMPLETE").
+    status_part = str(raw_status).strip().lower() if raw_status is not None else ""
+    for known in ("error", "complete", "running", "cancelled", "queued"):
+        if known in status_part: return known
+    if "cancel" in status_part: return "cancelled"
+    logging.warning(f"Unknown status parsed: '{status_part}'"); return None
+def check_kaggle_status(notebook_slug, account_index=0):
+    logging.debug(f"Checking Kaggle status: {notebook_slug} (account {account_index})")
+    api = get_kaggle_client(account_index)
+    if api is None: return None
+    try:
+        with _kaggle_client_locks[account_index]: response = api.kernels_status(notebook_slug)
+        failure_message = _response_field(response, "failureMessage") or _response_field(response, "failure_message")
+        if failure_message: logging.warning(f"Kaggle kernel {notebook_slug} failure message: {failure_message}")
+        return _parse_kaggle_status(_response_field(response, "status"))
+    except Exception as e: _log_kaggle_api_error("status check", e); return None
+def check_kaggle_statuses(kernels):
+    # Resolves all in-flight kernels in one round. kernels maps account_index -> notebook_slug; every account has its
+    # own pooled client, so the status calls run side by side and the round costs about one call's latency.
+    if not kernels: return {}
+    results = {}
+    with metrics.timer("kaggle_status_poll"), ThreadPoolExecutor(max_workers=len(kernels)) as executor:
+        futures = {executor.submit(check_kaggle_status, slug, account_index): account_index for account_index, slug in kernels.items()}
+        for future in as_completed(futures):
+            account_index = futures[future]
+            try: results[account_index] = future.result()
+            except Exception as e: logging.error(f"Unexpected error in batched status check (account {account_index}): {e}", exc_info=True); results[account_index] = None
+    return results
+KAGGLE_DOWNLOAD_WORKERS = 4   # Output files fetched in parallel
+def _list_kernel_output_files(api, notebook_slug):
+    # {file_name: signed url} of the kernel's latest output, without downloading anything. Older clients expose the
+    # swagger call, kaggle>=1.7 goes through kagglesdk.
+    owner_slug, kernel_slug = notebook_slug.split('/', 1)
+    if hasattr(api, "kernel_output_with_http_info"):
+        response = api.process_response(api.kernel_output_with_http_info(owner_slug, kernel_slug))
+        return {item['fileName']: item['url'] for item in response.get('files', [])}
+    from kagglesdk.kernels.types.kernels_api_service import ApiListKernelSessionOutputRequest
+    files = {}; page_token = None
+    with api.build_kaggle_client() as kaggle:
+        while True:
+            request = ApiListKernelSessionOutputRequest(); request.user_name = owner_slug; request.kernel_slug = kernel_slug
+            if page_token: request.page_token = page_token
+            response = kaggle.kernels.kernels_api_client.list_kernel_session_output(request)
+            for item in response.files: files[item.file_name] = item.url
+            page_token = response.next_page_token
+            if not page_token: break
+    return files
+def _verified_output(downloaded, file_name):
+    # Path of a downloaded output that passed its check, else None. A corrupt file is deleted so a retry fetches it again.
+    info = downloaded.get(file_name)
+    if not info: return None
+    path = info["path"]
+    if file_name.endswith(".mp3"):
+        check = verify_mp3(path)
+        if not check["ok"]: logging.warning(f"MP3 '{file_name}' failed integrity check ({check['error']}). Discarding it."); os.remove(path); return None
+        logging.info(f"Verified MP3: {path} ({check['frames']} frames, {check['duration']}s)")
+    elif file_name.endswith(".json"):
+        try:
+            with open(path, 'r', encoding='utf-8') as f: json.load(f)
+        except (OSError, ValueError) as e: logging.warning(f"JSON '{file_name}' unreadable ({e}). Discarding it."); os.remove(path); return None
+        logging.info(f"Verified JSON: {path}")
+    elif info["size"] <= 100: logging.warning(f"'{file_name}' is empty."); return None
+    return path
+def _collect_batch_outputs(downloaded, batch_size):
+    # Pairs output_{n}.mp3 with result_{n}.json. A track the kernel did not produce is dropped and the rest of the batch
+    # is kept; a listed file that failed to download or verify raises, so the retry fetches (or resumes) it.
+    outputs = []; failed = []
+    for n in range(batch_size):
+        mp3_name = KAGGLE_OUTPUT_BATCH_MP3.format(n=n); json_name = KAGGLE_OUTPUT_BATCH_JSON.format(n=n)
+        mp3_path = _verified_output(downloaded, mp3_name); json_path = _verified_output(downloaded, json_name)
+        if mp3_path and json_path: outputs.append({"index": n, "mp3": mp3_path, "json": json_path, "sha256": downloaded[mp3_name]["sha256"]}); continue
+        failed += [name for name, path in ((mp3_name, mp3_path), (json_name, json_path)) if not path and name in downloaded]
+        logging.warning(f"Batch track {n}: MP3 OK={bool(mp3_path)}, JSON OK={bool(json_path)}. Skipping track.")
+    if failed: raise IncompleteOutputError(f"batch outputs failed to download or verify: {failed}")
+    logging.info(f"Verified {len(outputs)}/{batch_size} batch tracks.")
+    if not outputs: raise IncompleteOutputError("no complete batch track in the kernel output")
+    return outputs
+
+def download_kaggle_output(notebook_slug, destination_dir=".", download_image=False, account_index=0, batch_size=None): ## <<< MODIFIED >>> ##
+    # With batch_size set, returns the list of verified {"index", "mp3", "json", "sha256"} batch tracks instead of the single-track tuple.
+    # Only the files this run needs are fetched (in parallel, resumable). A missing, partial or unverified output raises
+    # IncompleteOutputError, which retry_operation retries right away; the retry resumes partial files. Returns the
+    # failure value (None / (None, None, None)) only when no Kaggle client can be set up.
+    logging.info(f"Attempting download from Kaggle kernel: {notebook_slug} (account {account_index})")
+    failure = None if batch_size else (None, None, None)
+    try: os.makedirs(destination_dir, exist_ok=True)
+    except OSError as e: logging.error(f"Failed create dest dir: {e}"); return failure
+    api = get_kaggle_client(account_index)
+    if api is None: return failure
+    if batch_size: wanted = [name for n in range(batch_size) for name in (KAGGLE_OUTPUT_BATCH_MP3.format(n=n), KAGGLE_OUTPUT_BATCH_JSON.format(n=n))]
+    else: wanted = [KAGGLE_OUTPUT_MP3, KAGGLE_OUTPUT_JSON] + ([KAGGLE_OUTPUT_IMG] if download_image else [])
+    try:
+        with _kaggle_client_locks[account_index]: available = _list_kernel_output_files(api, notebook_slug)
+    except Exception as e: _log_kaggle_api_error("output listing", e); raise IncompleteOutputError(f"output listing failed: {e}") from e
+    missing = [name for name in wanted if name not in available]
+    if missing: logging.warning(f"Kernel output has no {missing} ({len(available)} files listed).")
+    logging.info(f"Downloading {len(wanted) - len(missing)} of {len(available)} output files...")
+    downloaded = download_files({name: available[name] for name in wanted if name in available}, destination_dir, max_workers=KAGGLE_DOWNLOAD_WORKERS)
+    if batch_size: return _collect_batch_outputs(downloaded, batch_size)
+    mp3_path = _verified_output(downloaded, KAGGLE_OUTPUT_MP3); json_path = _verified_output(downloaded, KAGGLE_OUTPUT_JSON)
+    img_path = _verified_output(downloaded, KAGGLE_OUTPUT_IMG) if download_image else None
+    if not mp3_path: logging.warning(f"MP3 '{KAGGLE_OUTPUT_MP3}' missing/invalid.")
+    if not json_path: logging.warning(f"JSON '{KAGGLE_OUTPUT_JSON}' missing/invalid.")
+    if not (mp3_path and json_path): raise IncompleteOutputError(f"MP3 OK={bool(mp3_path)}, JSON OK={bool(json_path)}")
+    return mp3_path, json_path, img_path
+# --- Uniqueness Check --- ## <<< MODIFIED >>> ##
+# Fingerprints of every kept track live in a persistent LSH index (fingerprint_index.py) instead of the last N in the state file.
+_fingerprint_index = None
+_fingerprint_index_lock = threading.Lock()
+def get_fingerprint_index():
+    global _fingerprint_index
+    with _fingerprint_index_lock:
+        if _fingerprint_index is None:
+            try: _fingerprint_index = FingerprintIndex(FINGERPRINT_INDEX_PATH)
+            except Exception as e: logging.critical(f"Failed open fingerprint index '{FINGERPRINT_INDEX_PATH}': {e}", exc_info=True); return None
+        return _fingerprint_index
+def compare_fingerprints(fp1_str, fp2_str): return fingerprint_similarity(fp1_str, fp2_str)
+def is_unique_enough(new_fingerprint, threshold, key=None):
+    # key: the track's own index key, so a rerun of the check does not match the fingerprint its first run stored.
+    if not new_fingerprint: logging.warning("New fingerprint empty."); return False
+    index = get_fingerprint_index()
+    if index is None: logging.error("Fingerprint index unavailable. Treating track as unique."); return True
+    try: return index.is_unique(new_fingerprint, threshold, key=key)
+    except Exception as e: logging.error(f"Fingerprint index lookup failed: {e}. Treating track as unique.", exc_info=True); return True
+def add_fingerprint(fingerprint, label=None, key=None):
+    index = get_fingerprint_index()
+    if index is None: logging.error("Fingerprint index unavailable. Fingerprint not stored."); return False
+    try: index.add(fingerprint, label=label, key=key); return True
+    except Exception as e: logging.error(f"Failed store fingerprint: {e}", exc_info=True); return False
+def migrate_recent_fingerprints(state_data):
+    # One-time move of the legacy state["recent_fingerprints"] window into the index. Returns True if the state changed.
+    # These are the notebook's string fingerprints: they keep matching new string fingerprints, but never the local
+    # landmark (int) fingerprints, and the audio to re-fingerprint them is no longer on disk.
+    legacy_fingerprints = state_data.get("recent_fingerprints")
+    if legacy_fingerprints is None: return False
+    if get_fingerprint_index() is None: return False
+    migrated = sum(1 for fp in legacy_fingerprints if fp and add_fingerprint(fp, label="migrated_from_state"))
+    state_data.pop("recent_fingerprints", None); logging.info(f"Migrated {migrated}/{len(legacy_fingerprints)} fingerprints from state into the fingerprint index.")
+    return True
+
+# --- Spotify API Interaction ---
+# ... (get_spotify_client, get_spotify_trending_keywords remain unchanged) ...
+_spotify_client = None
+def get_spotify_client():
+    global _spotify_client, SpotifyException
+    if SPOTIPY_AVAILABLE and SpotifyException is _SpotifyExceptionFallback: from spotipy.exceptions import SpotifyException # Also for a client set from outside
+    if _spotify_client: return _spotify_client
+    if not SPOTIPY_AVAILABLE: logging.error("Spotipy not installed."); return None
+    logging.info("Authenticating with Spotify...")
+    import spotipy
+    from spotipy.oauth2 import SpotifyClientCredentials
+    try:
+        client_id = os.environ.get('SPOTIPY_CLIENT_ID'); client_secret = os.environ.get('SPOTIPY_CLIENT_SECRET')
+        if not client_id or not client_secret: logging.error("Spotify creds missing."); return None
+        client_credentials_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret); sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
+        sp.categories(limit=1); logging.info("Spotify client authenticated."); _spotify_client = sp; return _spotify_client
+    except SpotifyException as e: logging.error(f"Spotify API auth/call error: {e}", exc_info=True); return None
+    except requests.exceptions.RequestException as e: logging.error(f"Network error Spotify auth: {e}", exc_info=True); return None
+    except Exception as e: logging.critical(f"Unexpected error Spotify auth: {e}", exc_info=True); return None
+# Trend keywords are served from a cache that a background thread keeps fresh (stale-while-revalidate): callers get the
+# current keywords immediately, and a stale or empty cache only schedules a refresh. Artist genres are memoized by ID.
+SPOTIFY_TREND_TTL_SECONDS = 6 * 3600
+SPOTIFY_TREND_FETCH_SIZE = 50      # Keywords kept in the cache; callers take a slice
+SPOTIFY_ARTISTS_BATCH_SIZE = 50    # Max IDs per sp.artists() call
+SPOTIFY_ARTIST_CACHE_MAX = 5000
+_spotify_trend_cache = {"keywords": [], "fetched_at": 0.0}
+_spotify_artist_genres = {}
+_spotify_cache_lock = threading.Lock()
+_spotify_refresh_lock = threading.Lock()  # Held while a refresh runs, so at most one is in flight
+_spotify_refresher_thread = None
+def _get_artist_genres(sp, artist_ids):
+    missing = [a for a in dict.fromkeys(artist_ids) if a not in _spotify_artist_genres]
+    for i in range(0, len(missing), SPOTIFY_ARTISTS_BATCH_SIZE):
+        chunk = missing[i:i + SPOTIFY_ARTISTS_BATCH_SIZE]
+        try: artists = sp.artists(chunk).get('artists', [])
+        except (SpotifyException, requests.exceptions.RequestException) as e: logging.warning(f"Spotify error fetching genres for {len(chunk)} artists: {e}"); continue
+        if len(_spotify_artist_genres) + len(artists) > SPOTIFY_ARTIST_CACHE_MAX: _spotify_artist_genres.clear()
+        for artist in artists:
+            if artist: _spotify_artist_genres[artist['id']] = [g.lower() for g in artist.get('genres', [])]
+    logging.debug(f"Artist genres: {len(artist_ids) - len(missing)} memoized, {len(missing)} fetched.")
+    return [g for a in artist_ids for g in _spotify_artist_genres.get(a, [])]
+def _fetch_spotify_trending_keywords(limit):
+    sp = get_spotify_client()
+    if not sp: logging.error("Cannot fetch Spotify keywords: client unavailable."); return None
+    keywords = []
+    try:
+        logging.info("Fetching Spotify categories...")
+        keywords.extend(category['name'].lower() for category in sp.categories(country='US', limit=max(limit // 2, 5))['categories']['items'])
+        logging.info("Fetching Spotify new releases...")
+        new_releases = sp.new_releases(limit=min(limit, 50))['albums']['items']
+        keywords.extend(_get_artist_genres(sp, [artist['id'] for album in new_releases for artist in album['artists'] if artist.get('id')]))
+    except SpotifyException as e: logging.error(f"Spotify API error fetching keywords: {e}", exc_info=True); return None
+    except requests.exceptions.RequestException as e: logging.error(f"Network error fetching keywords: {e}", exc_info=True); return None
+    except Exception as e: logging.critical(f"Unexpected error fetching keywords: {e}", exc_info=True); return None
+    final_keywords = list(dict.fromkeys(keywords))[:limit]; logging.info(f"Fetched {len(final_keywords)} Spotify keywords.")
+    return final_keywords
+def refresh_spotify_trend_cache():
+    # Returns True if the cache was refreshed; a failed refresh keeps serving the previous keywords.
+    if not _spotify_refresh_lock.acquire(blocking=False): logging.debug("Spotify trend refresh already running."); return False
+    try:
+        keywords = _fetch_spotify_trending_keywords(SPOTIFY_TREND_FETCH_SIZE)
+        if not keywords: return False
+        with _spotify_cache_lock: _spotify_trend_cache["keywords"] = keywords; _spotify_trend_cache["fetched_at"] = time.time()
+        return True
+    finally: _spotify_refresh_lock.release()
+def get_spotify_trending_keywords(limit=10):
+    # Never blocks on Spotify: returns cached keywords (possibly stale or empty) and kicks off a background refresh if stale.
+    with _spotify_cache_lock: keywords = list(_spotify_trend_cache["keywords"]); age = time.time() - _spotify_trend_cache["fetched_at"]
+    if age > SPOTIFY_TREND_TTL_SECONDS and not _spotify_refresh_lock.locked():
+        logging.info(f"Spotify trend cache stale ({'empty' if not keywords else f'{age / 3600:.1f}h old'}). Refreshing in background.")
+        threading.Thread(target=refresh_spotify_trend_cache, name="spotify-trend-refresh", daemon=True).start()
+    return keywords[:limit]
+def start_spotify_trend_refresher(interval_seconds=SPOTIFY_TREND_TTL_SECONDS * 0.8):
+    # Keeps the cache warm so prompt generation normally sees fresh keywords; failed refreshes retry sooner.
+    global _spotify_refresher_thread
+    if not SPOTIPY_AVAILABLE: logging.info("Spotipy not installed. Trend refresher not started."); return False
+    if _spotify_refresher_thread is not None and _spotify_refresher_thread.is_alive(): return True
+    def refresher():
+        while True: time.sleep(interval_seconds if refresh_spotify_trend_cache() else 300)
+    _spotify_refresher_thread = threading.Thread(target=refresher, name="spotify-trend-refresher", daemon=True); _spotify_refresher_thread.start()
+    logging.info("Spotify trend refresher started."); return True
+
+# --- Telegram Notification Utility --- ## <<< MODIFIED >>> ##
+# Messages are queued and delivered by a TelegramNotifier task on the bot application's event loop (telegram_notifier.py);
+# callers never block on the network. Until main() attaches the loop, messages wait in the queue.
+_telegram_notifier = None
+_telegram_notifier_lock = threading.Lock()
+def _get_telegram_notifier():
+    global _telegram_notifier
+    with _telegram_notifier_lock:
+        if _telegram_notifier is None:
+            chat_id = os.environ.get('TELEGRAM_CHAT_ID')
+            if not chat_id: logging.error("Cannot init Telegram notifier: Chat ID secret missing."); return None
+            _telegram_notifier = TelegramNotifier(chat_id)
+        return _telegram_notifier
+def start_telegram_notifier(bot, loop):
+    # Called on the bot's event loop (Application.post_init) with the application's own Bot instance.
+    notifier = _get_telegram_notifier()
+    if notifier is None: return False
+    notifier.start(bot, loop); return True
+async def stop_telegram_notifier():
+    if _telegram_notifier is not None: await _telegram_notifier.stop()
+def telegram_health_check():
+    # True if the Bot API answers getMe through the notifier's loop; None otherwise (same contract as kaggle_health_check).
+    notifier = _get_telegram_notifier()
+    if notifier is None: return None
+    return True if notifier.probe() else None
+def send_telegram_message(message, level="INFO", reply_markup=None):
+    notifier = _get_telegram_notifier()
+    if notifier is None: logging.error("TG message not sent: Notifier not initialized."); return False
+    logging.debug(f"Queued Telegram message (Level: {level}).")
+    return notifier.notify(message, level=level, reply_markup=reply_markup)